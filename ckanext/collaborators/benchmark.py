@@ -0,0 +1,314 @@
+# encoding: utf-8
+
+u'''Benchmark of the collaborators actions on synthetic data
+
+Organizations, users, datasets and collaborators are bulk inserted directly in
+the database (all with names starting with a random prefix, so they can be
+told apart from real data and removed afterwards), and then the main actions
+and permission checks are run a number of times on random samples of them,
+recording their latency and number of SQL queries.
+
+It writes to the database, so it should not be run on production sites.
+'''
+
+import math
+import uuid
+import random
+import logging
+import datetime
+import timeit
+
+from sqlalchemy.dialects.postgresql import insert
+
+from ckan import model
+from ckan.lib import search
+from ckan.plugins import toolkit, get_plugin
+
+from ckanext.collaborators.model import DatasetMember, make_uuid
+from ckanext.collaborators.instrumentation import QueryCounter
+from ckanext.collaborators.logic.action import get_labels_mode
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_SIZES = {
+    u'orgs': 10,
+    u'users': 1000,
+    u'datasets': 10000,
+    u'memberships': 100000,
+    u'power_users': 1,
+    u'power_user_memberships': 10000,
+    u'iterations': 100,
+}
+
+
+def _insert_in_batches(table, rows, batch_size, conflicts=False):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            _insert(table, batch, conflicts)
+            batch = []
+    if batch:
+        _insert(table, batch, conflicts)
+
+
+def _insert(table, batch, conflicts):
+    statement = insert(table).values(batch)
+    if conflicts:
+        statement = statement.on_conflict_do_nothing()
+    model.Session.execute(statement)
+    model.Session.commit()
+
+
+class Benchmark(object):
+
+    def __init__(self, sizes=None, batch_size=10000, seed=None):
+        self.sizes = dict(DEFAULT_SIZES, **(sizes or {}))
+        if self.sizes[u'power_user_memberships'] > self.sizes[u'datasets']:
+            raise ValueError(
+                u'power_user_memberships can not be larger than datasets')
+        if self.sizes[u'power_users'] > self.sizes[u'users']:
+            raise ValueError(u'power_users can not be larger than users')
+        self.batch_size = batch_size
+        self.random = random.Random(seed)
+        self.prefix = u'benchmark-{}'.format(uuid.uuid4().hex[:8])
+        self.org_ids = []
+        self.user_ids = []
+        self.dataset_ids = []
+        self.touched = set()
+
+    # Data generation
+
+    def generate(self):
+        u'''Bulk insert the synthetic data. Returns the seconds it took.'''
+        started = timeit.default_timer()
+        now = datetime.datetime.utcnow()
+        sizes = self.sizes
+
+        self.org_ids = [make_uuid() for i in range(sizes[u'orgs'])]
+        _insert_in_batches(model.Group.__table__, ({
+            u'id': id,
+            u'name': u'{}-org-{}'.format(self.prefix, i),
+            u'title': u'Benchmark organization {}'.format(i),
+            u'type': u'organization',
+            u'is_organization': True,
+            u'approval_status': u'approved',
+            u'state': u'active',
+            u'created': now,
+        } for i, id in enumerate(self.org_ids)), self.batch_size)
+
+        self.user_ids = [make_uuid() for i in range(sizes[u'users'])]
+        _insert_in_batches(model.User.__table__, ({
+            u'id': id,
+            u'name': u'{}-user-{}'.format(self.prefix, i),
+            u'email': u'{}-user-{}@example.com'.format(self.prefix, i),
+            u'state': u'active',
+            u'sysadmin': False,
+            u'created': now,
+        } for i, id in enumerate(self.user_ids)), self.batch_size)
+
+        self.dataset_ids = [make_uuid() for i in range(sizes[u'datasets'])]
+        _insert_in_batches(model.Package.__table__, ({
+            u'id': id,
+            u'name': u'{}-dataset-{}'.format(self.prefix, i),
+            u'title': u'Benchmark dataset {}'.format(i),
+            u'type': u'dataset',
+            u'state': u'active',
+            u'private': True,
+            u'owner_org': self.org_ids[i % len(self.org_ids)]
+            if self.org_ids else None,
+            u'metadata_created': now,
+            u'metadata_modified': now,
+        } for i, id in enumerate(self.dataset_ids)), self.batch_size)
+
+        _insert_in_batches(
+            DatasetMember.__table__, self._memberships(now), self.batch_size,
+            conflicts=True)
+
+        return timeit.default_timer() - started
+
+    def _memberships(self, now):
+        sizes = self.sizes
+
+        def member(user_id, dataset_id):
+            return {
+                u'id': make_uuid(),
+                u'user_id': user_id,
+                u'dataset_id': dataset_id,
+                u'capacity': self.random.choice((u'editor', u'member')),
+                u'modified': now,
+            }
+
+        for user_id in self.user_ids[:sizes[u'power_users']]:
+            for dataset_id in self.random.sample(
+                    self.dataset_ids, sizes[u'power_user_memberships']):
+                yield member(user_id, dataset_id)
+
+        # Duplicated pairs are skipped when inserted, so the final number can
+        # be slightly lower than requested
+        if self.user_ids and self.dataset_ids:
+            for i in range(sizes[u'memberships']):
+                yield member(self.random.choice(self.user_ids),
+                             self.random.choice(self.dataset_ids))
+
+    def cleanup(self):
+        u'''Remove all the synthetic data'''
+        model.Session.rollback()
+        like = u'{}-%'.format(self.prefix)
+        datasets = model.Session.query(model.Package.id).filter(
+            model.Package.name.like(like))
+        users = model.Session.query(model.User.id).filter(
+            model.User.name.like(like))
+        model.Session.query(DatasetMember).filter(
+            DatasetMember.dataset_id.in_(datasets.subquery()) |
+            DatasetMember.user_id.in_(users.subquery())).delete(
+                synchronize_session=False)
+        for dataset_id in self.touched:
+            search.clear(dataset_id)
+        for table, column in ((model.Package, model.Package.name),
+                              (model.User, model.User.name),
+                              (model.Group, model.Group.name)):
+            model.Session.query(table).filter(column.like(like)).delete(
+                synchronize_session=False)
+        model.Session.commit()
+
+    # Measurements
+
+    def _measure(self, func, samples):
+        u'''Call `func` once with each of the argument tuples in `samples`'''
+        latencies = []
+        queries = []
+        for args in samples:
+            with QueryCounter() as counter:
+                started = timeit.default_timer()
+                func(*args)
+                latencies.append(timeit.default_timer() - started)
+            queries.append(counter.count)
+            # Don't let objects loaded by one call be reused by the next
+            model.Session.remove()
+        return summarize(latencies, queries)
+
+    def _context(self, user=None):
+        return {u'model': model, u'ignore_auth': False,
+                u'user': user or self.site_user}
+
+    def _sample_members(self, iterations):
+        u'''Return the (user name, dataset id) of random collaborators'''
+        dataset_ids = [self.random.choice(self.dataset_ids)
+                       for i in range(iterations)]
+        members = dict(model.Session.query(
+            DatasetMember.dataset_id, model.User.name).join(
+            model.User, model.User.id == DatasetMember.user_id).filter(
+            DatasetMember.dataset_id.in_(dataset_ids)))
+        return [(members[dataset_id], dataset_id)
+                for dataset_id in dataset_ids if dataset_id in members]
+
+    def run(self):
+        u'''Run all the measurements, returns a dict with their results'''
+        iterations = self.sizes[u'iterations']
+        self.site_user = toolkit.get_action(u'get_site_user')(
+            {u'ignore_auth': True}, {})[u'name']
+        choice = self.random.choice
+        plugin = get_plugin(u'collaborators')
+
+        def create(dataset_id, user_id, capacity):
+            self.touched.add(dataset_id)
+            toolkit.get_action(u'dataset_collaborator_create')(
+                self._context(), {u'id': dataset_id, u'user_id': user_id,
+                                  u'capacity': capacity})
+
+        def list_(dataset_id):
+            toolkit.get_action(u'dataset_collaborator_list')(
+                self._context(), {u'id': dataset_id})
+
+        def list_for_user(user_id):
+            toolkit.get_action(u'dataset_collaborator_list_for_user')(
+                self._context(), {u'id': user_id})
+
+        def package_update_auth(user_name, dataset_id):
+            try:
+                toolkit.check_access(
+                    u'package_update', self._context(user_name),
+                    {u'id': dataset_id})
+            except toolkit.NotAuthorized:
+                pass
+
+        def user_dataset_labels(user_id):
+            # Includes loading the user, as CKAN does on each request
+            plugin.get_user_dataset_labels(model.User.get(user_id))
+
+        def users():
+            return [(choice(self.user_ids),) for i in range(iterations)]
+
+        measurements = [
+            (u'dataset_collaborator_create', create, [
+                (choice(self.dataset_ids), choice(self.user_ids),
+                 choice((u'editor', u'member'))) for i in range(iterations)]),
+            (u'dataset_collaborator_list', list_,
+             [(choice(self.dataset_ids),) for i in range(iterations)]),
+            (u'dataset_collaborator_list_for_user', list_for_user, users()),
+            (u'package_update_auth', package_update_auth,
+             self._sample_members(iterations)),
+            (u'get_user_dataset_labels', user_dataset_labels, users()),
+        ]
+        if self.sizes[u'power_users']:
+            power_user = [(self.user_ids[0],)] * iterations
+            measurements += [
+                (u'dataset_collaborator_list_for_user (power user)',
+                 list_for_user, power_user),
+                (u'get_user_dataset_labels (power user)',
+                 user_dataset_labels, power_user),
+            ]
+
+        results = {}
+        for name, func, samples in measurements:
+            log.info(u'Measuring {}'.format(name))
+            results[name] = self._measure(func, samples)
+        return results
+
+
+def percentile(values, percent):
+    u'''Nearest-rank percentile of a list of numbers'''
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def summarize(latencies, queries):
+    u'''Latency percentiles (in milliseconds) and query counts of a series of
+    calls'''
+    return {
+        u'calls': len(latencies),
+        u'latency_ms': dict(
+            (u'p{}'.format(p), round(percentile(latencies, p) * 1000, 3))
+            for p in (50, 95, 99)) if latencies else {},
+        u'queries': {
+            u'p50': percentile(queries, 50),
+            u'max': max(queries) if queries else None,
+            u'total': sum(queries),
+        },
+    }
+
+
+def run(sizes=None, batch_size=10000, seed=None, keep=False):
+    u'''Generate the synthetic data, run the measurements and remove the data
+    (unless `keep` is True). Returns a dict with the sizes, the seconds the
+    data generation took and the results of each measurement.'''
+    benchmark = Benchmark(sizes, batch_size=batch_size, seed=seed)
+    log.info(u'Generating data with prefix {}'.format(benchmark.prefix))
+    try:
+        generate_seconds = benchmark.generate()
+        results = benchmark.run()
+    finally:
+        if not keep:
+            benchmark.cleanup()
+    return {
+        u'prefix': benchmark.prefix,
+        u'sizes': benchmark.sizes,
+        u'labels_mode': get_labels_mode(),
+        u'generate_seconds': round(generate_seconds, 3),
+        u'results': results,
+    }
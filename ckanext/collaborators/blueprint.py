@@ -8,6 +8,8 @@ import ckan.model as model
 import ckan.lib.navl.dictization_functions as dictization_functions
 import ckan.logic as logic
 
+from ckanext.collaborators.profiling import phase, profiled
+
 
 def collaborators_read(dataset_id):
     if not hasattr(toolkit.c, 'user') or not toolkit.c.user:
@@ -17,16 +19,20 @@ def collaborators_read(dataset_id):
     data_dict = {'id': dataset_id}
 
     try:
-        toolkit.check_access(u'dataset_collaborator_list', context, data_dict)
-        # needed to ckan_extend package/edit_base.html
-        g.pkg_dict = toolkit.get_action('package_show')(context, data_dict)
+        with phase(u'auth'):
+            toolkit.check_access(
+                u'dataset_collaborator_list', context, data_dict)
+        with phase(u'fetch'):
+            # needed to ckan_extend package/edit_base.html
+            g.pkg_dict = toolkit.get_action('package_show')(context, data_dict)
     except toolkit.NotAuthorized:
         message = 'Unauthorized to read collaborators {0}'.format(dataset_id)
         return toolkit.abort(403, toolkit._(message))
     except toolkit.ObjectNotFound:
         return toolkit.abort(404, toolkit._(u'Resource not found'))
 
-    return toolkit.render('collaborators/collaborator/collaborators.html')
+    with phase(u'render'):
+        return toolkit.render('collaborators/collaborator/collaborators.html')
 
 def collaborator_delete(dataset_id, user_id):
     if not hasattr(toolkit.c, 'user') or not toolkit.c.user:
@@ -35,10 +41,11 @@ def collaborator_delete(dataset_id, user_id):
     context = {u'model': model, u'user': toolkit.c.user}
 
     try:
-        toolkit.get_action('dataset_collaborator_delete')(context, {
-            'id': dataset_id,
-            'user_id': user_id
-        })
+        with phase(u'action'):
+            toolkit.get_action('dataset_collaborator_delete')(context, {
+                'id': dataset_id,
+                'user_id': user_id
+            })
     except toolkit.NotAuthorized:
         message = u'Unauthorized to delete collaborators {0}'.format(dataset_id)
         return toolkit.abort(403, toolkit._(message))
@@ -62,9 +69,10 @@ class CollaboratorEditView(MethodView):
                     logic.tuplize_dict(
                         logic.parse_params(toolkit.request.form))))
 
-            user = toolkit.get_action('user_show')(context, {
-                'id':form_dict['username']
-                })
+            with phase(u'fetch'):
+                user = toolkit.get_action('user_show')(context, {
+                    'id':form_dict['username']
+                    })
 
             data_dict = {
                 'id': dataset_id,
@@ -73,8 +81,9 @@ class CollaboratorEditView(MethodView):
                 'send_mail': form_dict.get('send_mail', False)
             }
 
-            toolkit.get_action('dataset_collaborator_create')(
-                context, data_dict)
+            with phase(u'action'):
+                toolkit.get_action('dataset_collaborator_create')(
+                    context, data_dict)
 
         except dictization_functions.DataError:
             return toolkit.abort(400, _(u'Integrity Error'))
@@ -98,9 +107,13 @@ class CollaboratorEditView(MethodView):
         data_dict = {'id': dataset_id}
 
         try:
-            toolkit.check_access(u'dataset_collaborator_list', context, data_dict)
-            # needed to ckan_extend package/edit_base.html
-            g.pkg_dict = toolkit.get_action('package_show')(context, data_dict)
+            with phase(u'auth'):
+                toolkit.check_access(
+                    u'dataset_collaborator_list', context, data_dict)
+            with phase(u'fetch'):
+                # needed to ckan_extend package/edit_base.html
+                g.pkg_dict = toolkit.get_action('package_show')(
+                    context, data_dict)
         except toolkit.NotAuthorized:
             message = u'Unauthorized to read collaborators {0}'.format(dataset_id)
             return toolkit.abort(403, toolkit._(message))
@@ -111,12 +124,13 @@ class CollaboratorEditView(MethodView):
         user_capacity = 'member'
 
         if user:
-            collaborators = toolkit.get_action('dataset_collaborator_list')(
-                context, data_dict)
-            for c in collaborators:
-                if c['user_id'] == user:
-                    user_capacity = c['capacity']
-            user = toolkit.get_action('user_show')(context, {'id': user})
+            with phase(u'fetch'):
+                collaborators = toolkit.get_action(
+                    'dataset_collaborator_list')(context, data_dict)
+                for c in collaborators:
+                    if c['user_id'] == user:
+                        user_capacity = c['capacity']
+                user = toolkit.get_action('user_show')(context, {'id': user})
             # Needed to reuse template
             g.user_dict = user
 
@@ -128,7 +142,9 @@ class CollaboratorEditView(MethodView):
             'user_capacity': user_capacity,
         }
 
-        return toolkit.render('collaborators/collaborator/collaborator_new.html', extra_vars)
+        with phase(u'render'):
+            return toolkit.render(
+                'collaborators/collaborator/collaborator_new.html', extra_vars)
 
 
 collaborators = Blueprint('collaborators', __name__)
@@ -136,17 +152,17 @@ collaborators = Blueprint('collaborators', __name__)
 collaborators.add_url_rule(
     rule=u'/dataset/collaborators/<dataset_id>',
     endpoint='read',
-    view_func=collaborators_read, methods=['GET',]
+    view_func=profiled(collaborators_read), methods=['GET',]
     )
 
 collaborators.add_url_rule(
     rule=u'/dataset/collaborators/<dataset_id>/new',
-    view_func=CollaboratorEditView.as_view('new'),
+    view_func=profiled(CollaboratorEditView.as_view('new')),
     methods=['GET', 'POST',]
     )
 
 collaborators.add_url_rule(
     rule=u'/dataset/collaborators/<dataset_id>/delete/<user_id>',
     endpoint='delete',
-    view_func=collaborator_delete, methods=['POST',]
+    view_func=profiled(collaborator_delete), methods=['POST',]
     )
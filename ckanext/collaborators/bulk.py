@@ -0,0 +1,199 @@
+# encoding: utf-8
+
+u'''Bulk import and export of dataset collaborators as CSV or JSON lines files
+
+Files have one collaborator per row (or line), with the `dataset_id`,
+`user_id` and `capacity` fields. Datasets and users can be given by id or by
+name when importing. Exported files have these fields (plus some optional
+ones), so they can be imported back.
+'''
+
+import csv
+import json
+import logging
+from collections import OrderedDict
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.collaborators.model import DatasetMember
+
+log = logging.getLogger(__name__)
+
+
+FORMATS = (u'csv', u'jsonl')
+
+FIELDS = (u'dataset_id', u'user_id', u'capacity')
+
+
+def guess_format(path):
+    u'''Return the format of a file from its extension (csv by default)'''
+    if path.lower().endswith((u'.jsonl', u'.json', u'.ndjson')):
+        return u'jsonl'
+    return u'csv'
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode(u'utf-8')
+    return value
+
+
+def read_collaborators(f, format=u'csv'):
+    u'''Read the rows of a CSV or JSON lines file one at a time
+
+    Yields a (line, row) tuple for each collaborator, where `row` is a dict
+    with the `dataset_id`, `user_id` and `capacity` of the collaborator (None
+    for missing fields) and `line` is its position in the file, starting at
+    1 and not counting the CSV header. Blank lines of JSON lines files are
+    skipped (but counted). Rows that can not be parsed are yielded with an
+    empty dict.
+    '''
+    if format not in FORMATS:
+        raise ValueError(u'Unknown format: {}'.format(format))
+
+    if format == u'csv':
+        rows = csv.DictReader(f)
+    else:
+        rows = f
+
+    for line, row in enumerate(rows, 1):
+        if format == u'jsonl':
+            if not row.strip():
+                continue
+            try:
+                row = json.loads(row)
+            except ValueError:
+                row = None
+        if not isinstance(row, dict):
+            yield line, {}
+            continue
+        yield line, dict((field, _decode(row.get(field)))
+                         for field in FIELDS)
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_collaborators(rows, batch_size=1000, skip=0):
+    u'''Create (or update) the collaborators read by `read_collaborators`
+
+    Rows are processed in chunks of `batch_size` with
+    ``dataset_collaborator_create_many``, which resolves all the dataset and
+    user names of the chunk at once, checks the capacities and upserts the
+    whole chunk in a single statement and commit. No notifications are sent.
+
+    The first `skip` rows are ignored, to resume an import that was
+    interrupted after that many rows had been committed.
+
+    Yields a (line, processed, rejected) tuple after each chunk is committed,
+    with the line of its last row, the number of rows in it and the list of
+    (line, row, error) tuples of the rows that could not be imported.
+    '''
+    context = {u'ignore_auth': True}
+    site_user = toolkit.get_action(u'get_site_user')(context, {})
+    create_many = toolkit.get_action(u'dataset_collaborator_create_many')
+
+    rows = ((line, row) for line, row in rows if line > skip)
+    for chunk in _chunks(rows, batch_size):
+        results = create_many(
+            {u'ignore_auth': True, u'user': site_user[u'name']},
+            {u'collaborators': [{
+                u'id': row.get(u'dataset_id'),
+                u'user_id': row.get(u'user_id'),
+                u'capacity': row.get(u'capacity'),
+            } for line, row in chunk], u'send_mail': False})
+
+        rejected = []
+        for (line, row), result in zip(chunk, results):
+            if not row:
+                rejected.append((line, row, u'Could not parse row'))
+            elif not result[u'success']:
+                rejected.append((line, row, result[u'error']))
+        yield chunk[-1][0], len(chunk), rejected
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode(u'utf-8')
+    return value
+
+
+def export_collaborators(f, format=u'csv', owner_org=None, capacity=None,
+                         modified_since=None, include_names=False,
+                         batch_size=1000):
+    u'''Write all the collaborators to a CSV or JSON lines file
+
+    Rows are read through a server side cursor, `batch_size` at a time, so
+    memory use does not grow with the size of the table.
+
+    :param f: a file opened in binary mode for CSV, or in text mode (unicode)
+        for JSON lines
+    :param owner_org: only export the collaborators of datasets of this
+        organization (id or name)
+    :param capacity: only export collaborators with this capacity
+    :param modified_since: only export collaborators modified at or after
+        this datetime
+    :param include_names: add the `dataset_name` and `user_name` fields
+        (empty if the dataset or user does not exist)
+
+    Returns the number of collaborators written.
+    '''
+    if format not in FORMATS:
+        raise ValueError(u'Unknown format: {}'.format(format))
+
+    # Columns rather than DatasetMember objects are queried, so rows are not
+    # kept in the session's identity map
+    columns = [DatasetMember.dataset_id, DatasetMember.user_id,
+               DatasetMember.capacity, DatasetMember.modified]
+    fields = FIELDS + (u'modified',)
+    if include_names:
+        columns += [model.Package.name, model.User.name]
+        fields += (u'dataset_name', u'user_name')
+
+    # Outer joins, so collaborators of missing datasets or users are still
+    # exported (with empty names)
+    q = model.Session.query(*columns)
+    if owner_org:
+        q = q.join(model.Package,
+                   model.Package.id == DatasetMember.dataset_id)
+    elif include_names:
+        q = q.outerjoin(model.Package,
+                        model.Package.id == DatasetMember.dataset_id)
+    if include_names:
+        q = q.outerjoin(model.User, model.User.id == DatasetMember.user_id)
+    if owner_org:
+        org = model.Group.get(owner_org)
+        if not org or not org.is_organization:
+            raise toolkit.ObjectNotFound(u'Organization not found')
+        q = q.filter(model.Package.owner_org == org.id)
+    if capacity:
+        q = q.filter(DatasetMember.capacity == capacity)
+    if modified_since:
+        q = q.filter(DatasetMember.modified >= modified_since)
+
+    if format == u'csv':
+        writer = csv.writer(f)
+        writer.writerow(fields)
+
+    count = 0
+    for row in q.yield_per(batch_size):
+        values = OrderedDict(zip(fields, row))
+        if values[u'modified']:
+            values[u'modified'] = values[u'modified'].isoformat()
+
+        if format == u'csv':
+            writer.writerow([_encode(value) for value in values.values()])
+        else:
+            f.write(unicode(json.dumps(values)) + u'\n')
+        count += 1
+
+    return count
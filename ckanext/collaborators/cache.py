@@ -0,0 +1,192 @@
+# encoding: utf-8
+
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import flask
+
+
+def request_cache(name):
+    u'''Return a dict to memoize values for the duration of the current request
+
+    Outside a request (eg in commands or background jobs) an empty dict is
+    returned every time, so nothing gets memoized.
+    '''
+    if not flask.has_request_context():
+        return {}
+    caches = getattr(flask.g, u'_collaborators_cache', None)
+    if caches is None:
+        caches = flask.g._collaborators_cache = {}
+    return caches.setdefault(name, {})
+
+
+def clear_request_cache(name=None):
+    u'''Forget the values memoized in the current request, for all caches or
+    just the one with the given name'''
+    if not flask.has_request_context():
+        return
+    caches = getattr(flask.g, u'_collaborators_cache', None)
+    if caches is None:
+        return
+    if name:
+        caches.pop(name, None)
+    else:
+        caches.clear()
+
+
+class MemoryBackend(object):
+    u'''In-process LRU cache with a TTL
+
+    Each process has its own copy, so invalidations only reach the process
+    where the change was made. Other processes keep serving their copy until
+    it expires.
+    '''
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                return None
+            # Move to the end, as the most recently used
+            self._data[key] = item
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisBackend(object):
+    u'''Cache shared by all processes, stored in Redis with a TTL
+
+    `client` is a Redis client, by default the one CKAN uses for background
+    jobs.
+    '''
+
+    def __init__(self, ttl, client=None, prefix=None):
+        if client is None:
+            from ckan.lib.redis import connect_to_redis
+            client = connect_to_redis()
+        self.ttl = ttl
+        self.client = client
+        self.prefix = prefix or u'ckanext-collaborators:labels:'
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, json.dumps(value))
+
+    def delete(self, keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + u'*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class LabelCache(object):
+    u'''Cache of the collaborator permission labels of each user, keyed by
+    user id
+
+    With no backend the cache is disabled, every lookup is a miss and
+    nothing is stored.
+    '''
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def get(self, user_id):
+        labels = self.backend.get(user_id) if self.enabled else None
+        if labels is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return labels
+
+    def set(self, user_id, labels):
+        if self.enabled:
+            self.backend.set(user_id, labels)
+
+    def invalidate(self, user_ids):
+        user_ids = list(set(user_ids))
+        if self.enabled and user_ids:
+            self.backend.delete(user_ids)
+            self.invalidations += len(user_ids)
+
+    def clear(self):
+        if self.enabled:
+            self.backend.clear()
+
+    def stats(self):
+        return {
+            u'enabled': self.enabled,
+            u'backend': type(self.backend).__name__ if self.enabled else None,
+            u'hits': self.hits,
+            u'misses': self.misses,
+            u'invalidations': self.invalidations,
+        }
+
+
+_label_cache = LabelCache()
+
+
+def configure_label_cache(config):
+    u'''Set up the permission labels cache from the config options'''
+    global _label_cache
+
+    backend = config.get(u'ckanext.collaborators.labels_cache.backend', u'none')
+    ttl = int(config.get(u'ckanext.collaborators.labels_cache.ttl', 300))
+    if backend == u'memory':
+        _label_cache = LabelCache(MemoryBackend(ttl, int(config.get(
+            u'ckanext.collaborators.labels_cache.size', 10000))))
+    elif backend == u'redis':
+        _label_cache = LabelCache(RedisBackend(
+            ttl, prefix=u'ckanext-collaborators:{}:labels:'.format(
+                config.get(u'ckan.site_id'))))
+    elif backend == u'none':
+        _label_cache = LabelCache()
+    else:
+        raise ValueError(
+            u'Unknown labels cache backend: {}'.format(backend))
+
+    return _label_cache
+
+
+def get_label_cache():
+    return _label_cache
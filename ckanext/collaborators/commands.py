@@ -1,11 +1,23 @@
 # encoding: utf-8
 
+from __future__ import print_function
+
+import io
+import os
 import sys
+import json
+import time
 import logging
 
-from ckan.plugins.toolkit import CkanCommand
+from ckan import model
+from ckan.lib.helpers import date_str_to_datetime
+from ckan.lib.mailer import MailerException
+from ckan.plugins.toolkit import CkanCommand, ObjectNotFound
 
-from ckanext.collaborators.model import tables_exist, create_tables
+from ckanext.collaborators import benchmark, bulk, mailer, migration
+from ckanext.collaborators.cache import get_label_cache
+from ckanext.collaborators.model import (
+    DatasetMember, tables_exist, create_tables, find_orphan_members)
 
 
 class DatasetCollaborators(CkanCommand):
@@ -15,26 +27,141 @@ class DatasetCollaborators(CkanCommand):
         paster collaborators init-db
             Initialize database tables
 
+        paster collaborators migrate [<version>] [--dry-run]
+            Upgrade (or downgrade) the database tables to the given version,
+            by default the latest one. With --dry-run the migrations that
+            would be run are listed but not applied
+
+        paster collaborators current
+            Show the current version of the database tables
+
+        paster collaborators send-notifications [--batch-size=N]
+            Send the notifications waiting in the outbox (when using the
+            outbox delivery), N at a time over a single SMTP connection.
+            Meant to be run periodically, eg from cron
+
+        paster collaborators reconcile [--include-deleted] [--batch-size=N]
+                                       [--dry-run]
+            Remove the collaborators whose user or dataset no longer exists
+            (or, with --include-deleted, is deleted), checking N rows at a
+            time. With --dry-run the orphans are counted but not removed
+
+        paster collaborators import <file> [--format=csv|jsonl]
+                                    [--batch-size=N] [--checkpoint=<file>]
+                                    [--rejects=<file>]
+            Create (or update) the collaborators listed in a CSV or JSON lines
+            file, with the dataset_id, user_id (ids or names) and capacity of
+            each one, N at a time. The number of rows imported is saved to
+            the checkpoint file after each batch, and an interrupted import
+            is resumed from there when run again. Rows that can not be
+            imported are listed in the rejects file (JSON lines)
+
+        paster collaborators export [<file>] [--format=csv|jsonl]
+                                    [--org=<org>] [--capacity=<capacity>]
+                                    [--modified-since=<date>] [--include-names]
+            Write all the collaborators (optionally only those of datasets of
+            an organization, with a capacity or modified since a date) to a
+            CSV or JSON lines file, by default to the standard output. With
+            --include-names the dataset and user names are added
+
+        paster collaborators benchmark [<size>=<value> ...] [--batch-size=N]
+                                       [--keep]
+            Bulk insert synthetic organizations, users, datasets and
+            collaborators (N rows per statement), time the main actions and
+            permission checks on them and print the results as JSON. Sizes
+            (and their defaults) are orgs=10, users=1000, datasets=10000,
+            memberships=100000, power_users=1, power_user_memberships=10000
+            and iterations=100 (calls measured for each action); seed can be
+            set to make runs repeatable. The synthetic data is removed
+            afterwards unless --keep is given. Do not run it on production
+            sites
+
+    Rows processed at a time (--batch-size) default to 100 for
+    send-notifications, 1000 for import and export and 10000 for reconcile
+    and benchmark.
+
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
-    max_args = 9
+    max_args = 10
     min_args = 0
 
+    # Default --batch-size of each command
+    batch_sizes = {
+        'send-notifications': 100,
+        'reconcile': 10000,
+        'import': 1000,
+        'export': 1000,
+        'benchmark': 10000,
+    }
+
     def __init__(self, name):
 
         super(DatasetCollaborators, self).__init__(name)
 
+        self.parser.add_option('--dry-run', dest='dry_run',
+                               action='store_true', default=False,
+                               help='Show what would be done without doing it')
+        self.parser.add_option('--batch-size', dest='batch_size', type='int',
+                               default=None,
+                               help='Number of rows processed at a time '
+                                    '(the default depends on the command)')
+        self.parser.add_option('--include-deleted', dest='include_deleted',
+                               action='store_true', default=False,
+                               help='Treat deleted users and datasets as '
+                                    'missing')
+        self.parser.add_option('--format', dest='format', default=None,
+                               choices=bulk.FORMATS,
+                               help='File format (by default guessed from '
+                                    'the file extension)')
+        self.parser.add_option('--checkpoint', dest='checkpoint',
+                               default=None,
+                               help='File to save the progress of the '
+                                    'import to')
+        self.parser.add_option('--rejects', dest='rejects', default=None,
+                               help='File to write the rejected rows to')
+        self.parser.add_option('--org', dest='org', default=None,
+                               help='Id or name of an organization')
+        self.parser.add_option('--capacity', dest='capacity', default=None,
+                               help='Capacity of the collaborators')
+        self.parser.add_option('--modified-since', dest='modified_since',
+                               default=None,
+                               help='Date (ISO 8601) collaborators were '
+                                    'last modified on or after')
+        self.parser.add_option('--include-names', dest='include_names',
+                               action='store_true', default=False,
+                               help='Add the names of datasets and users')
+        self.parser.add_option('--keep', dest='keep',
+                               action='store_true', default=False,
+                               help='Keep the synthetic benchmark data')
+
     def command(self):
         self._load_config()
 
-        if len(self.args) != 1:
+        if not self.args:
             self.parser.print_usage()
             sys.exit(1)
 
         cmd = self.args[0]
+        if self.options.batch_size is None:
+            self.options.batch_size = self.batch_sizes.get(cmd)
+
         if cmd == 'init-db':
             self.init_db()
+        elif cmd == 'migrate':
+            self.migrate()
+        elif cmd == 'current':
+            self.current()
+        elif cmd == 'send-notifications':
+            self.send_notifications()
+        elif cmd == 'reconcile':
+            self.reconcile()
+        elif cmd == 'import':
+            self.import_()
+        elif cmd == 'export':
+            self.export()
+        elif cmd == 'benchmark':
+            self.benchmark()
         else:
             self.parser.print_usage()
             sys.exit(1)
@@ -46,5 +173,218 @@ class DatasetCollaborators(CkanCommand):
             sys.exit(0)
 
         create_tables()
+        migration.stamp(model.meta.engine, migration.head())
 
         print(u'Dataset collaborators tables created')
+
+    def migrate(self):
+
+        if not tables_exist():
+            print(u'Dataset collaborators tables do not exist, run init-db')
+            sys.exit(1)
+
+        target = None
+        if len(self.args) > 1:
+            try:
+                target = int(self.args[1])
+            except ValueError:
+                print(u'Version must be an integer')
+                sys.exit(1)
+
+        try:
+            steps = migration.migrate(target, dry_run=self.options.dry_run)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+        if not steps:
+            print(u'Dataset collaborators tables are up to date')
+            return
+
+        for step, direction in steps:
+            print(u'{}{} {}: {}{}'.format(
+                u'Would ' if self.options.dry_run else u'',
+                direction, step.version, step.description,
+                u'' if step.transactional else u' (without transaction)'))
+
+    def current(self):
+
+        print(u'Current version: {} (latest: {})'.format(
+            migration.current_version(), migration.head()))
+
+    def send_notifications(self):
+
+        try:
+            sent, failed = mailer.send_outbox(
+                batch_size=self.options.batch_size)
+        except MailerException as e:
+            print(u'Could not send notifications: {}'.format(e),
+                  file=sys.stderr)
+            sys.exit(1)
+
+        print(u'{} notifications sent, {} failed'.format(sent, failed))
+
+    def reconcile(self):
+
+        dry_run = self.options.dry_run
+        connection = model.meta.engine.connect()
+        scanned = removed = 0
+        try:
+            for count, orphans in find_orphan_members(
+                    connection, self.options.batch_size,
+                    include_deleted=self.options.include_deleted):
+                scanned += count
+                if orphans and not dry_run:
+                    with connection.begin():
+                        connection.execute(
+                            DatasetMember.__table__.delete().where(
+                                DatasetMember.__table__.c.id.in_(
+                                    [row.id for row in orphans])))
+                    get_label_cache().invalidate(
+                        set(row.user_id for row in orphans))
+                removed += len(orphans)
+                print(u'{} rows checked, {} orphans {}'.format(
+                    scanned, removed, u'found' if dry_run else u'removed'))
+        finally:
+            connection.close()
+
+        print(u'{} orphan collaborators {}'.format(
+            removed, u'would be removed' if dry_run else u'removed'))
+
+    def _read_checkpoint(self):
+        path = self.options.checkpoint
+        if not path or not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+
+    def _write_checkpoint(self, line):
+        path = self.options.checkpoint
+        if not path:
+            return
+        # Written to a temporary file first so an interruption can not leave
+        # an incomplete checkpoint behind
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(line))
+        os.rename(path + '.tmp', path)
+
+    def import_(self):
+
+        if len(self.args) < 2:
+            print(u'Missing file to import')
+            sys.exit(1)
+        path = self.args[1]
+        format = self.options.format or bulk.guess_format(path)
+
+        skip = self._read_checkpoint()
+        if skip:
+            print(u'Resuming after row {}'.format(skip))
+
+        rejects = None
+        if self.options.rejects:
+            rejects = io.open(self.options.rejects, 'a' if skip else 'w',
+                              encoding='utf-8')
+
+        imported = rejected = 0
+        started = time.time()
+        try:
+            with open(path, 'rb' if format == 'csv' else 'r') as f:
+                rows = bulk.read_collaborators(f, format)
+                for line, processed, errors in bulk.import_collaborators(
+                        rows, batch_size=self.options.batch_size, skip=skip):
+                    imported += processed - len(errors)
+                    rejected += len(errors)
+                    self._write_checkpoint(line)
+                    for error_line, row, error in errors:
+                        if rejects:
+                            rejects.write(json.dumps(dict(
+                                row, line=error_line, error=error),
+                                ensure_ascii=False) + u'\n')
+                        else:
+                            print(u'Row {} rejected: {}'.format(
+                                error_line, error))
+                    print(u'{} rows imported, {} rejected ({:.0f} rows/s)'.format(
+                        imported, rejected,
+                        (imported + rejected) / max(time.time() - started,
+                                                    0.001)))
+        finally:
+            if rejects:
+                rejects.close()
+
+        if self.options.checkpoint and os.path.exists(
+                self.options.checkpoint):
+            os.remove(self.options.checkpoint)
+
+        print(u'Import finished: {} rows imported, {} rejected'.format(
+            imported, rejected))
+
+    def export(self):
+
+        path = self.args[1] if len(self.args) > 1 else None
+        format = self.options.format or (
+            bulk.guess_format(path) if path else 'csv')
+
+        modified_since = None
+        if self.options.modified_since:
+            try:
+                modified_since = date_str_to_datetime(
+                    self.options.modified_since)
+            except (TypeError, ValueError):
+                print(u'Wrong date: {}'.format(self.options.modified_since))
+                sys.exit(1)
+
+        if path:
+            f = open(path, 'wb') if format == 'csv' else io.open(
+                path, 'w', encoding='utf-8')
+        elif format == 'csv':
+            f = sys.stdout
+        else:
+            f = io.open(sys.stdout.fileno(), 'w', encoding='utf-8',
+                        closefd=False)
+
+        started = time.time()
+        try:
+            count = bulk.export_collaborators(
+                f, format, owner_org=self.options.org,
+                capacity=self.options.capacity,
+                modified_since=modified_since,
+                include_names=self.options.include_names,
+                batch_size=self.options.batch_size)
+        except ObjectNotFound as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+
+        print(u'{} collaborators exported in {:.1f}s'.format(
+            count, time.time() - started), file=sys.stderr)
+
+    def benchmark(self):
+
+        sizes = {}
+        seed = None
+        for arg in self.args[1:]:
+            key, _, value = arg.partition('=')
+            if key not in benchmark.DEFAULT_SIZES and key != 'seed':
+                print(u'Unknown size: {}'.format(key))
+                sys.exit(1)
+            try:
+                value = int(value)
+            except ValueError:
+                print(u'{} must be an integer'.format(key))
+                sys.exit(1)
+            if key == 'seed':
+                seed = value
+            else:
+                sizes[key] = value
+
+        try:
+            results = benchmark.run(
+                sizes, batch_size=self.options.batch_size, seed=seed,
+                keep=self.options.keep)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+        print(json.dumps(results, indent=2, sort_keys=True))
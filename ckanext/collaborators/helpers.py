@@ -1,19 +1,50 @@
 import ckan.plugins.toolkit as toolkit
+import ckan.lib.helpers as h
+from ckan import model
+
+from ckanext.collaborators.profiling import phase
+
 
 def get_collaborators(package_dict):
     '''Return collaborators list.
+
+    Each collaborator includes the user details (see the ``include_user``
+    parameter of ``dataset_collaborator_list``), so they can be rendered
+    without further queries.
     '''
     context = {'ignore_auth': True} #TODO
+    data_dict = {'id': package_dict['id'], 'include_user': True}
+    with phase(u'fetch'):
+        return toolkit.get_action('dataset_collaborator_list')(
+            context, data_dict)
+
+
+def get_collaborators_count(package_dict):
+    '''Return the number of collaborators of a dataset, in total (``count``)
+    and for each capacity (``capacities``).'''
+    context = {'ignore_auth': True}
     data_dict = {'id': package_dict['id']}
-    _collaborators = toolkit.get_action('dataset_collaborator_list')(context, data_dict)
-    
-    collaborators = []
+    with phase(u'fetch'):
+        return toolkit.get_action('dataset_collaborator_count')(
+            context, data_dict)
+
 
-    for collaborator in _collaborators:
-        collaborators.append([
-            collaborator['user_id'],
-            collaborator['capacity']
-            ])
+def linked_user(collaborator, maxlength=0, avatar=20):
+    '''Same as the core ``linked_user`` helper, but using the user details
+    included in a collaborator dict instead of querying the user.
+    '''
+    name = collaborator.get('user_name')
+    if not name:
+        return collaborator['user_id']
 
-    return collaborators
+    if not model.User.VALID_NAME.match(name):
+        name = collaborator['user_id']
+    displayname = collaborator['user_display_name']
+    if maxlength and len(displayname) > maxlength:
+        displayname = displayname[:maxlength] + '...'
 
+    return h.literal(u'{icon} {link}'.format(
+        icon=h.gravatar(email_hash=collaborator['user_email_hash'],
+                        size=avatar),
+        link=h.link_to(displayname, h.url_for('user.read', id=name))
+    ))
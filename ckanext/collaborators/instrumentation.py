@@ -0,0 +1,389 @@
+# encoding: utf-8
+
+u'''Tools to measure the work done by the collaborators extension'''
+
+import os
+import re
+import bisect
+import socket
+import traceback
+import logging
+import threading
+import functools
+import timeit
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from ckan.model import meta
+from ckan.plugins.toolkit import asbool
+
+log = logging.getLogger(__name__)
+
+
+class QueryCounter(object):
+    u'''Count the SQL statements run on an engine (by default CKAN's)
+
+    Use it as a context manager::
+
+        with QueryCounter() as counter:
+            toolkit.get_action('dataset_collaborator_list')(...)
+        print(counter.count, counter.statements)
+
+    '''
+
+    def __init__(self, engine=None):
+        self.engine = engine or meta.engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, u'before_cursor_execute',
+                     self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, u'before_cursor_execute',
+                     self._before_cursor_execute)
+
+
+# Metrics
+#
+# Actions, auth functions and permission label hooks are wrapped with
+# `instrumented` when registered by the plugin. When no sinks are configured
+# (and the slow query log is disabled) the wrappers just call the wrapped
+# function, otherwise each call is measured and passed to all the sinks.
+
+# Upper bounds (in milliseconds) of the latency histogram buckets
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, float(u'inf'))
+
+_sinks = []
+
+# Whether the calls in progress need to be tracked even with no sinks
+_tracking = False
+
+_local = threading.local()
+
+
+class Measurement(object):
+
+    __slots__ = (u'kind', u'name', u'seconds', u'queries', u'rows', u'error')
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.seconds = 0
+        self.queries = 0
+        self.rows = None
+        self.error = False
+
+    @property
+    def key(self):
+        return u'{}.{}'.format(self.kind, self.name)
+
+
+def _count_rows(result):
+    if isinstance(result, dict) and isinstance(result.get(u'results'), list):
+        return len(result[u'results'])
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return None
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    for measurement in getattr(_local, u'active', ()):
+        measurement.queries += 1
+
+
+def instrumented(kind, name):
+    u'''Decorator to record the metrics of each call to a function
+
+    `kind` is one of ``action``, ``auth`` or ``labels``. Attributes of the
+    function (eg those set by ``chained_action`` or
+    ``auth_allow_anonymous_access``) are kept.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks and not _tracking:
+                return func(*args, **kwargs)
+
+            measurement = Measurement(kind, name)
+            active = getattr(_local, u'active', None)
+            if active is None:
+                active = _local.active = []
+            active.append(measurement)
+            started = timeit.default_timer()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                measurement.error = True
+                raise
+            else:
+                measurement.rows = _count_rows(result)
+                return result
+            finally:
+                measurement.seconds = timeit.default_timer() - started
+                active.remove(measurement)
+                for sink in _sinks:
+                    try:
+                        sink.record(measurement)
+                    except Exception:
+                        log.exception(u'Could not record metrics')
+        return wrapper
+    return decorator
+
+
+class LogSink(object):
+    u'''Write a log line for each call'''
+
+    def record(self, m):
+        log.info(u'{} {:.1f}ms queries={} rows={}{}'.format(
+            m.key, m.seconds * 1000, m.queries,
+            u'-' if m.rows is None else m.rows,
+            u' error' if m.error else u''))
+
+
+class StatsdSink(object):
+    u'''Send the metrics of each call to a statsd server over UDP'''
+
+    def __init__(self, host=u'localhost', port=8125,
+                 prefix=u'ckanext.collaborators'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, m):
+        key = u'{}.{}'.format(self.prefix, m.key)
+        lines = [
+            u'{}.calls:1|c'.format(key),
+            u'{}.latency:{:.3f}|ms'.format(key, m.seconds * 1000),
+            u'{}.queries:{}|h'.format(key, m.queries),
+        ]
+        if m.rows is not None:
+            lines.append(u'{}.rows:{}|h'.format(key, m.rows))
+        if m.error:
+            lines.append(u'{}.errors:1|c'.format(key))
+        try:
+            self.socket.sendto(
+                u'\n'.join(lines).encode(u'utf-8'), self.address)
+        except socket.error as e:
+            log.debug(u'Could not send metrics to statsd: {}'.format(e))
+
+
+class MemorySink(object):
+    u'''Aggregate the metrics of each action, auth function and hook in this
+    process, to be read with the ``collaborators_stats`` action'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def record(self, m):
+        with self._lock:
+            metric = self._metrics.get(m.key)
+            if metric is None:
+                metric = self._metrics[m.key] = {
+                    u'calls': 0,
+                    u'errors': 0,
+                    u'total_ms': 0.0,
+                    u'max_ms': 0.0,
+                    u'queries': 0,
+                    u'rows': 0,
+                    u'histogram': [0] * len(BUCKETS),
+                }
+            ms = m.seconds * 1000
+            metric[u'calls'] += 1
+            metric[u'errors'] += int(m.error)
+            metric[u'total_ms'] += ms
+            metric[u'max_ms'] = max(metric[u'max_ms'], ms)
+            metric[u'queries'] += m.queries
+            metric[u'rows'] += m.rows or 0
+            metric[u'histogram'][bisect.bisect_left(BUCKETS, ms)] += 1
+
+    def snapshot(self):
+        u'''Return a copy of the metrics, with the histogram buckets keyed
+        by their upper bound'''
+        with self._lock:
+            out = {}
+            for key, metric in self._metrics.items():
+                metric = dict(metric)
+                metric[u'histogram'] = OrderedDict(
+                    (u'le_{}'.format(bound) if bound != BUCKETS[-1]
+                     else u'inf', count)
+                    for bound, count in zip(BUCKETS, metric[u'histogram']))
+                out[key] = metric
+            return out
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+
+
+def _listen(name, func, enabled):
+    u'''Add or remove an event listener on CKAN's engine'''
+    listening = event.contains(meta.engine, name, func)
+    if enabled and not listening:
+        event.listen(meta.engine, name, func)
+    elif not enabled and listening:
+        event.remove(meta.engine, name, func)
+
+
+def configure_metrics(config):
+    u'''Set up the metrics sinks from the config options'''
+    global _sinks
+
+    sinks = []
+    for name in config.get(u'ckanext.collaborators.metrics.sinks', u'').split():
+        if name == u'log':
+            sinks.append(LogSink())
+        elif name == u'statsd':
+            sinks.append(StatsdSink(
+                config.get(u'ckanext.collaborators.metrics.statsd_host',
+                           u'localhost'),
+                config.get(u'ckanext.collaborators.metrics.statsd_port',
+                           8125),
+                config.get(u'ckanext.collaborators.metrics.statsd_prefix',
+                           u'ckanext.collaborators')))
+        elif name == u'memory':
+            sinks.append(MemorySink())
+        else:
+            raise ValueError(u'Unknown metrics sink: {}'.format(name))
+
+    _listen(u'before_cursor_execute', _count_query, bool(sinks))
+
+    _sinks = sinks
+    return sinks
+
+
+def get_memory_sink():
+    u'''Return the in-memory registry of metrics, if enabled'''
+    for sink in _sinks:
+        if isinstance(sink, MemorySink):
+            return sink
+    return None
+
+
+# Slow query log
+#
+# Statements on the dataset_member table that take longer than the threshold
+# are logged with their parameters, the actions (or auth functions...) in
+# progress, the place in the extension code they were run from and, on
+# PostgreSQL, their plan. Plans are obtained with EXPLAIN, which does not run
+# the statement again.
+
+_slow_query_threshold = None
+
+_explain_slow_queries = True
+
+_TABLE_RE = re.compile(r'\bdataset_member\b')
+
+_EXPLAINABLE = (u'SELECT', u'INSERT', u'UPDATE', u'DELETE', u'WITH')
+
+
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    # Kept in the execution context, so nothing is left behind if the
+    # statement fails
+    if context is not None:
+        context._collaborators_query_start = timeit.default_timer()
+
+
+def _check_slow_query(conn, cursor, statement, parameters, context,
+                      executemany):
+    started = getattr(context, u'_collaborators_query_start', None)
+    if started is None:
+        return
+    seconds = timeit.default_timer() - started
+    if seconds * 1000 < _slow_query_threshold or \
+            not _TABLE_RE.search(statement):
+        return
+
+    calls = getattr(_local, u'active', None)
+    plan = None
+    if _explain_slow_queries and not executemany and \
+            conn.dialect.name == u'postgresql' and \
+            statement.lstrip().upper().startswith(_EXPLAINABLE):
+        plan = _explain(cursor.connection, statement, parameters)
+
+    log.warning(
+        u'Slow query on dataset_member ({:.1f}ms)\n'
+        u'Called from: {}\n'
+        u'Location: {}\n'
+        u'Statement: {}\n'
+        u'Parameters: {}{}'.format(
+            seconds * 1000,
+            u' > '.join(m.key for m in calls) if calls else u'unknown',
+            _caller(),
+            statement,
+            _truncate(repr(parameters)),
+            u'\nPlan:\n{}'.format(plan) if plan else u''))
+
+
+def _truncate(text, length=1000):
+    if len(text) > length:
+        return text[:length] + u'...'
+    return text
+
+
+def _caller():
+    u'''Return the innermost frame of the extension (outside this module)
+    in the current stack'''
+    package = os.path.dirname(os.path.abspath(__file__))
+    this = os.path.splitext(os.path.abspath(__file__))[0]
+    for filename, line, function, text in reversed(traceback.extract_stack()):
+        path = os.path.abspath(filename)
+        if path.startswith(package) and \
+                os.path.splitext(path)[0] != this:
+            return u'{}:{} in {}'.format(
+                os.path.relpath(path, os.path.dirname(package)), line,
+                function)
+    return u'unknown'
+
+
+def _explain(dbapi_connection, statement, parameters):
+    u'''Return the plan of a statement, using the DBAPI connection directly
+    so the EXPLAIN is not itself instrumented. Inside a transaction it runs
+    in a savepoint, so a failure can not abort the transaction.'''
+    savepoint = not getattr(dbapi_connection, u'autocommit', False)
+    cursor = dbapi_connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute(u'SAVEPOINT collaborators_explain')
+        try:
+            cursor.execute(u'EXPLAIN ' + statement, parameters)
+            plan = u'\n'.join(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            if savepoint:
+                cursor.execute(u'ROLLBACK TO SAVEPOINT collaborators_explain')
+            log.debug(u'Could not explain statement: {}'.format(e))
+            plan = None
+        if savepoint:
+            cursor.execute(u'RELEASE SAVEPOINT collaborators_explain')
+        return plan
+    except Exception as e:
+        log.debug(u'Could not explain statement: {}'.format(e))
+        return None
+    finally:
+        cursor.close()
+
+
+def configure_slow_query_log(config):
+    u'''Set up the slow query log from the config options'''
+    global _slow_query_threshold, _explain_slow_queries, _tracking
+
+    threshold = config.get(u'ckanext.collaborators.slow_queries.threshold')
+    _slow_query_threshold = float(threshold) if threshold else None
+    _explain_slow_queries = asbool(config.get(
+        u'ckanext.collaborators.slow_queries.explain', True))
+
+    enabled = _slow_query_threshold is not None
+    _listen(u'before_cursor_execute', _start_timer, enabled)
+    _listen(u'after_cursor_execute', _check_slow_query, enabled)
+    _tracking = enabled
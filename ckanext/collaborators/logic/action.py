@@ -1,17 +1,95 @@
+import json
+import base64
+import hashlib
 import logging
 import datetime
 
+from sqlalchemy import or_, tuple_, func, select
+
 from ckan import model as core_model
+from ckan.lib import search
 from ckan.plugins import toolkit
 
-from ckanext.collaborators.model import DatasetMember
-from ckanext.collaborators.mailer import mail_notification_to_collaborator
+from ckanext.collaborators.cache import clear_request_cache, get_label_cache
+from ckanext.collaborators.instrumentation import get_memory_sink
+from ckanext.collaborators.model import (
+    DatasetMember, member_as_dict, upsert_members, foreign_keys_exist)
+from ckanext.collaborators.mailer import add_to_outbox, notify_collaborators
 
 log = logging.getLogger(__name__)
 
 
 ALLOWED_CAPACITIES = ('editor', 'member')
 
+DEFAULT_MAX_LIMIT = 1000
+
+LABELS_MODES = ('dataset', 'user')
+
+
+def get_labels_mode():
+    '''Return how permission labels are assigned to collaborators
+
+    * ``dataset``: each dataset has a label that all its collaborators get
+    * ``user``: each collaborator has a label that all their datasets get.
+      This keeps the search filters of users with many collaborations small,
+      but datasets need to be reindexed when their collaborators change
+
+    '''
+    mode = toolkit.config.get('ckanext.collaborators.labels_mode', 'dataset')
+    if mode not in LABELS_MODES:
+        raise ValueError('Unknown labels mode: {}'.format(mode))
+    return mode
+
+
+def reindex_datasets_job(dataset_ids):
+    '''Background job that reindexes datasets after their collaborators
+    have changed'''
+    for dataset_id in dataset_ids:
+        try:
+            search.rebuild(dataset_id, defer_commit=True)
+        except toolkit.ObjectNotFound:
+            # Purged since the job was enqueued
+            search.clear(dataset_id)
+    search.commit()
+    log.info('Reindexed {} datasets'.format(len(dataset_ids)))
+
+
+def _reindex_datasets(dataset_ids):
+    '''Reindex datasets, in the request if there are only a few of them
+    (up to ``ckanext.collaborators.reindex.threshold``) or otherwise in
+    background jobs of ``ckanext.collaborators.reindex.batch_size`` datasets
+    '''
+    dataset_ids = sorted(set(dataset_ids))
+    if not dataset_ids:
+        return
+
+    threshold = int(toolkit.config.get(
+        'ckanext.collaborators.reindex.threshold', 20))
+    if len(dataset_ids) <= threshold:
+        reindex_datasets_job(dataset_ids)
+        return
+
+    batch_size = int(toolkit.config.get(
+        'ckanext.collaborators.reindex.batch_size', 1000))
+    for start in range(0, len(dataset_ids), batch_size):
+        chunk = dataset_ids[start:start + batch_size]
+        toolkit.enqueue_job(
+            reindex_datasets_job, [chunk],
+            title='Reindex {} datasets after collaborator changes'.format(
+                len(chunk)),
+            queue=toolkit.config.get(
+                'ckanext.collaborators.reindex.queue', 'default'))
+
+
+def _memberships_changed(user_ids, dataset_ids):
+    '''Update everything that depends on the collaborators of datasets after
+    they have been changed (and committed)'''
+    clear_request_cache('editor')
+    get_label_cache().invalidate(user_ids)
+
+    if get_labels_mode() == 'user':
+        _reindex_datasets(dataset_ids)
+
 
 def dataset_collaborator_create(context, data_dict):
     '''Make a user a collaborator in a dataset.
@@ -63,18 +141,143 @@ def dataset_collaborator_create(context, data_dict):
     member.modified = datetime.datetime.utcnow()
 
     model.Session.add(member)
+    if data_dict.get('send_mail', False):
+        add_to_outbox([member.as_dict()], event='create')
     model.repo.commit()
+    _memberships_changed([user.id], [dataset.id])
 
     log.info('User {} added as collaborator in dataset {} ({})'.format(
         user.name, dataset.id, capacity))
 
     if data_dict.get('send_mail', False):
-        mail_notification_to_collaborator(dataset_id, user_id, capacity,
-                                        event='create')
+        notify_collaborators([member.as_dict()], event='create')
 
     return member.as_dict()
 
 
+def _resolve_ids(model, model_class, keys):
+    '''Map ids or names of datasets or users to their ids in a single query'''
+    keys = list(set(key for key in keys
+                    if key and isinstance(key, basestring)))
+    if not keys:
+        return {}
+
+    q = model.Session.query(model_class.id, model_class.name).filter(
+        or_(model_class.id.in_(keys), model_class.name.in_(keys)))
+
+    ids = {}
+    for id_, name in q:
+        ids[id_] = id_
+        ids[name] = id_
+    return ids
+
+
+def dataset_collaborator_create_many(context, data_dict):
+    '''Make users collaborators in datasets in a single operation.
+
+    If a user is already a collaborator in a dataset then their capacity will
+    be updated.
+
+    Users are authorized once for each of the datasets involved, in the same
+    way as in ``dataset_collaborator_create``. Items that can not be processed
+    (eg because the dataset does not exist or the user is not authorized on
+    it) are reported in the results, and do not prevent the rest from being
+    created.
+
+    :param collaborators: the collaborators to create, each a dict with the
+        ``id`` (id or name of the dataset), ``user_id`` (id or name of the
+        user) and ``capacity`` (one of {}) keys
+    :type collaborators: list of dictionaries
+    :param send_mail: (optional) send a notification email to each of the
+        collaborators created or updated
+    :type send_mail: bool
+
+    :returns: one result for each of the items in ``collaborators``, in the
+        same order, each a dict with a ``success`` key and either a
+        ``collaborator`` key with the created (or updated) collaborator or an
+        ``error`` key with the reason it failed
+    :rtype: list of dictionaries
+
+    '''.format(', '.join(ALLOWED_CAPACITIES))
+    model = context.get('model', core_model)
+
+    collaborators = toolkit.get_or_bust(data_dict, 'collaborators')
+    if not isinstance(collaborators, list) or not all(
+            isinstance(item, dict) for item in collaborators):
+        raise toolkit.ValidationError(
+            {'collaborators': ['Must be a list of dictionaries']})
+
+    toolkit.check_access('dataset_collaborator_create_many', context, data_dict)
+
+    dataset_ids = _resolve_ids(
+        model, model.Package, [item.get('id') for item in collaborators])
+    user_ids = _resolve_ids(
+        model, model.User, [item.get('user_id') for item in collaborators])
+
+    authorized = {}
+    errors = []
+    members = []
+    for item in collaborators:
+        dataset_id = dataset_ids.get(item.get('id'))
+        user_id = user_ids.get(item.get('user_id'))
+        error = None
+        if item.get('capacity') not in ALLOWED_CAPACITIES:
+            error = 'Capacity must be one of "{}"'.format(', '.join(
+                ALLOWED_CAPACITIES))
+        elif not dataset_id:
+            error = 'Dataset not found'
+        elif not user_id:
+            error = 'User not found'
+        else:
+            if dataset_id not in authorized:
+                try:
+                    toolkit.check_access('dataset_collaborator_create',
+                                         context, {'id': dataset_id})
+                    authorized[dataset_id] = True
+                except toolkit.NotAuthorized:
+                    authorized[dataset_id] = False
+            if not authorized[dataset_id]:
+                error = 'Not authorized to add collaborators to dataset {}'.format(
+                    dataset_id)
+
+        errors.append(error)
+        members.append({
+            'dataset_id': dataset_id,
+            'user_id': user_id,
+            'capacity': item.get('capacity'),
+        })
+
+    upserted = upsert_members(model.Session, [
+        member for member, error in zip(members, errors) if not error])
+    if data_dict.get('send_mail', False):
+        add_to_outbox(upserted, event='create')
+    model.repo.commit()
+    _memberships_changed([member['user_id'] for member in upserted],
+                         [member['dataset_id'] for member in upserted])
+
+    upserted = dict(((member['dataset_id'], member['user_id']), member)
+                    for member in upserted)
+
+    log.info('{} collaborators added or updated in {} datasets'.format(
+        len(upserted), len(set(key[0] for key in upserted))))
+
+    results = []
+    for member, error in zip(members, errors):
+        if error:
+            results.append({'success': False, 'error': error})
+        else:
+            results.append({
+                'success': True,
+                'collaborator': upserted[
+                    (member['dataset_id'], member['user_id'])],
+            })
+
+    if data_dict.get('send_mail', False):
+        notify_collaborators(upserted.values(), event='create')
+
+    return results
+
+
 def dataset_collaborator_delete(context, data_dict):
     '''Remove a collaborator from a dataset.
 
@@ -104,13 +307,173 @@ def dataset_collaborator_delete(context, data_dict):
             'User {} is not a collaborator on this dataset'.format(user_id))
 
     model.Session.delete(member)
+    add_to_outbox([member.as_dict()], event='delete')
     model.repo.commit()
+    _memberships_changed([member.user_id], [dataset.id])
 
     log.info('User {} removed as collaborator from dataset {}'.format(
         user_id, dataset.id))
 
-    mail_notification_to_collaborator(dataset_id, user_id, member.capacity,
-                                        event='delete')
+    notify_collaborators([member.as_dict()], event='delete')
+
+
+def _as_list(value):
+    if isinstance(value, basestring):
+        return [value]
+    return value or []
+
+
+def dataset_collaborator_delete_many(context, data_dict):
+    '''Remove collaborators from datasets in a single operation.
+
+    All the given users are removed from all the given datasets (or from all
+    datasets of the given organization).
+
+    Users are authorized once for each of the given datasets, in the same way
+    as in ``dataset_collaborator_delete``, and when ``owner_org`` is provided
+    they must be allowed to manage the members of the organization. If they
+    are not authorized on any of them no collaborator is removed.
+
+    :param user_ids: the ids or names of the users to remove
+    :type user_ids: list of strings
+    :param ids: (optional) the ids or names of the datasets to remove the
+        users from. Either this or ``owner_org`` must be provided
+    :type ids: list of strings
+    :param owner_org: (optional) the id or name of an organization, to remove
+        the users from all its datasets
+    :type owner_org: string
+    :param send_mail: (optional) send a notification email to each of the
+        collaborators removed (default: True)
+    :type send_mail: bool
+
+    :returns: the collaborators removed
+    :rtype: list of dictionaries
+
+    '''
+    model = context.get('model', core_model)
+
+    user_keys = _as_list(toolkit.get_or_bust(data_dict, 'user_ids'))
+    dataset_keys = _as_list(data_dict.get('ids'))
+    owner_org = data_dict.get('owner_org')
+    if not dataset_keys and not owner_org:
+        raise toolkit.ValidationError(
+            {'ids': ['Either ids or owner_org must be provided']})
+
+    org = None
+    if owner_org:
+        org = model.Group.get(owner_org)
+        if not org or not org.is_organization:
+            raise toolkit.ObjectNotFound('Organization not found')
+
+    # Everything is authorized before looking at the existing collaborators,
+    # so the result does not reveal who collaborates on what
+    toolkit.check_access('dataset_collaborator_delete_many', context,
+                         dict(data_dict, owner_org=org.id if org else None))
+
+    ids = list(set(_resolve_ids(model, model.Package, dataset_keys).values()))
+    for dataset_id in ids:
+        toolkit.check_access('dataset_collaborator_delete', context,
+                             {'id': dataset_id})
+
+    user_ids = list(set(_resolve_ids(model, model.User, user_keys).values()))
+    if not user_ids or (dataset_keys and not ids):
+        return []
+
+    # A single statement removes the collaborators and returns them, so the
+    # affected datasets don't need to be looked up first
+    table = DatasetMember.__table__
+    q = table.delete().where(table.c.user_id.in_(user_ids))
+    if ids:
+        q = q.where(table.c.dataset_id.in_(ids))
+    if org:
+        q = q.where(table.c.dataset_id.in_(
+            select([model.Package.id]).where(
+                model.Package.owner_org == org.id)))
+
+    deleted = [member_as_dict(row) for row in model.Session.execute(
+        q.returning(*table.c))]
+    if not deleted:
+        return []
+
+    dataset_ids = list(set(member['dataset_id'] for member in deleted))
+    if data_dict.get('send_mail', True):
+        add_to_outbox(deleted, event='delete')
+    model.repo.commit()
+    _memberships_changed([member['user_id'] for member in deleted],
+                         dataset_ids)
+
+    log.info('{} collaborators removed from {} datasets'.format(
+        len(deleted), len(dataset_ids)))
+
+    if data_dict.get('send_mail', True):
+        notify_collaborators(deleted, event='delete')
+
+    return deleted
+
+
+def _encode_cursor(member):
+    return base64.urlsafe_b64encode(
+        json.dumps([member.modified.isoformat(), member.id]))
+
+
+def _decode_cursor(cursor):
+    try:
+        modified, member_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        try:
+            modified = datetime.datetime.strptime(
+                modified, '%Y-%m-%dT%H:%M:%S.%f')
+        except ValueError:
+            modified = datetime.datetime.strptime(
+                modified, '%Y-%m-%dT%H:%M:%S')
+        return modified, member_id
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({'cursor': ['Invalid cursor']})
+
+
+def _paginate(q, data_dict):
+    '''Sort a DatasetMember query and apply the keyset pagination params
+
+    Memberships are sorted by last modified date and id. If a ``limit`` is
+    provided only that number of rows after the ``cursor`` (if any) are
+    returned, along with the cursor to get the next page (None on the last
+    one).
+
+    Returns a (rows, next_cursor) tuple.
+    '''
+    q = q.order_by(DatasetMember.modified, DatasetMember.id)
+
+    if data_dict.get('cursor'):
+        q = q.filter(tuple_(DatasetMember.modified, DatasetMember.id) >
+                     tuple_(*_decode_cursor(data_dict['cursor'])))
+
+    limit = data_dict.get('limit')
+    if limit is None or limit == '':
+        return q.all(), None
+
+    max_limit = int(toolkit.config.get(
+        'ckanext.collaborators.list_max_limit', DEFAULT_MAX_LIMIT))
+    try:
+        limit = int(limit)
+        if not 0 < limit <= max_limit:
+            raise ValueError
+    except ValueError:
+        raise toolkit.ValidationError(
+            {'limit': ['Must be an integer between 1 and {}'.format(
+                max_limit)]})
+
+    rows = q.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    # Queries with extra columns return tuples, with the member first
+    last = rows[-1][0] if isinstance(rows[-1], tuple) else rows[-1]
+    return rows, _encode_cursor(last)
+
+
+def _paginated(results, data_dict, next_cursor):
+    if data_dict.get('limit') is None or data_dict.get('limit') == '':
+        return results
+    return {'results': results, 'next_cursor': next_cursor}
 
 
 def dataset_collaborator_list(context, data_dict):
@@ -124,10 +487,23 @@ def dataset_collaborator_list(context, data_dict):
     :param capacity: (optional) If provided, only users with this capacity are
         returned
     :type capacity: string
+    :param limit: (optional) If provided, only this number of collaborators
+        are returned, along with a cursor to get the next ones
+    :type limit: int
+    :param cursor: (optional) the ``next_cursor`` value returned by a previous
+        call, to get the following collaborators
+    :type cursor: string
+    :param include_user: (optional) include the ``user_name``,
+        ``user_display_name``, ``user_state`` and ``user_email_hash`` of each
+        collaborator, fetched in the same query (default: False)
+    :type include_user: bool
 
     :returns: a list of collaborators, each a dict including the dataset and
-        user id, the capacity and the last modified date
-    :rtype: list of dictionaries
+        user id, the capacity and the last modified date, sorted by the last
+        modified date. If ``limit`` is provided, a dict with the list of
+        collaborators in ``results`` and the cursor to get the next ones in
+        ``next_cursor`` (None if there are no more)
+    :rtype: list of dictionaries or dictionary
 
     '''
     model = context.get('model', core_model)
@@ -145,15 +521,38 @@ def dataset_collaborator_list(context, data_dict):
         raise toolkit.ValidationError(
             'Capacity must be one of "{}"'.format(', '.join(
                 ALLOWED_CAPACITIES)))
-    q = model.Session.query(DatasetMember).\
-        filter(DatasetMember.dataset_id == dataset.id)
+    include_user = toolkit.asbool(data_dict.get('include_user', False))
+    if include_user:
+        q = model.Session.query(
+            DatasetMember, model.User.name, model.User.fullname,
+            model.User.state, model.User.email).\
+            outerjoin(model.User, model.User.id == DatasetMember.user_id)
+    else:
+        q = model.Session.query(DatasetMember)
+    q = q.filter(DatasetMember.dataset_id == dataset.id)
 
     if capacity:
         q = q.filter(DatasetMember.capacity == capacity)
 
-    members = q.all()
+    rows, next_cursor = _paginate(q, data_dict)
 
-    return [member.as_dict() for member in members]
+    if not include_user:
+        return _paginated(
+            [member.as_dict() for member in rows], data_dict, next_cursor)
+
+    out = []
+    for member, name, fullname, state, email in rows:
+        member_dict = member.as_dict()
+        member_dict.update({
+            'user_name': name,
+            'user_display_name': fullname or name,
+            'user_state': state,
+            'user_email_hash': hashlib.md5(
+                (email or '').strip().lower().encode('utf8')).hexdigest(),
+        })
+        out.append(member_dict)
+
+    return _paginated(out, data_dict, next_cursor)
 
 
 def dataset_collaborator_list_for_user(context, data_dict):
@@ -164,10 +563,30 @@ def dataset_collaborator_list_for_user(context, data_dict):
     :param capacity: (optional) If provided, only datasets where the user has this
         capacity are returned
     :type capacity: string
+    :param limit: (optional) If provided, only this number of datasets are
+        returned, along with a cursor to get the next ones
+    :type limit: int
+    :param cursor: (optional) the ``next_cursor`` value returned by a previous
+        call, to get the following datasets
+    :type cursor: string
+    :param include_dataset: (optional) include the ``dataset_name``,
+        ``dataset_title``, ``dataset_state``, ``dataset_owner_org`` and
+        ``dataset_metadata_modified`` of each dataset, fetched in the same
+        query (default: False)
+    :type include_dataset: bool
+    :param dataset_state: (optional) If provided, only datasets in this state
+        (or states) are returned, eg ``active``
+    :type dataset_state: string or list of strings
+    :param owner_org: (optional) If provided, only datasets of this
+        organization (id or name) are returned
+    :type owner_org: string
 
     :returns: a list of datasets, each a dict including the dataset id, the
-        capacity and the last modified date
-    :rtype: list of dictionaries
+        capacity and the last modified date, sorted by the last modified date.
+        If ``limit`` is provided, a dict with the list of datasets in
+        ``results`` and the cursor to get the next ones in ``next_cursor``
+        (None if there are no more)
+    :rtype: list of dictionaries or dictionary
 
     '''
     model = context.get('model', core_model)
@@ -185,25 +604,201 @@ def dataset_collaborator_list_for_user(context, data_dict):
         raise toolkit.ValidationError(
             'Capacity must be one of "{}"'.format(', '.join(
                 ALLOWED_CAPACITIES)))
-    q = model.Session.query(DatasetMember).\
-        filter(DatasetMember.user_id == user.id)
+    include_dataset = toolkit.asbool(data_dict.get('include_dataset', False))
+    dataset_states = _as_list(data_dict.get('dataset_state'))
+    owner_org = data_dict.get('owner_org')
+
+    if include_dataset:
+        q = model.Session.query(
+            DatasetMember, model.Package.name, model.Package.title,
+            model.Package.state, model.Package.owner_org,
+            model.Package.metadata_modified)
+    else:
+        q = model.Session.query(DatasetMember)
+    q = q.filter(DatasetMember.user_id == user.id)
+
+    if dataset_states or owner_org:
+        q = q.join(model.Package, model.Package.id == DatasetMember.dataset_id)
+    elif include_dataset:
+        q = q.outerjoin(
+            model.Package, model.Package.id == DatasetMember.dataset_id)
+
+    if dataset_states:
+        q = q.filter(model.Package.state.in_(dataset_states))
+
+    if owner_org:
+        org = model.Group.get(owner_org)
+        if not org or not org.is_organization:
+            raise toolkit.ObjectNotFound('Organization not found')
+        q = q.filter(model.Package.owner_org == org.id)
 
     if capacity:
         q = q.filter(DatasetMember.capacity == capacity)
 
-    members = q.all()
+    rows, next_cursor = _paginate(q, data_dict)
 
     out = []
-    for member in members:
-        out.append({
+    for row in rows:
+        member = row[0] if include_dataset else row
+        member_dict = {
             'dataset_id': member.dataset_id,
             'capacity': member.capacity,
             'modified': member.modified.isoformat(),
-        })
+        }
+        if include_dataset:
+            name, title, state, org_id, metadata_modified = row[1:]
+            member_dict.update({
+                'dataset_name': name,
+                'dataset_title': title,
+                'dataset_state': state,
+                'dataset_owner_org': org_id,
+                'dataset_metadata_modified': (
+                    metadata_modified.isoformat() if metadata_modified
+                    else None),
+            })
+        out.append(member_dict)
+
+    return _paginated(out, data_dict, next_cursor)
+
+
+def _empty_count():
+    return {
+        'count': 0,
+        'capacities': dict((capacity, 0) for capacity in ALLOWED_CAPACITIES),
+    }
+
+
+def dataset_collaborator_count(context, data_dict):
+    '''Return the number of collaborators of one or more datasets, or the
+    number of datasets a user is a collaborator in.
+
+    One (and only one) of ``id``, ``ids`` or ``user_id`` must be provided.
+    Counting the collaborators of a dataset requires the same permissions as
+    ``dataset_collaborator_list``, and counting the datasets of a user the
+    same as ``dataset_collaborator_list_for_user``.
+
+    :param id: (optional) the id or name of a dataset
+    :type id: string
+    :param ids: (optional) the ids or names of several datasets
+    :type ids: list of strings
+    :param user_id: (optional) the id or name of a user
+    :type user_id: string
+
+    :returns: a dict with the total ``count`` and the count for each capacity
+        in ``capacities``. If ``ids`` is provided, a dict with one of these for
+        each dataset, keyed by dataset id
+    :rtype: dictionary
+
+    '''
+    model = context.get('model', core_model)
 
+    keys = [key for key in ('id', 'ids', 'user_id') if data_dict.get(key)]
+    if len(keys) != 1:
+        raise toolkit.ValidationError(
+            'One of "id", "ids" or "user_id" must be provided')
+
+    toolkit.check_access('dataset_collaborator_count', context, data_dict)
+
+    if 'user_id' in keys:
+        user = model.User.get(data_dict['user_id'])
+        if not user:
+            raise toolkit.ObjectNotFound('User not found')
+
+        toolkit.check_access('dataset_collaborator_list_for_user', context,
+                             {'id': data_dict['user_id']})
+
+        q = model.Session.query(DatasetMember.capacity, func.count()).filter(
+            DatasetMember.user_id == user.id).group_by(DatasetMember.capacity)
+
+        out = _empty_count()
+        for capacity, count in q:
+            out['capacities'][capacity] = count
+            out['count'] += count
+        return out
+
+    dataset_keys = _as_list(data_dict.get('ids') or data_dict.get('id'))
+    dataset_ids = _resolve_ids(model, model.Package, dataset_keys)
+    for key in dataset_keys:
+        if key not in dataset_ids:
+            raise toolkit.ObjectNotFound('Dataset not found: {}'.format(key))
+
+    ids = list(set(dataset_ids[key] for key in dataset_keys))
+    for dataset_id in ids:
+        toolkit.check_access('dataset_collaborator_list', context,
+                             {'id': dataset_id})
+
+    q = model.Session.query(
+        DatasetMember.dataset_id, DatasetMember.capacity, func.count()).\
+        filter(DatasetMember.dataset_id.in_(ids)).\
+        group_by(DatasetMember.dataset_id, DatasetMember.capacity)
+
+    out = dict((dataset_id, _empty_count()) for dataset_id in ids)
+    for dataset_id, capacity, count in q:
+        out[dataset_id]['capacities'][capacity] = count
+        out[dataset_id]['count'] += count
+
+    if 'id' in keys:
+        return out[ids[0]]
     return out
 
 
+def collaborators_stats(context, data_dict):
+    '''Return the metrics recorded in this process for each of the actions,
+    auth functions and permission label hooks of the extension.
+
+    Only available to sysadmins, and only if the ``memory`` sink is enabled
+    in ``ckanext.collaborators.metrics.sinks``. Metrics are kept separately
+    by each server process.
+
+    :param reset: (optional) clear the metrics after returning them
+    :type reset: bool
+
+    :returns: the metrics keyed by ``<kind>.<name>`` (eg
+        ``action.dataset_collaborator_list``), each a dict with the number of
+        ``calls`` and ``errors``, ``total_ms`` and ``max_ms`` latencies, total
+        ``queries`` and ``rows`` returned and a latency ``histogram``
+    :rtype: dictionary
+
+    '''
+    toolkit.check_access('collaborators_stats', context, data_dict)
+
+    sink = get_memory_sink()
+    if not sink:
+        raise toolkit.ValidationError(
+            {'sinks': ['The memory metrics sink is not enabled']})
+
+    stats = sink.snapshot()
+    if toolkit.asbool(data_dict.get('reset', False)):
+        sink.reset()
+    return stats
+
+
+def _delete_members(model, condition):
+    '''Delete all the collaborators matching `condition` in bulk
+
+    Rows are deleted in chunks of ``ckanext.collaborators.delete_batch_size``
+    (default 10000), committing after each one so large deletions don't hold
+    long transactions. Returns the sets of affected user and dataset ids.
+    '''
+    batch_size = int(toolkit.config.get(
+        'ckanext.collaborators.delete_batch_size', 10000))
+    table = DatasetMember.__table__
+    user_ids = set()
+    dataset_ids = set()
+    while True:
+        chunk = select([table.c.id]).where(condition).limit(batch_size)
+        rows = model.Session.execute(
+            table.delete().where(table.c.id.in_(chunk)).returning(
+                table.c.user_id, table.c.dataset_id)).fetchall()
+        model.Session.commit()
+        for user_id, dataset_id in rows:
+            user_ids.add(user_id)
+            dataset_ids.add(dataset_id)
+        if len(rows) < batch_size:
+            break
+    return user_ids, dataset_ids
+
+
 @toolkit.chained_action
 def collaborators_package_delete(up_func, context, data_dict):
     '''
@@ -211,28 +806,70 @@ def collaborators_package_delete(up_func, context, data_dict):
     '''
     model = context.get('model', core_model)
     up_func(context, data_dict)
-    id = data_dict['id']
-    dataset_collaborators = model.Session.query(DatasetMember).filter(
-        DatasetMember.dataset_id == id).all()
-    for collaborator in dataset_collaborators:
-        model.Session.delete(collaborator)
+    dataset = model.Package.get(data_dict['id'])
+    id = dataset.id if dataset else data_dict['id']
 
-    model.Session.commit()
+    user_ids, dataset_ids = _delete_members(
+        model, DatasetMember.__table__.c.dataset_id == id)
+    _memberships_changed(user_ids, dataset_ids)
 
 
 @toolkit.chained_action
-def collaborators_user_delete(up_func, context, data_dict):
+def collaborators_dataset_purge(up_func, context, data_dict):
     '''
     Remove collaborators record from table after calling the core action
     '''
+    model = context.get('model', core_model)
+    dataset = model.Package.get(data_dict['id'])
+    id = dataset.id if dataset else data_dict['id']
+
+    if foreign_keys_exist(model.Session.connection()):
+        # The database removes the collaborators with the dataset, we only
+        # need to know who they were
+        user_ids = [user_id for user_id, in model.Session.query(
+            DatasetMember.user_id).filter(DatasetMember.dataset_id == id)]
+        up_func(context, data_dict)
+    else:
+        up_func(context, data_dict)
+        user_ids, dataset_ids = _delete_members(
+            model, DatasetMember.__table__.c.dataset_id == id)
+    # The dataset is no longer indexed, so only the caches need updating
+    _memberships_changed(user_ids, [])
+
 
+@toolkit.chained_action
+def collaborators_bulk_update_delete(up_func, context, data_dict):
+    '''
+    Remove collaborators record from table after calling the core action
+    '''
     model = context.get('model', core_model)
     up_func(context, data_dict)
-    user_id = data_dict['id']
+    ids = _as_list(data_dict.get('datasets'))
+    if not ids:
+        return
+
+    # Only the datasets the core action deleted, ie those of the organization
+    # the user was authorized on
+    deleted = select([model.Package.id]).where(
+        model.Package.id.in_(ids)).where(
+        model.Package.owner_org == data_dict.get('org_id')).where(
+        model.Package.state == 'deleted')
+    user_ids, dataset_ids = _delete_members(
+        model, DatasetMember.__table__.c.dataset_id.in_(deleted))
+    _memberships_changed(user_ids, dataset_ids)
 
-    datasets_where_user_is_collaborator = model.Session.query(DatasetMember).filter(
-        DatasetMember.user_id == user_id).all()
-    for collaborator in datasets_where_user_is_collaborator:
-        model.Session.delete(collaborator)
 
-    model.Session.commit()
+@toolkit.chained_action
+def collaborators_user_delete(up_func, context, data_dict):
+    '''
+    Remove collaborators record from table after calling the core action
+    '''
+
+    model = context.get('model', core_model)
+    up_func(context, data_dict)
+    user = model.User.get(data_dict['id'])
+    user_id = user.id if user else data_dict['id']
+
+    user_ids, dataset_ids = _delete_members(
+        model, DatasetMember.__table__.c.user_id == user_id)
+    _memberships_changed([user_id], dataset_ids)
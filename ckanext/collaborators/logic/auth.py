@@ -1,22 +1,55 @@
+from sqlalchemy import or_, exists
+
+from ckan import model as core_model
 from ckan.plugins import toolkit
 
 from ckan.logic.auth import get_package_object
 from ckan.authz import has_user_permission_for_group_or_org
 from ckan.logic.auth.update import package_update as core_package_update
 
+from ckanext.collaborators.cache import request_cache
+from ckanext.collaborators.model import DatasetMember
+
+
+def _get_owner_org(context, dataset_id):
+    '''Return the owner org of a dataset (by id or name), memoized for the
+    rest of the request'''
+    package = context.get('package')
+    if package and dataset_id in (package.id, package.name):
+        return package.owner_org
+
+    cache = request_cache('owner_org')
+    if dataset_id in cache:
+        return cache[dataset_id]
+
+    model = context.get('model', core_model)
+    dataset = model.Session.query(
+        model.Package.id, model.Package.name, model.Package.owner_org).\
+        filter(or_(model.Package.id == dataset_id,
+                   model.Package.name == dataset_id)).first()
+    if not dataset:
+        raise toolkit.ObjectNotFound('Dataset not found')
+
+    cache[dataset.id] = cache[dataset.name] = dataset.owner_org
+    return dataset.owner_org
+
+
+def _can_manage_collaborators(owner_org, user):
+    cache = request_cache('org_membership_permission')
+    if (owner_org, user) not in cache:
+        cache[(owner_org, user)] = has_user_permission_for_group_or_org(
+            owner_org, user, 'membership')
+    return cache[(owner_org, user)]
+
 
 def _auth_collaborator(context, data_dict, message):
     user = context['user']
 
-    dataset = toolkit.get_action('package_show')(
-        {'ignore_auth': True}, {'id': data_dict['id']})
-
-    owner_org = dataset.get('owner_org')
+    owner_org = _get_owner_org(context, data_dict['id'])
     if not owner_org:
         return {'success': False}
 
-    if not has_user_permission_for_group_or_org(
-            owner_org, user, 'membership'):
+    if not _can_manage_collaborators(owner_org, user):
         return {
             'success': False,
             'msg': toolkit._(message) % user}
@@ -34,6 +67,15 @@ def dataset_collaborator_create(context, data_dict):
         'User %s not authorized to add members to this dataset')
 
 
+def dataset_collaborator_create_many(context, data_dict):
+    '''Checks if a user is allowed to add collaborators in bulk
+
+    Any logged in user can call the action, as permissions are checked for
+    each of the datasets involved using ``dataset_collaborator_create``.
+    '''
+    return {'success': bool(context.get('user'))}
+
+
 def dataset_collaborator_delete(context, data_dict):
     '''Checks if a user is allowed to delete collaborators from a dataset
 
@@ -44,6 +86,29 @@ def dataset_collaborator_delete(context, data_dict):
         'User %s not authorized to remove members from this dataset')
 
 
+def dataset_collaborator_delete_many(context, data_dict):
+    '''Checks if a user is allowed to remove collaborators in bulk
+
+    Any logged in user can call the action with a list of datasets, as
+    permissions are checked for each of them using
+    ``dataset_collaborator_delete``. Removing collaborators from all the
+    datasets of an organization is restricted to its Administrators.
+    '''
+    user = context.get('user')
+    if not user:
+        return {'success': False}
+
+    owner_org = data_dict.get('owner_org')
+    if owner_org and not _can_manage_collaborators(owner_org, user):
+        return {
+            'success': False,
+            'msg': toolkit._(
+                'User %s not authorized to remove members from the datasets '
+                'of this organization') % user}
+
+    return {'success': True}
+
+
 def dataset_collaborator_list(context, data_dict):
     '''Checks if a user is allowed to list collaborators from a dataset
 
@@ -54,6 +119,16 @@ def dataset_collaborator_list(context, data_dict):
         'User %s not authorized to list members from this dataset')
 
 
+def dataset_collaborator_count(context, data_dict):
+    '''Checks if a user is allowed to count collaborators
+
+    Any logged in user can call the action, as permissions are checked for
+    each of the datasets (or the user) involved using
+    ``dataset_collaborator_list`` (or ``dataset_collaborator_list_for_user``).
+    '''
+    return {'success': bool(context.get('user'))}
+
+
 def dataset_collaborator_list_for_user(context, data_dict):
     '''Checks if a user is allowed to list all datasets a user is a collaborator in
 
@@ -65,6 +140,32 @@ def dataset_collaborator_list_for_user(context, data_dict):
     return {'success': False}
 
 
+def collaborators_stats(context, data_dict):
+    '''Only sysadmins can read the metrics of the extension'''
+    return {'success': False}
+
+
+def _is_editor(context, dataset_id, user_name):
+    '''Check if the user is an editor collaborator of the dataset, memoized
+    for the rest of the request (the collaborator actions reset it)'''
+    cache = request_cache('editor')
+    if (dataset_id, user_name) in cache:
+        return cache[(dataset_id, user_name)]
+
+    model = context.get('model', core_model)
+    user_obj = context.get('auth_user_obj')
+    if not user_obj or user_name not in (user_obj.name, user_obj.id):
+        user_obj = model.User.get(user_name) if user_name else None
+
+    is_editor = bool(user_obj) and model.Session.query(exists().where(
+        DatasetMember.dataset_id == dataset_id).where(
+        DatasetMember.user_id == user_obj.id).where(
+        DatasetMember.capacity == 'editor')).scalar()
+
+    cache[(dataset_id, user_name)] = is_editor
+    return is_editor
+
+
 # Core overrides
 # TODO: remove the direct core import and use the chained_auth_function
 # decorator once #4248 et al are backported into 2.8
@@ -78,8 +179,5 @@ def package_update(context, data_dict):
     user_name = context['user']
     dataset = get_package_object(context, data_dict)
 
-    datasets = toolkit.get_action(
-        'dataset_collaborator_list_for_user')(
-            context, {'id': user_name, 'capacity': 'editor'})
-    return {
-        'success': dataset.id in [d['dataset_id'] for d in datasets]}
+    return {'success': _is_editor(context, dataset.id, user_name)}
+
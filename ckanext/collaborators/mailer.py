@@ -1,10 +1,35 @@
+import time
+import socket
+import smtplib
 import logging
+import datetime
+from collections import OrderedDict
+from email.header import Header
+from email.mime.text import MIMEText
+from email import utils as email_utils
+
+from sqlalchemy import func
+
+import ckan
 from ckan import model as core_model
 from ckan.plugins import toolkit
 from ckan.lib.mailer import mail_user, MailerException
 from ckan.lib.base import render_jinja2
+
+from ckanext.collaborators.model import MailOutbox
 log = logging.getLogger(__name__)
 
+DELIVERY_MODES = ('sync', 'async', 'outbox')
+
+
+def _get_delivery():
+    delivery = toolkit.config.get(
+        'ckanext.collaborators.notifications.delivery', 'sync')
+    if delivery not in DELIVERY_MODES:
+        raise ValueError(
+            'Unknown notifications delivery: {}'.format(delivery))
+    return delivery
+
 
 def _compose_email_subj(dataset):
     return u'{0} - Notification about collaborator role for {1}'.format(
@@ -21,15 +46,409 @@ def _compose_email_body(user, dataset, role, event):
         'dataset_link': dataset_link
     })
 
+def _send_notification(user, dataset, capacity, event):
+    subj = _compose_email_subj(dataset)
+    body = _compose_email_body(user, dataset, capacity, event)
+    mail_user(user, subj, body, headers={
+        'Content-Type': 'text/html; charset=UTF-8'
+    })
+
+
 def mail_notification_to_collaborator(dataset_id, user_id, capacity, event):
     user = core_model.User.get(user_id)
     dataset = core_model.Package.get(dataset_id)
 
     try:
-        subj = _compose_email_subj(dataset)
-        body = _compose_email_body(user, dataset, capacity, event)
-        mail_user(user, subj, body, headers={
-            'Content-Type': 'text/html; charset=UTF-8'
-        })
+        _send_notification(user, dataset, capacity, event)
     except MailerException as exception:
         log.exception(exception)
+
+
+def mail_notifications_to_collaborators(notifications, event):
+    '''Send a notification for each of the given memberships
+
+    :param notifications: dicts with the `dataset_id`, `user_id` and
+        `capacity` of each membership
+    :param event: `create` or `delete`
+
+    Users and datasets are loaded with one query each.
+
+    Returns the notifications that could not be sent.
+    '''
+    if not notifications:
+        return []
+
+    users = dict((user.id, user) for user in core_model.Session.query(
+        core_model.User).filter(core_model.User.id.in_(
+            set(n['user_id'] for n in notifications))))
+    datasets = dict((dataset.id, dataset) for dataset in core_model.Session.query(
+        core_model.Package).filter(core_model.Package.id.in_(
+            set(n['dataset_id'] for n in notifications))))
+
+    failed = []
+    for notification in notifications:
+        user = users.get(notification['user_id'])
+        dataset = datasets.get(notification['dataset_id'])
+        if not user or not dataset:
+            continue
+        try:
+            _send_notification(user, dataset, notification['capacity'], event)
+        except MailerException as exception:
+            log.exception(exception)
+            failed.append(notification)
+
+    return failed
+
+
+def _enqueue_notifications(notifications, event, attempt=0):
+    toolkit.enqueue_job(
+        send_notifications_job, [notifications, event, attempt],
+        title='Notify {} dataset collaborators ({}){}'.format(
+            len(notifications), event,
+            ' (retry {})'.format(attempt) if attempt else ''),
+        queue=toolkit.config.get(
+            'ckanext.collaborators.notifications.queue', 'default'))
+
+
+def send_notifications_job(notifications, event, attempt=0):
+    '''Background job that sends notifications to collaborators
+
+    Notifications that fail are sent again by a new job, added to the end of
+    the queue so the worker is not held up in the meantime, up to
+    ``ckanext.collaborators.notifications.retries`` times.
+    '''
+    retries = int(toolkit.config.get(
+        'ckanext.collaborators.notifications.retries', 3))
+
+    failed = mail_notifications_to_collaborators(notifications, event)
+    if not failed:
+        return
+
+    if attempt < retries:
+        log.info('Retrying {} notifications (attempt {} of {})'.format(
+            len(failed), attempt + 1, retries))
+        _enqueue_notifications(failed, event, attempt + 1)
+    else:
+        log.error('Could not send {} notifications to collaborators'.format(
+            len(failed)))
+
+
+def _notifications(notifications):
+    return [{
+        'dataset_id': n['dataset_id'],
+        'user_id': n['user_id'],
+        'capacity': n['capacity'],
+    } for n in notifications]
+
+
+def notify_collaborators(notifications, event):
+    '''Notify collaborators that they have been added to (or removed from)
+    datasets, once the change has been committed
+
+    Depending on ``ckanext.collaborators.notifications.delivery`` the emails
+    are sent straight away (``sync``, the default) or by a background job
+    (``async``). With ``outbox`` this does nothing, as notifications are
+    added to the outbox by ``add_to_outbox`` before the change is committed.
+
+    :param notifications: dicts with the `dataset_id`, `user_id` and
+        `capacity` of each membership
+    :param event: `create` or `delete`
+    '''
+    notifications = _notifications(notifications)
+    if not notifications:
+        return
+
+    delivery = _get_delivery()
+    if delivery == 'async':
+        _enqueue_notifications(notifications, event)
+    elif delivery == 'sync':
+        mail_notifications_to_collaborators(notifications, event)
+
+
+def add_to_outbox(notifications, event):
+    '''Add notifications to the outbox if the ``outbox`` delivery is enabled
+
+    The rows are added to the current session, so they are only stored if the
+    membership change they notify about is committed.
+    '''
+    if _get_delivery() != 'outbox':
+        return
+
+    for notification in _notifications(notifications):
+        core_model.Session.add(MailOutbox(event=event, **notification))
+
+
+class SMTPConnection(object):
+    '''SMTP connection that can be reused to send many emails
+
+    Follows the same config options as ``ckan.lib.mailer``, but instead of
+    connecting for every email the connection is opened once, when the first
+    email is sent (or ``open`` is called), eg::
+
+        with SMTPConnection() as smtp:
+            for user, subject, body in emails:
+                smtp.send(user, subject, body)
+
+    '''
+
+    def __init__(self):
+        config = toolkit.config
+        self.mail_from = config.get('smtp.mail_from')
+        self.reply_to = config.get('smtp.reply_to')
+        if 'smtp.test_server' in config:
+            self.server = config['smtp.test_server']
+            self.starttls = False
+            self.user = self.password = None
+        else:
+            self.server = config.get('smtp.server', 'localhost')
+            self.starttls = toolkit.asbool(config.get('smtp.starttls'))
+            self.user = config.get('smtp.user')
+            self.password = config.get('smtp.password')
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        connection = smtplib.SMTP()
+        try:
+            connection.connect(self.server)
+            connection.ehlo()
+            if self.starttls:
+                if not connection.has_extn('STARTTLS'):
+                    raise MailerException(
+                        'SMTP server does not support STARTTLS')
+                connection.starttls()
+                connection.ehlo()
+            if self.user:
+                connection.login(self.user, self.password)
+        except (socket.error, smtplib.SMTPException) as e:
+            raise MailerException('SMTP connection failed: {}'.format(e))
+        self.connection = connection
+
+    def close(self):
+        if self.connection:
+            try:
+                self.connection.quit()
+            except (socket.error, smtplib.SMTPException):
+                pass
+            self.connection = None
+
+    def send(self, user, subject, body):
+        if not user.email:
+            raise MailerException('User {} has no email'.format(user.name))
+        if not self.connection:
+            self.open()
+
+        msg = MIMEText(body.encode('utf-8'), 'html', 'utf-8')
+        msg['Subject'] = Header(subject.encode('utf-8'), 'utf-8')
+        msg['From'] = u'{} <{}>'.format(
+            toolkit.config.get('ckan.site_title'), self.mail_from)
+        msg['To'] = Header(u'{} <{}>'.format(
+            user.display_name, user.email), 'utf-8')
+        msg['Date'] = email_utils.formatdate(time.time())
+        msg['X-Mailer'] = 'CKAN {}'.format(ckan.__version__)
+        if self.reply_to:
+            msg['Reply-to'] = self.reply_to
+
+        try:
+            try:
+                self.connection.sendmail(
+                    self.mail_from, [user.email], msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                # The server may close idle connections, reconnect once
+                self.open()
+                self.connection.sendmail(
+                    self.mail_from, [user.email], msg.as_string())
+        except smtplib.SMTPRecipientsRefused:
+            raise MailerException(
+                'Recipient refused: {}'.format(user.email))
+        except (socket.error, smtplib.SMTPServerDisconnected) as e:
+            # Don't reuse a broken connection for the following emails
+            self.close()
+            raise MailerException('SMTP connection failed: {}'.format(e))
+        except smtplib.SMTPException as e:
+            raise MailerException('Could not send email to {}: {}'.format(
+                user.email, e))
+
+
+def _pending_outbox(max_attempts, started):
+    '''Query for the outbox rows still to be sent in this run'''
+    return core_model.Session.query(MailOutbox).\
+        filter(MailOutbox.sent.is_(None)).\
+        filter(MailOutbox.attempts < max_attempts).\
+        filter(MailOutbox.created < started).\
+        filter((MailOutbox.last_attempt.is_(None)) |
+               (MailOutbox.last_attempt < started))
+
+
+def _lock_digest_rows(q, batch_size, window):
+    '''Lock all the pending rows of up to `batch_size` users whose oldest
+    pending notification is older than `window` seconds'''
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=window)
+    user_ids = q.with_entities(MailOutbox.user_id).\
+        group_by(MailOutbox.user_id).\
+        having(func.min(MailOutbox.created) < cutoff).\
+        limit(batch_size).all()
+    if not user_ids:
+        return []
+    return q.filter(MailOutbox.user_id.in_([u for u, in user_ids])).\
+        order_by(MailOutbox.created).\
+        with_for_update(skip_locked=True).all()
+
+
+def _compose_digest_subj():
+    return u'{0} - Summary of changes to your collaborator roles'.format(
+        toolkit.config.get('ckan.site_title'))
+
+
+def _compose_digest_body(user, rows, datasets):
+    return render_jinja2('collaborators/emails/digest.html', {
+        'user_name': user.fullname or user.name,
+        'site_title': toolkit.config.get('ckan.site_title'),
+        'site_url': toolkit.config.get('ckan.site_url'),
+        'events': [{
+            'event': row.event,
+            'role': row.capacity,
+            'dataset_title': datasets[row.dataset_id].title,
+            'dataset_link': toolkit.url_for(
+                'dataset_read', id=row.dataset_id, qualified=True),
+        } for row in rows],
+    })
+
+
+def prune_outbox(max_attempts, retention):
+    '''Delete the notifications that were given up on more than `retention`
+    days ago (and any sent ones left by previous versions)'''
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention)
+    pruned = core_model.Session.query(MailOutbox).filter(
+        (MailOutbox.sent.isnot(None)) |
+        ((MailOutbox.attempts >= max_attempts) &
+         (MailOutbox.last_attempt < cutoff))).delete(
+            synchronize_session=False)
+    core_model.Session.commit()
+    if pruned:
+        log.info('{} notifications removed from the outbox'.format(pruned))
+    return pruned
+
+
+def send_outbox(batch_size=100):
+    '''Send the notifications waiting in the outbox
+
+    Pending notifications are locked and sent in batches over a single SMTP
+    connection, and removed from the outbox once sent, in one commit per
+    batch. Several processes can run this at the same time, as locked rows
+    are skipped. Each notification is tried at most once per run, and given
+    up on after ``ckanext.collaborators.notifications.retries`` failed
+    attempts. Notifications given up on are kept for
+    ``ckanext.collaborators.notifications.retention`` days (default 30), so
+    they can be looked into, and then removed.
+
+    If ``ckanext.collaborators.notifications.digest_window`` is set, the
+    notifications of each user are held until the oldest one is that number
+    of seconds old, and then all of them are sent in a single summary email
+    (batches are then of `batch_size` users).
+
+    Returns a (sent, failed) tuple with the number of notifications.
+    '''
+    session = core_model.Session
+    max_attempts = int(toolkit.config.get(
+        'ckanext.collaborators.notifications.retries', 3)) + 1
+    digest_window = int(toolkit.config.get(
+        'ckanext.collaborators.notifications.digest_window', 0))
+    retention = int(toolkit.config.get(
+        'ckanext.collaborators.notifications.retention', 30))
+    started = datetime.datetime.utcnow()
+    sent = failed = 0
+
+    prune_outbox(max_attempts, retention)
+
+    with SMTPConnection() as smtp:
+        while True:
+            q = _pending_outbox(max_attempts, started)
+            if digest_window:
+                rows = _lock_digest_rows(q, batch_size, digest_window)
+            else:
+                rows = q.order_by(MailOutbox.created).limit(batch_size).\
+                    with_for_update(skip_locked=True).all()
+            if not rows:
+                break
+
+            # Connect once there is something to send. If the server can't
+            # be reached the run stops, without counting it as an attempt
+            if not smtp.connection:
+                try:
+                    smtp.open()
+                except MailerException:
+                    session.rollback()
+                    raise
+
+            users = dict((user.id, user) for user in session.query(
+                core_model.User).filter(core_model.User.id.in_(
+                    set(row.user_id for row in rows))))
+            datasets = dict((dataset.id, dataset) for dataset in session.query(
+                core_model.Package).filter(core_model.Package.id.in_(
+                    set(row.dataset_id for row in rows))))
+
+            if digest_window:
+                groups = OrderedDict()
+                for row in rows:
+                    groups.setdefault(row.user_id, []).append(row)
+                groups = groups.values()
+            else:
+                groups = [[row] for row in rows]
+
+            now = datetime.datetime.utcnow()
+            for group in groups:
+                user = users.get(group[0].user_id)
+                for row in group:
+                    row.attempts += 1
+                    row.last_attempt = now
+
+                # Users or datasets purged since the notifications were
+                # queued. These can never be sent, but don't hold back the
+                # rest of a digest
+                missing = [row for row in group
+                           if not user or row.dataset_id not in datasets]
+                if missing:
+                    log.warning('Dropping notifications {}: user or dataset '
+                                'not found'.format(
+                                    ', '.join(row.id for row in missing)))
+                    for row in missing:
+                        row.attempts = max_attempts
+                        row.last_error = u'User or dataset not found'
+                    failed += len(missing)
+                    group = [row for row in group if row not in missing]
+                    if not group:
+                        continue
+
+                try:
+                    if len(group) == 1:
+                        row = group[0]
+                        dataset = datasets[row.dataset_id]
+                        smtp.send(user,
+                                  _compose_email_subj(dataset),
+                                  _compose_email_body(
+                                      user, dataset, row.capacity, row.event))
+                    else:
+                        smtp.send(user,
+                                  _compose_digest_subj(),
+                                  _compose_digest_body(user, group, datasets))
+                except MailerException as e:
+                    log.warning('Could not send notifications {}: {}'.format(
+                        ', '.join(row.id for row in group), e))
+                    for row in group:
+                        row.last_error = u'{}'.format(e)
+                    failed += len(group)
+                else:
+                    for row in group:
+                        session.delete(row)
+                    sent += len(group)
+
+            session.commit()
+            log.info('{} notifications sent, {} failed'.format(sent, failed))
+
+    return sent, failed
@@ -0,0 +1,264 @@
+# encoding: utf-8
+
+u'''Versioned schema migrations for the dataset collaborators tables
+
+Each migration has an upgrade and a downgrade step. Applied versions are
+recorded in the `dataset_member_migration` table, and the current version is
+the highest one recorded there (0 for installs created before migrations were
+introduced).
+
+Transactional migrations run in a single transaction together with the update
+of the version table. Migrations that can not run inside a transaction (eg
+`CREATE INDEX CONCURRENTLY`) run on an autocommit connection and are written
+so they can safely be re-run if interrupted. In both cases `lock_timeout` is
+set so a migration fails fast instead of queueing behind (and blocking) live
+traffic on the tables.
+
+New migrations must be appended to `MIGRATIONS`, and the model declarations
+must always match the schema of the latest version, as `init-db` creates the
+tables from the model and records them as up to date.
+'''
+
+import logging
+
+from ckan.model import meta
+from ckan.plugins import toolkit
+
+from ckanext.collaborators.model import (
+    MailOutbox, MigrationVersion, FOREIGN_KEYS,
+    create_index, drop_index, remove_duplicate_members,
+    create_foreign_key, validate_foreign_key, drop_foreign_key)
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_LOCK_TIMEOUT = u'10s'
+DEFAULT_BATCH_SIZE = 10000
+
+
+class Migration(object):
+
+    def __init__(self, version, description, upgrade, downgrade,
+                 transactional=True):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.downgrade = downgrade
+        self.transactional = transactional
+
+    def __repr__(self):
+        return u'<Migration {} {}>'.format(self.version, self.description)
+
+
+def run_in_batches(connection, statement, batch_size=None, **params):
+    u'''Run `statement` repeatedly until it does not affect any rows
+
+    Use it in non transactional migrations to backfill or clean up large
+    tables without holding row locks for the whole operation. The statement
+    must limit the rows it affects with the `batch_size` bind parameter, eg::
+
+        UPDATE dataset_member SET ... WHERE id IN (
+            SELECT id FROM dataset_member WHERE ... LIMIT %(batch_size)s)
+
+    Returns the total number of rows affected.
+    '''
+    params[u'batch_size'] = batch_size or int(toolkit.config.get(
+        u'ckanext.collaborators.migrations.batch_size', DEFAULT_BATCH_SIZE))
+    total = 0
+    while True:
+        count = connection.execute(statement, params).rowcount
+        if not count:
+            return total
+        total += count
+        log.info(u'{} rows processed'.format(total))
+
+
+# Migrations
+
+def _upgrade_indexes(connection):
+    removed = remove_duplicate_members(connection)
+    if removed:
+        log.warning(
+            u'Removed {} duplicated dataset collaborators'.format(removed))
+    create_index(connection, u'idx_dataset_member_dataset_id_user_id',
+                 concurrently=True)
+    create_index(connection, u'idx_dataset_member_user_id_capacity',
+                 concurrently=True)
+
+
+def _downgrade_indexes(connection):
+    drop_index(connection, u'idx_dataset_member_user_id_capacity',
+               concurrently=True)
+    drop_index(connection, u'idx_dataset_member_dataset_id_user_id',
+               concurrently=True)
+
+
+def _upgrade_pagination_indexes(connection):
+    create_index(connection, u'idx_dataset_member_dataset_id_modified_id',
+                 concurrently=True)
+    create_index(connection, u'idx_dataset_member_user_id_modified_id',
+                 concurrently=True)
+
+
+def _downgrade_pagination_indexes(connection):
+    drop_index(connection, u'idx_dataset_member_user_id_modified_id',
+               concurrently=True)
+    drop_index(connection, u'idx_dataset_member_dataset_id_modified_id',
+               concurrently=True)
+
+
+def _upgrade_mail_outbox(connection):
+    MailOutbox.__table__.create(bind=connection, checkfirst=True)
+
+
+def _downgrade_mail_outbox(connection):
+    MailOutbox.__table__.drop(bind=connection, checkfirst=True)
+
+
+def _upgrade_foreign_keys(connection):
+    # Adding the constraints as NOT VALID first stops new orphans from
+    # appearing while the existing ones are removed, and validating them
+    # afterwards does not block writes on the table
+    for name in FOREIGN_KEYS:
+        create_foreign_key(connection, name)
+    removed = run_in_batches(connection, u'''
+        DELETE FROM dataset_member
+        WHERE id IN (
+            SELECT m.id FROM dataset_member m
+            WHERE NOT EXISTS (
+                SELECT 1 FROM "user" u WHERE u.id = m.user_id)
+            OR NOT EXISTS (
+                SELECT 1 FROM package p WHERE p.id = m.dataset_id)
+            LIMIT %(batch_size)s
+        )''')
+    if removed:
+        log.warning(u'Removed {} collaborators of missing users or '
+                    u'datasets'.format(removed))
+    for name in FOREIGN_KEYS:
+        validate_foreign_key(connection, name)
+
+
+def _downgrade_foreign_keys(connection):
+    for name in reversed(FOREIGN_KEYS):
+        drop_foreign_key(connection, name)
+
+
+MIGRATIONS = [
+    Migration(1, u'Add dataset and user indexes to dataset_member',
+              _upgrade_indexes, _downgrade_indexes, transactional=False),
+    Migration(2, u'Add pagination indexes to dataset_member',
+              _upgrade_pagination_indexes, _downgrade_pagination_indexes,
+              transactional=False),
+    Migration(3, u'Add the notifications outbox table',
+              _upgrade_mail_outbox, _downgrade_mail_outbox),
+    Migration(4, u'Add foreign keys to the users and datasets of '
+                 u'dataset_member',
+              _upgrade_foreign_keys, _downgrade_foreign_keys,
+              transactional=False),
+]
+
+
+def head():
+    return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+
+def current_version(connection=None):
+    connection = connection or meta.engine
+    if not MigrationVersion.__table__.exists(bind=connection):
+        return 0
+    return connection.execute(
+        u'SELECT max(version) FROM dataset_member_migration').scalar() or 0
+
+
+def stamp(connection, version):
+    u'''Record all migrations up to `version` as applied'''
+    table = MigrationVersion.__table__
+    table.create(bind=connection, checkfirst=True)
+    connection.execute(table.delete())
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            connection.execute(table.insert().values(
+                version=migration.version,
+                description=migration.description))
+
+
+def plan(current, target=None):
+    u'''Return the list of (migration, direction) steps needed to go from the
+    `current` version to `target` (defaults to the latest version)'''
+    target = head() if target is None else target
+    if target not in [0] + [m.version for m in MIGRATIONS]:
+        raise ValueError(u'Unknown migration version: {}'.format(target))
+
+    if target >= current:
+        return [(m, u'upgrade') for m in MIGRATIONS
+                if current < m.version <= target]
+    return [(m, u'downgrade') for m in reversed(MIGRATIONS)
+            if target < m.version <= current]
+
+
+def _set_lock_timeout(connection, local=False):
+    connection.execute(u'SET {}lock_timeout = %(timeout)s'.format(
+        u'LOCAL ' if local else u''), {u'timeout': toolkit.config.get(
+            u'ckanext.collaborators.migrations.lock_timeout',
+            DEFAULT_LOCK_TIMEOUT)})
+
+
+def _record(connection, migration, direction):
+    table = MigrationVersion.__table__
+    if direction == u'upgrade':
+        connection.execute(table.insert().values(
+            version=migration.version, description=migration.description))
+    else:
+        connection.execute(
+            table.delete().where(table.c.version == migration.version))
+
+
+def _apply(migration, direction):
+    step = getattr(migration, direction)
+
+    if migration.transactional:
+        connection = meta.engine.connect()
+        try:
+            with connection.begin():
+                _set_lock_timeout(connection, local=True)
+                step(connection)
+                _record(connection, migration, direction)
+        finally:
+            connection.close()
+    else:
+        connection = meta.engine.connect().execution_options(
+            isolation_level=u'AUTOCOMMIT')
+        try:
+            _set_lock_timeout(connection)
+            step(connection)
+            _record(connection, migration, direction)
+        finally:
+            # The setting is not scoped to a transaction, so it has to be
+            # reset (even if the step failed) before the connection goes back
+            # to the pool. If that fails the connection is discarded.
+            try:
+                connection.execute(u'RESET lock_timeout')
+            except Exception:
+                connection.invalidate()
+            connection.close()
+
+
+def migrate(target=None, dry_run=False):
+    u'''Upgrade (or downgrade) the tables to the `target` version, by default
+    the latest one.
+
+    Returns the list of (migration, direction) steps applied, or that would be
+    applied if `dry_run` is True.
+    '''
+    steps = plan(current_version(), target)
+    if dry_run:
+        return steps
+
+    MigrationVersion.__table__.create(bind=meta.engine, checkfirst=True)
+
+    for migration, direction in steps:
+        log.info(u'Running {} of migration {}: {}'.format(
+            direction, migration.version, migration.description))
+        _apply(migration, direction)
+
+    return steps
@@ -5,9 +5,12 @@ import uuid
 import logging
 from collections import OrderedDict
 
-from sqlalchemy import orm, Column, Unicode, DateTime
+from sqlalchemy import (
+    orm, Column, Unicode, UnicodeText, Integer, DateTime, Index, ForeignKey)
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects.postgresql import insert
 
+from ckan.model import meta
 from ckan.model.meta import metadata
 
 log = logging.getLogger(__name__)
@@ -24,28 +27,305 @@ class DatasetMember(Base):
     __tablename__ = u'dataset_member'
 
     id = Column(Unicode, primary_key=True, default=make_uuid)
-    user_id = Column(Unicode, nullable=False)
-    dataset_id = Column(Unicode, nullable=False)
+    # Collaborators are removed by the database when their user or dataset
+    # rows are deleted (eg on purges). Both keys are backed by the indexes
+    # below, as each one is the leading column of one of them
+    user_id = Column(
+        Unicode,
+        ForeignKey(u'user.id', name=u'fk_dataset_member_user_id',
+                   ondelete=u'CASCADE'),
+        nullable=False)
+    dataset_id = Column(
+        Unicode,
+        ForeignKey(u'package.id', name=u'fk_dataset_member_dataset_id',
+                   ondelete=u'CASCADE'),
+        nullable=False)
     capacity = Column(Unicode, nullable=False)
     modified = Column(DateTime, default=datetime.datetime.utcnow)
 
+    __table_args__ = (
+        # Lookups by dataset and by (dataset, user), and guarantees a user is
+        # only a collaborator once on each dataset
+        Index(u'idx_dataset_member_dataset_id_user_id',
+              u'dataset_id', u'user_id', unique=True),
+        # Lookups by user (optionally filtered by capacity)
+        Index(u'idx_dataset_member_user_id_capacity',
+              u'user_id', u'capacity'),
+        # Keyset pagination of the collaborators of a dataset and of the
+        # datasets of a user
+        Index(u'idx_dataset_member_dataset_id_modified_id',
+              u'dataset_id', u'modified', u'id'),
+        Index(u'idx_dataset_member_user_id_modified_id',
+              u'user_id', u'modified', u'id'),
+    )
+
     def as_dict(self):
-        _dict = OrderedDict()
-        table = orm.class_mapper(self.__class__).mapped_table
-        for col in table.c:
-            val = getattr(self, col.name)
-            if isinstance(val, datetime.date):
-                val = str(val)
-            if isinstance(val, datetime.datetime):
-                val = val.isoformat()
-            _dict[col.name] = val
-        return _dict
+        return member_as_dict(self)
+
+
+def member_as_dict(member):
+    u'''Dictize a DatasetMember object or a dataset_member row returned by a
+    Core statement'''
+    _dict = OrderedDict()
+    table = orm.class_mapper(DatasetMember).mapped_table
+    for col in table.c:
+        val = getattr(member, col.name)
+        if isinstance(val, datetime.date):
+            val = str(val)
+        if isinstance(val, datetime.datetime):
+            val = val.isoformat()
+        _dict[col.name] = val
+    return _dict
+
+
+class MailOutbox(Base):
+    u'''Collaborator notifications waiting to be sent
+
+    Rows are added in the same transaction as the membership change they
+    notify about, and sent in batches by the send-notifications command.
+    '''
+    __tablename__ = u'dataset_member_mail_outbox'
+
+    id = Column(Unicode, primary_key=True, default=make_uuid)
+    user_id = Column(Unicode, nullable=False)
+    dataset_id = Column(Unicode, nullable=False)
+    capacity = Column(Unicode, nullable=False)
+    event = Column(Unicode, nullable=False)
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_attempt = Column(DateTime)
+    last_error = Column(UnicodeText)
+    sent = Column(DateTime)
+
+    __table_args__ = (
+        # Pending notifications, in the order they are sent
+        Index(u'idx_dataset_member_mail_outbox_pending', u'created',
+              postgresql_where=sent.is_(None)),
+    )
+
+
+class MigrationVersion(Base):
+    __tablename__ = u'dataset_member_migration'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(UnicodeText)
+    applied = Column(DateTime, default=datetime.datetime.utcnow)
+
 
 def create_tables():
     DatasetMember.__table__.create()
+    MailOutbox.__table__.create(checkfirst=True)
+    MigrationVersion.__table__.create(checkfirst=True)
 
     log.info(u'Dataset collaborators database tables created')
 
 
 def tables_exist():
     return DatasetMember.__table__.exists()
+
+
+def upsert_members(session, members):
+    u'''Create or update memberships in a single statement
+
+    :param members: dicts with the `dataset_id`, `user_id` and `capacity` of
+        each membership. If a (dataset_id, user_id) pair appears more than once
+        the last one is used.
+
+    Existing memberships get their capacity and modified date updated. The
+    statement is executed in the session's transaction, it is up to the caller
+    to commit it.
+
+    Returns the resulting memberships as dicts.
+    '''
+    unique = OrderedDict()
+    for member in members:
+        unique[(member[u'dataset_id'], member[u'user_id'])] = member
+    if not unique:
+        return []
+
+    now = datetime.datetime.utcnow()
+    table = DatasetMember.__table__
+    statement = insert(table).values([{
+        u'id': make_uuid(),
+        u'dataset_id': member[u'dataset_id'],
+        u'user_id': member[u'user_id'],
+        u'capacity': member[u'capacity'],
+        u'modified': now,
+    } for member in unique.values()])
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.dataset_id, table.c.user_id],
+        set_={
+            u'capacity': statement.excluded.capacity,
+            u'modified': statement.excluded.modified,
+        }).returning(*table.c)
+
+    return [member_as_dict(row) for row in session.execute(statement)]
+
+
+def get_index(name):
+    for index in DatasetMember.__table__.indexes:
+        if index.name == name:
+            return index
+    raise KeyError(name)
+
+
+def index_status(connection, name):
+    u'''Return True if the index exists and is valid, False if it exists
+    but is invalid (eg an interrupted concurrent build) and None if it does
+    not exist.'''
+    return connection.execute(u'''
+        SELECT i.indisvalid
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %(name)s''', {u'name': name}).scalar()
+
+
+def create_index(connection, name, concurrently=False):
+    u'''Create one of the indexes declared on DatasetMember if it is missing.
+
+    With `concurrently` the index is built with CREATE INDEX CONCURRENTLY,
+    which does not block writes on the table but can not run inside a
+    transaction, so `connection` must be in autocommit mode. An invalid index
+    left behind by a previously interrupted build is dropped and rebuilt.
+
+    Returns True if the index was created.
+    '''
+    status = index_status(connection, name)
+    if status:
+        return False
+    if status is not None:
+        log.warning(u'Dropping invalid index {}'.format(name))
+        drop_index(connection, name, concurrently)
+
+    index = get_index(name)
+    log.info(u'Creating index {}'.format(name))
+    connection.execute(
+        u'CREATE {unique}INDEX {concurrently}{name} ON {table} ({columns})'.format(
+            unique=u'UNIQUE ' if index.unique else u'',
+            concurrently=u'CONCURRENTLY ' if concurrently else u'',
+            name=name,
+            table=index.table.name,
+            columns=u', '.join(col.name for col in index.columns)))
+    return True
+
+
+def drop_index(connection, name, concurrently=False):
+    connection.execute(u'DROP INDEX {concurrently}IF EXISTS {name}'.format(
+        concurrently=u'CONCURRENTLY ' if concurrently else u'', name=name))
+
+
+FOREIGN_KEYS = OrderedDict([
+    (u'fk_dataset_member_user_id', (u'user_id', u'"user"')),
+    (u'fk_dataset_member_dataset_id', (u'dataset_id', u'package')),
+])
+
+
+def foreign_key_status(connection, name):
+    u'''Return True if the foreign key exists and is validated, False if it
+    exists but has not been validated yet and None if it does not exist.'''
+    return connection.execute(u'''
+        SELECT convalidated FROM pg_constraint
+        WHERE conname = %(name)s''', {u'name': name}).scalar()
+
+
+def foreign_keys_exist(connection=None):
+    u'''Return True if the database removes collaborators when their users or
+    datasets are deleted.
+
+    Constraints not validated yet are enough, as they are already enforced
+    for rows deleted after they were added.'''
+    connection = connection or meta.engine
+    return all(foreign_key_status(connection, name) is not None
+               for name in FOREIGN_KEYS)
+
+
+def create_foreign_key(connection, name):
+    u'''Add one of the foreign keys of DatasetMember if it is missing.
+
+    The constraint is added as NOT VALID, which only needs a brief lock on
+    the tables, and has to be validated afterwards with
+    `validate_foreign_key`.
+
+    Returns True if the foreign key was created.
+    '''
+    if foreign_key_status(connection, name) is not None:
+        return False
+    column, target = FOREIGN_KEYS[name]
+    log.info(u'Creating foreign key {}'.format(name))
+    connection.execute(
+        u'ALTER TABLE dataset_member ADD CONSTRAINT {name} '
+        u'FOREIGN KEY ({column}) REFERENCES {target} (id) '
+        u'ON DELETE CASCADE NOT VALID'.format(
+            name=name, column=column, target=target))
+    return True
+
+
+def validate_foreign_key(connection, name):
+    u'''Check the existing rows against a NOT VALID foreign key. This does not
+    block reads or writes on dataset_member while it runs.'''
+    if foreign_key_status(connection, name) is False:
+        log.info(u'Validating foreign key {}'.format(name))
+        connection.execute(
+            u'ALTER TABLE dataset_member VALIDATE CONSTRAINT {}'.format(name))
+
+
+def drop_foreign_key(connection, name):
+    connection.execute(
+        u'ALTER TABLE dataset_member DROP CONSTRAINT IF EXISTS {}'.format(
+            name))
+
+
+def find_orphan_members(connection, batch_size, include_deleted=False):
+    u'''Find the collaborators whose user or dataset no longer exists
+
+    The table is walked in id order, `batch_size` rows at a time, and each
+    batch is joined with the user and package tables on their primary keys,
+    so the whole scan takes time proportional to the size of the table.
+    Deleting the orphans found between batches is safe.
+
+    With `include_deleted`, collaborators of users and datasets in the
+    deleted state are considered orphans too.
+
+    Yields a (scanned, orphans) tuple for each batch, with the number of rows
+    scanned and the orphan rows (with their id, user_id and dataset_id).
+    '''
+    deleted = u''
+    if include_deleted:
+        deleted = u" OR p.state = 'deleted' OR u.state = 'deleted'"
+    statement = u'''
+        SELECT m.id, m.user_id, m.dataset_id,
+               (p.id IS NULL OR u.id IS NULL{deleted}) AS orphan
+        FROM dataset_member m
+        LEFT JOIN package p ON p.id = m.dataset_id
+        LEFT JOIN "user" u ON u.id = m.user_id
+        WHERE m.id > %(last_id)s
+        ORDER BY m.id
+        LIMIT %(batch_size)s'''.format(deleted=deleted)
+
+    last_id = u''
+    while True:
+        rows = connection.execute(statement, {
+            u'last_id': last_id, u'batch_size': batch_size}).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield len(rows), [row for row in rows if row.orphan]
+
+
+def remove_duplicate_members(connection):
+    u'''Remove duplicated (dataset_id, user_id) rows, keeping the most
+    recently modified one, so the unique index can be built.
+
+    Returns the number of rows deleted.
+    '''
+    result = connection.execute(u'''
+        DELETE FROM dataset_member
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, row_number() OVER (
+                    PARTITION BY dataset_id, user_id
+                    ORDER BY modified DESC NULLS LAST, id) AS position
+                FROM dataset_member
+            ) AS ranked
+            WHERE ranked.position > 1
+        )''')
+    return result.rowcount
@@ -1,12 +1,17 @@
 import logging
 
 import ckan.plugins as p
+from ckan import model
 from ckan.lib.plugins import DefaultPermissionLabels
 import ckan.plugins.toolkit as toolkit
 
-from ckanext.collaborators import blueprint
-from ckanext.collaborators.helpers import get_collaborators
-from ckanext.collaborators.model import tables_exist
+from ckanext.collaborators import blueprint, migration
+from ckanext.collaborators.cache import configure_label_cache, get_label_cache
+from ckanext.collaborators.helpers import (
+    get_collaborators, get_collaborators_count, linked_user)
+from ckanext.collaborators.instrumentation import (
+    configure_metrics, configure_slow_query_log, instrumented)
+from ckanext.collaborators.model import DatasetMember, tables_exist
 from ckanext.collaborators.logic import action, auth
 
 log = logging.getLogger(__name__)
@@ -14,6 +19,7 @@ log = logging.getLogger(__name__)
 
 class CollaboratorsPlugin(p.SingletonPlugin, DefaultPermissionLabels):
     p.implements(p.IConfigurer)
+    p.implements(p.IConfigurable)
     p.implements(p.IActions)
     p.implements(p.IAuthFunctions)
     p.implements(p.IPermissionLabels)
@@ -28,6 +34,12 @@ class CollaboratorsPlugin(p.SingletonPlugin, DefaultPermissionLabels):
 The dataset collaborators extension requires a database setup. Please run the
 following to create the database tables:
     paster --plugin=ckanext-collaborators collaborators init-db
+''')
+        elif migration.current_version() < migration.head():
+            log.critical(u'''
+The dataset collaborators database tables are not up to date. Please run the
+following to apply the pending migrations:
+    paster --plugin=ckanext-collaborators collaborators migrate
 ''')
         else:
             log.debug(u'Dataset collaborators tables exist')
@@ -36,40 +48,73 @@ following to create the database tables:
         toolkit.add_public_directory(config_, 'public')
         toolkit.add_resource('fanstatic', 'collaborators')
 
+    # IConfigurable
+
+    def configure(self, config_):
+        # Fail early on unknown values
+        action.get_labels_mode()
+        configure_label_cache(config_)
+        configure_metrics(config_)
+        configure_slow_query_log(config_)
+
     # IActions
 
     def get_actions(self):
-        return {
+        actions = {
             'dataset_collaborator_create': action.dataset_collaborator_create,
+            'dataset_collaborator_create_many': action.dataset_collaborator_create_many,
             'dataset_collaborator_delete': action.dataset_collaborator_delete,
+            'dataset_collaborator_delete_many': action.dataset_collaborator_delete_many,
             'dataset_collaborator_list': action.dataset_collaborator_list,
             'dataset_collaborator_list_for_user': action.dataset_collaborator_list_for_user,
+            'dataset_collaborator_count': action.dataset_collaborator_count,
             'package_delete': action.collaborators_package_delete,
+            'dataset_purge': action.collaborators_dataset_purge,
+            'bulk_update_delete': action.collaborators_bulk_update_delete,
             'user_delete': action.collaborators_user_delete,
+            'collaborators_stats': action.collaborators_stats,
         }
+        return dict((name, instrumented('action', name)(func))
+                    for name, func in actions.items())
 
     # IAuthFunctions
 
     def get_auth_functions(self):
-        return {
+        auth_functions = {
             'dataset_collaborator_create': auth.dataset_collaborator_create,
+            'dataset_collaborator_create_many': auth.dataset_collaborator_create_many,
             'dataset_collaborator_delete': auth.dataset_collaborator_delete,
+            'dataset_collaborator_delete_many': auth.dataset_collaborator_delete_many,
             'dataset_collaborator_list': auth.dataset_collaborator_list,
             'dataset_collaborator_list_for_user': auth.dataset_collaborator_list_for_user,
+            'dataset_collaborator_count': auth.dataset_collaborator_count,
             'package_update': auth.package_update,
+            'collaborators_stats': auth.collaborators_stats,
         }
+        return dict((name, instrumented('auth', name)(func))
+                    for name, func in auth_functions.items())
 
     # IPermissionLabels
 
+    @instrumented('labels', 'get_dataset_labels')
     def get_dataset_labels(self, dataset_obj):
 
         labels = super(CollaboratorsPlugin, self).get_dataset_labels(dataset_obj)
 
+        if action.get_labels_mode() == 'user':
+            # Add a label for each of this dataset collaborators
+            user_ids = model.Session.query(DatasetMember.user_id).filter(
+                DatasetMember.dataset_id == dataset_obj.id)
+            labels.extend(u'collaborator-user-{}'.format(user_id)
+                          for user_id, in user_ids)
+            return labels
+
         # Add a generic label for all this dataset collaborators
         labels.append(u'collaborator-{}'.format(dataset_obj.id))
 
         return labels
 
+    @instrumented('labels', 'get_user_dataset_labels')
     def get_user_dataset_labels(self, user_obj):
 
         labels = super(CollaboratorsPlugin, self).get_user_dataset_labels(user_obj)
@@ -77,18 +122,31 @@ following to create the database tables:
         if not user_obj:
             return labels
 
-        # Add a label for each dataset this user is a collaborator of
-        datasets = toolkit.get_action('dataset_collaborator_list_for_user')(
-                {'ignore_auth': True}, {'id': user_obj.id})
+        if action.get_labels_mode() == 'user':
+            labels.append(u'collaborator-user-{}'.format(user_obj.id))
+            return labels
 
-        for dataset in datasets:
-            labels.append('collaborator-{}'.format(dataset['dataset_id']))
+        cache = get_label_cache()
+        collaborator_labels = cache.get(user_obj.id)
+        if collaborator_labels is None:
+            # Add a label for each dataset this user is a collaborator of
+            datasets = toolkit.get_action('dataset_collaborator_list_for_user')(
+                    {'ignore_auth': True}, {'id': user_obj.id})
 
-        return labels
+            collaborator_labels = [
+                'collaborator-{}'.format(dataset['dataset_id'])
+                for dataset in datasets]
+            cache.set(user_obj.id, collaborator_labels)
+
+        return labels + collaborator_labels
 
     # ITemplateHelpers
     def get_helpers(self):
-        return {'collaborators_get_collaborators': get_collaborators}
+        return {
+            'collaborators_get_collaborators': get_collaborators,
+            'collaborators_get_collaborators_count': get_collaborators_count,
+            'collaborators_linked_user': linked_user,
+        }
 
     # IBlueprint
     def get_blueprint(self):
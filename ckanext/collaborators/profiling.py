@@ -0,0 +1,159 @@
+# encoding: utf-8
+
+u'''Opt-in profiling of the collaborators pages
+
+When ``ckanext.collaborators.profiling.enabled`` is set, a fraction of the
+requests to the collaborators blueprint (``ckanext.collaborators.profiling.
+sample_rate``) is run under cProfile, and the time spent in each phase of the
+view (auth checks, data fetching, template rendering...) is recorded.
+
+Profiles can be written to a directory (a ``.prof`` file that can be loaded
+with ``pstats`` or tools like snakeviz, and a ``.json`` file with the phases)
+and the phases can be sent to sysadmins in a response header.
+'''
+
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import cProfile
+import functools
+import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import flask
+
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+
+HEADER = u'X-Collaborators-Profile'
+
+
+class Phases(object):
+    u'''Time spent in each phase of a request. Phases can be nested, the time
+    of a nested phase is not counted in its parent.'''
+
+    def __init__(self):
+        self.seconds = OrderedDict()
+        self._stack = []
+
+    def _add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        now = timeit.default_timer()
+        if self._stack:
+            parent, started = self._stack[-1]
+            self._add(parent, now - started)
+        self._stack.append((name, now))
+        try:
+            yield
+        finally:
+            name, started = self._stack.pop()
+            now = timeit.default_timer()
+            self._add(name, now - started)
+            if self._stack:
+                self._stack[-1] = (self._stack[-1][0], now)
+
+    def as_dict(self, total):
+        out = OrderedDict(
+            (name, round(seconds * 1000, 3))
+            for name, seconds in self.seconds.items())
+        out[u'other'] = round(
+            max(total - sum(self.seconds.values()), 0) * 1000, 3)
+        out[u'total'] = round(total * 1000, 3)
+        return out
+
+
+def _current_phases():
+    if not flask.has_request_context():
+        return None
+    return getattr(flask.g, u'_collaborators_phases', None)
+
+
+@contextmanager
+def phase(name):
+    u'''Record the time spent in the body of the with statement as `name`,
+    if the current request is being profiled'''
+    phases = _current_phases()
+    if phases is None:
+        yield
+        return
+    with phases.phase(name):
+        yield
+
+
+def _sampled():
+    if not toolkit.asbool(toolkit.config.get(
+            u'ckanext.collaborators.profiling.enabled', False)):
+        return False
+    rate = float(toolkit.config.get(
+        u'ckanext.collaborators.profiling.sample_rate', 1.0))
+    return random.random() < rate
+
+
+def _write(directory, profile, info):
+    name = u'{}-{}-{}'.format(
+        time.strftime(u'%Y%m%d%H%M%S'), flask.request.endpoint,
+        uuid.uuid4().hex[:8])
+    path = os.path.join(directory, name)
+    profile.dump_stats(path + u'.prof')
+    with open(path + u'.json', u'w') as f:
+        json.dump(info, f, indent=2)
+    return path
+
+
+def _is_sysadmin():
+    user = getattr(toolkit.c, u'userobj', None)
+    return bool(user and user.sysadmin)
+
+
+def profiled(view):
+    u'''Profile the sampled calls to a view function'''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _sampled():
+            return view(*args, **kwargs)
+
+        phases = flask.g._collaborators_phases = Phases()
+        profile = cProfile.Profile()
+        started = timeit.default_timer()
+        response = None
+        try:
+            response = flask.make_response(
+                profile.runcall(view, *args, **kwargs))
+            return response
+        finally:
+            total = timeit.default_timer() - started
+            flask.g._collaborators_phases = None
+            info = OrderedDict([
+                (u'method', flask.request.method),
+                (u'url', flask.request.url),
+                (u'endpoint', flask.request.endpoint),
+                (u'status', response.status_code if response else None),
+                (u'phases_ms', phases.as_dict(total)),
+            ])
+            log.debug(u'Profiled {}: {}'.format(
+                flask.request.url, json.dumps(info[u'phases_ms'])))
+
+            directory = toolkit.config.get(
+                u'ckanext.collaborators.profiling.directory')
+            if directory:
+                try:
+                    _write(directory, profile, info)
+                except (IOError, OSError) as e:
+                    log.warning(u'Could not write profile: {}'.format(e))
+
+            if response is not None and toolkit.asbool(toolkit.config.get(
+                    u'ckanext.collaborators.profiling.header', False)) and \
+                    _is_sysadmin():
+                response.headers[HEADER] = u'; '.join(
+                    u'{}={}ms'.format(name, ms)
+                    for name, ms in info[u'phases_ms'].items())
+    return wrapper
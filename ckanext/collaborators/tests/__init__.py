@@ -1,6 +1,22 @@
+from ckan import model
 from ckan.tests import helpers
 
-from ckanext.collaborators.model import tables_exist, create_tables
+from ckanext.collaborators.model import (
+    DatasetMember, tables_exist, create_tables)
+
+
+def create_collaborators(datasets, users, capacity='editor'):
+    '''Make each of the users a collaborator in each of the datasets
+
+    Rows are inserted directly, so users and datasets only need an ``id``
+    (they don't need to exist if the foreign keys have been dropped).
+    '''
+    for dataset in datasets:
+        for user in users:
+            model.Session.add(DatasetMember(
+                dataset_id=dataset['id'], user_id=user['id'],
+                capacity=capacity))
+    model.Session.commit()
 
 class FunctionalTestBase(helpers.FunctionalTestBase):
 
@@ -7,7 +7,9 @@ from ckan.plugins import toolkit
 from ckan.tests import helpers, factories
 
 from ckanext.collaborators.model import DatasetMember
-from ckanext.collaborators.tests import FunctionalTestBase
+from ckanext.collaborators.plugin import CollaboratorsPlugin
+from ckanext.collaborators.tests import (
+    FunctionalTestBase, create_collaborators)
 
 
 class TestCollaboratorsActions(FunctionalTestBase):
@@ -183,6 +185,32 @@ class TestCollaboratorsActions(FunctionalTestBase):
         assert_equals(members[0]['user_id'], user2['id'])
         assert_equals(members[0]['capacity'], capacity2)
 
+    def test_list_include_user(self):
+
+        dataset = factories.Dataset()
+        user1 = factories.User(fullname='First Collaborator')
+        user2 = factories.User(fullname='')
+
+        for user in (user1, user2):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], user_id=user['id'], capacity='editor')
+
+        members = helpers.call_action(
+            'dataset_collaborator_list',
+            id=dataset['id'], include_user=True)
+
+        assert_equals(len(members), 2)
+
+        assert_equals(members[0]['user_id'], user1['id'])
+        assert_equals(members[0]['user_name'], user1['name'])
+        assert_equals(members[0]['user_display_name'], 'First Collaborator')
+        assert_equals(members[0]['user_state'], 'active')
+        assert_equals(members[0]['user_email_hash'],
+                      model.User.get(user1['id']).email_hash)
+
+        assert_equals(members[1]['user_display_name'], user2['name'])
+
     def test_list_dataset_not_found(self):
 
         assert_raises(toolkit.ObjectNotFound, helpers.call_action,
@@ -252,6 +280,49 @@ class TestCollaboratorsActions(FunctionalTestBase):
         assert_equals(datasets[0]['dataset_id'], dataset1['id'])
         assert_equals(datasets[0]['capacity'], capacity1)
 
+    def test_list_for_user_include_dataset(self):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(title='Collaborator Dataset',
+                                    owner_org=org['id'])
+        user = factories.User()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='editor')
+
+        datasets = helpers.call_action(
+            'dataset_collaborator_list_for_user',
+            id=user['id'], include_dataset=True)
+
+        assert_equals(len(datasets), 1)
+        assert_equals(datasets[0]['dataset_id'], dataset['id'])
+        assert_equals(datasets[0]['dataset_name'], dataset['name'])
+        assert_equals(datasets[0]['dataset_title'], 'Collaborator Dataset')
+        assert_equals(datasets[0]['dataset_state'], 'active')
+        assert_equals(datasets[0]['dataset_owner_org'], org['id'])
+        assert_equals(datasets[0]['dataset_metadata_modified'],
+                      dataset['metadata_modified'])
+
+    def test_list_for_user_filter_dataset(self):
+
+        org = factories.Organization()
+        dataset1 = factories.Dataset(owner_org=org['id'])
+        dataset2 = factories.Dataset(owner_org=org['id'], state='draft')
+        dataset3 = factories.Dataset()
+        user = factories.User()
+
+        for dataset in (dataset1, dataset2, dataset3):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], user_id=user['id'], capacity='editor')
+
+        datasets = helpers.call_action(
+            'dataset_collaborator_list_for_user',
+            id=user['id'], owner_org=org['name'], dataset_state='active')
+
+        assert_equals([d['dataset_id'] for d in datasets], [dataset1['id']])
+
     def test_list_for_user_user_not_found(self):
 
         assert_raises(toolkit.ObjectNotFound, helpers.call_action,
@@ -325,6 +396,74 @@ class TestCollaboratorsSearch(FunctionalTestBase):
         assert_equals(results['results'][0]['id'], dataset1['id'])
         assert_equals(results['results'][1]['id'], dataset2['id'])
 
+    @helpers.change_config('ckanext.collaborators.labels_mode', 'user')
+    def test_search_results_user_labels(self):
+
+        org = factories.Organization()
+        dataset1 = factories.Dataset(
+            name='test1', private=True, owner_org=org['id'])
+        dataset2 = factories.Dataset(name='test2')
+
+        user = factories.User()
+        context = {'user': user['name']}
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset1['id'], user_id=user['id'], capacity='member')
+
+        results = toolkit.get_action('package_search')(context,
+                {'q':'*:*', 'include_private':True, 'sort': 'name asc'})
+
+        assert_equals(results['count'], 2)
+        assert_equals(results['results'][0]['id'], dataset1['id'])
+
+        helpers.call_action(
+            'dataset_collaborator_delete',
+            id=dataset1['id'], user_id=user['id'])
+
+        results = toolkit.get_action('package_search')(context,
+                {'q':'*:*', 'include_private':True})
+
+        assert_equals(results['count'], 1)
+        assert_equals(results['results'][0]['id'], dataset2['id'])
+
+    @helpers.change_config('ckanext.collaborators.labels_mode', 'user')
+    def test_user_labels_are_constant_size(self):
+
+        user = factories.User()
+        for i in range(3):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=factories.Dataset()['id'], user_id=user['id'],
+                capacity='member')
+
+        labels = CollaboratorsPlugin().get_user_dataset_labels(
+            model.User.get(user['id']))
+
+        assert_equals(
+            [l for l in labels if l.startswith('collaborator-')],
+            ['collaborator-user-{}'.format(user['id'])])
+
+    @helpers.change_config('ckanext.collaborators.labels_mode', 'user')
+    @helpers.change_config('ckanext.collaborators.reindex.threshold', '2')
+    @helpers.change_config('ckanext.collaborators.reindex.batch_size', '2')
+    @mock.patch('ckanext.collaborators.logic.action.toolkit.enqueue_job')
+    def test_user_labels_reindex_in_background(self, mock_enqueue_job):
+
+        user = factories.User()
+        datasets = [factories.Dataset() for i in range(3)]
+
+        helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[{'id': dataset['id'], 'user_id': user['id'],
+                            'capacity': 'member'} for dataset in datasets])
+
+        assert_equals(mock_enqueue_job.call_count, 2)
+        assert_equals(
+            sorted(dataset_id for call in mock_enqueue_job.call_args_list
+                   for dataset_id in call[0][1][0]),
+            sorted(dataset['id'] for dataset in datasets))
+
     @mock.patch('ckanext.collaborators.mailer.mail_user')
     def test_create_collaborator_emails_notification_if_send_email(self, mock_mail_user):
         dataset = factories.Dataset()
@@ -364,3 +503,472 @@ class TestCollaboratorsSearch(FunctionalTestBase):
             id=dataset['id'], user_id=user['id'])
 
         assert_equals(mock_mail_user.call_count, 2)
+
+
+class TestCollaboratorsCreateMany(FunctionalTestBase):
+
+    def test_create_many(self):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+
+        results = helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': dataset1['id'], 'user_id': user1['id'],
+                 'capacity': 'editor'},
+                {'id': dataset1['name'], 'user_id': user2['name'],
+                 'capacity': 'member'},
+                {'id': dataset2['id'], 'user_id': user1['id'],
+                 'capacity': 'member'},
+            ])
+
+        assert_equals([r['success'] for r in results], [True, True, True])
+        assert_equals(results[1]['collaborator']['dataset_id'], dataset1['id'])
+        assert_equals(results[1]['collaborator']['user_id'], user2['id'])
+        assert_equals(results[1]['collaborator']['capacity'], 'member')
+
+        assert_equals(model.Session.query(DatasetMember).count(), 3)
+
+    def test_create_many_updates_existing(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='member')
+
+        results = helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': dataset['id'], 'user_id': user['id'],
+                 'capacity': 'editor'},
+            ])
+
+        assert_equals(results[0]['collaborator']['capacity'], 'editor')
+        assert_equals(model.Session.query(DatasetMember).count(), 1)
+        assert_equals(model.Session.query(DatasetMember).one().capacity,
+            'editor')
+
+    def test_create_many_duplicated_items(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        results = helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': dataset['id'], 'user_id': user['id'],
+                 'capacity': 'member'},
+                {'id': dataset['id'], 'user_id': user['name'],
+                 'capacity': 'editor'},
+            ])
+
+        assert_equals([r['success'] for r in results], [True, True])
+        assert_equals(model.Session.query(DatasetMember).count(), 1)
+        assert_equals(model.Session.query(DatasetMember).one().capacity,
+            'editor')
+
+    def test_create_many_reports_errors(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        results = helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': 'xxx', 'user_id': user['id'], 'capacity': 'editor'},
+                {'id': dataset['id'], 'user_id': 'yyy', 'capacity': 'editor'},
+                {'id': dataset['id'], 'user_id': user['id'],
+                 'capacity': 'unknown'},
+                {'id': dataset['id'], 'user_id': user['id'],
+                 'capacity': 'editor'},
+            ])
+
+        assert_equals([r['success'] for r in results],
+                      [False, False, False, True])
+        assert_equals(results[0]['error'], 'Dataset not found')
+        assert_equals(results[1]['error'], 'User not found')
+        assert_equals(model.Session.query(DatasetMember).count(), 1)
+
+    def test_create_many_not_authorized_dataset(self):
+
+        org_admin = factories.User()
+        org1 = factories.Organization(
+            users=[{'name': org_admin['name'], 'capacity': 'admin'}])
+        org2 = factories.Organization()
+        dataset1 = factories.Dataset(owner_org=org1['id'])
+        dataset2 = factories.Dataset(owner_org=org2['id'])
+        user = factories.User()
+
+        context = {'user': org_admin['name'], 'ignore_auth': False}
+        results = helpers.call_action(
+            'dataset_collaborator_create_many', context=context,
+            collaborators=[
+                {'id': dataset1['id'], 'user_id': user['id'],
+                 'capacity': 'editor'},
+                {'id': dataset2['id'], 'user_id': user['id'],
+                 'capacity': 'editor'},
+            ])
+
+        assert_equals([r['success'] for r in results], [True, False])
+        assert_equals(model.Session.query(DatasetMember).count(), 1)
+
+    def test_create_many_wrong_input(self):
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_create_many', collaborators='xxx')
+
+    @mock.patch('ckanext.collaborators.mailer.mail_user')
+    def test_create_many_emails_notification_if_send_email(self, mock_mail_user):
+        dataset = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+
+        helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': dataset['id'], 'user_id': user1['id'],
+                 'capacity': 'editor'},
+                {'id': dataset['id'], 'user_id': user2['id'],
+                 'capacity': 'member'},
+            ], send_mail=True)
+
+        assert_equals(mock_mail_user.call_count, 2)
+
+
+class TestCollaboratorsDeleteMany(FunctionalTestBase):
+
+    @mock.patch('ckanext.collaborators.mailer.mail_user')
+    def test_delete_many(self, mock_mail_user):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        dataset3 = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+
+        create_collaborators([dataset1, dataset2, dataset3], [user1, user2])
+
+        deleted = helpers.call_action(
+            'dataset_collaborator_delete_many',
+            ids=[dataset1['id'], dataset2['name']], user_ids=[user1['name']])
+
+        assert_equals(len(deleted), 2)
+        assert_equals(set(d['dataset_id'] for d in deleted),
+                      set([dataset1['id'], dataset2['id']]))
+        assert_equals(model.Session.query(DatasetMember).count(), 4)
+        assert_equals(mock_mail_user.call_count, 2)
+
+    @mock.patch('ckanext.collaborators.mailer.mail_user')
+    def test_delete_many_from_organization(self, mock_mail_user):
+
+        org = factories.Organization()
+        dataset1 = factories.Dataset(owner_org=org['id'])
+        dataset2 = factories.Dataset(owner_org=org['id'])
+        dataset3 = factories.Dataset()
+        user = factories.User()
+
+        create_collaborators([dataset1, dataset2, dataset3], [user])
+
+        deleted = helpers.call_action(
+            'dataset_collaborator_delete_many',
+            owner_org=org['name'], user_ids=[user['id']], send_mail=False)
+
+        assert_equals(len(deleted), 2)
+        assert_equals(model.Session.query(DatasetMember).one().dataset_id,
+                      dataset3['id'])
+        assert_equals(mock_mail_user.call_count, 0)
+
+    def test_delete_many_not_authorized(self):
+
+        org_admin = factories.User()
+        org1 = factories.Organization(
+            users=[{'name': org_admin['name'], 'capacity': 'admin'}])
+        org2 = factories.Organization()
+        dataset1 = factories.Dataset(owner_org=org1['id'])
+        dataset2 = factories.Dataset(owner_org=org2['id'])
+        user = factories.User()
+
+        create_collaborators([dataset1, dataset2], [user])
+
+        context = {'user': org_admin['name'], 'ignore_auth': False}
+        assert_raises(toolkit.NotAuthorized, helpers.call_action,
+            'dataset_collaborator_delete_many', context=context,
+            ids=[dataset1['id'], dataset2['id']], user_ids=[user['id']],
+            send_mail=False)
+
+        assert_equals(model.Session.query(DatasetMember).count(), 2)
+
+    def test_delete_many_not_authorized_without_collaborators(self):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'], private=True)
+        user = factories.User()
+        other_user = factories.User()
+
+        context = {'user': other_user['name'], 'ignore_auth': False}
+        assert_raises(toolkit.NotAuthorized, helpers.call_action,
+            'dataset_collaborator_delete_many', context=context,
+            ids=[dataset['id']], user_ids=[user['id']], send_mail=False)
+        assert_raises(toolkit.NotAuthorized, helpers.call_action,
+            'dataset_collaborator_delete_many', context=context,
+            owner_org=org['id'], user_ids=[user['id']], send_mail=False)
+
+    def test_delete_many_from_organization_authorized(self):
+
+        org_admin = factories.User()
+        org = factories.Organization(
+            users=[{'name': org_admin['name'], 'capacity': 'admin'}])
+        dataset = factories.Dataset(owner_org=org['id'])
+        user = factories.User()
+
+        create_collaborators([dataset], [user])
+
+        context = {'user': org_admin['name'], 'ignore_auth': False}
+        deleted = helpers.call_action(
+            'dataset_collaborator_delete_many', context=context,
+            owner_org=org['name'], user_ids=[user['id']], send_mail=False)
+
+        assert_equals(len(deleted), 1)
+
+    def test_delete_many_missing_datasets(self):
+
+        user = factories.User()
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_delete_many', user_ids=[user['id']])
+
+    def test_delete_many_organization_not_found(self):
+
+        user = factories.User()
+
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action,
+            'dataset_collaborator_delete_many',
+            owner_org='xxx', user_ids=[user['id']])
+
+
+class TestCollaboratorsCascade(FunctionalTestBase):
+
+    def _members(self):
+        return sorted((m.dataset_id, m.user_id)
+                      for m in model.Session.query(DatasetMember))
+
+    def test_deleting_dataset_removes_collaborators(self):
+        datasets = [factories.Dataset(), factories.Dataset()]
+        users = [factories.User(), factories.User()]
+        create_collaborators(datasets, users)
+
+        helpers.call_action('package_delete', id=datasets[0]['name'])
+
+        assert_equals(self._members(), sorted(
+            (datasets[1]['id'], user['id']) for user in users))
+
+    @helpers.change_config('ckanext.collaborators.delete_batch_size', '2')
+    def test_deleting_user_removes_collaborators_in_chunks(self):
+        datasets = [factories.Dataset() for i in range(5)]
+        users = [factories.User(), factories.User()]
+        create_collaborators(datasets, users)
+
+        helpers.call_action('user_delete', id=users[0]['name'])
+
+        assert_equals(self._members(), sorted(
+            (dataset['id'], users[1]['id']) for dataset in datasets))
+
+    def test_purging_dataset_removes_collaborators(self):
+        datasets = [factories.Dataset(), factories.Dataset()]
+        user = factories.User()
+        create_collaborators(datasets, [user])
+
+        helpers.call_action('dataset_purge', id=datasets[0]['name'])
+
+        assert_equals(self._members(), [(datasets[1]['id'], user['id'])])
+
+    def test_bulk_deleting_datasets_removes_collaborators(self):
+        org = factories.Organization()
+        datasets = [factories.Dataset(owner_org=org['id']) for i in range(3)]
+        user = factories.User()
+        create_collaborators(datasets, [user])
+
+        helpers.call_action(
+            'bulk_update_delete', org_id=org['id'],
+            datasets=[datasets[0]['id'], datasets[1]['id']])
+
+        assert_equals(self._members(), [(datasets[2]['id'], user['id'])])
+
+    def test_bulk_deleting_datasets_of_other_organizations(self):
+        org = factories.Organization()
+        other_org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        other_dataset = factories.Dataset(owner_org=other_org['id'])
+        user = factories.User()
+        create_collaborators([dataset, other_dataset], [user])
+
+        helpers.call_action(
+            'bulk_update_delete', org_id=org['id'],
+            datasets=[dataset['id'], other_dataset['id']])
+
+        assert_equals(model.Package.get(other_dataset['id']).state, 'active')
+        assert_equals(self._members(), [(other_dataset['id'], user['id'])])
+
+
+class TestCollaboratorsPagination(FunctionalTestBase):
+
+    def test_list_pages(self):
+
+        dataset = factories.Dataset()
+        users = [factories.User() for i in range(5)]
+        for user in users:
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], user_id=user['id'], capacity='editor')
+
+        page1 = helpers.call_action(
+            'dataset_collaborator_list', id=dataset['id'], limit=2)
+        page2 = helpers.call_action(
+            'dataset_collaborator_list', id=dataset['id'], limit=2,
+            cursor=page1['next_cursor'])
+        page3 = helpers.call_action(
+            'dataset_collaborator_list', id=dataset['id'], limit=2,
+            cursor=page2['next_cursor'])
+
+        assert_equals(
+            [m['user_id'] for m in
+             page1['results'] + page2['results'] + page3['results']],
+            [user['id'] for user in users])
+        assert_equals(len(page3['results']), 1)
+        assert_equals(page3['next_cursor'], None)
+
+    def test_list_last_page_is_full(self):
+
+        dataset = factories.Dataset()
+        for i in range(2):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], user_id=factories.User()['id'],
+                capacity='editor')
+
+        page = helpers.call_action(
+            'dataset_collaborator_list', id=dataset['id'], limit=2)
+
+        assert_equals(len(page['results']), 2)
+        assert_equals(page['next_cursor'], None)
+
+    def test_list_for_user_pages(self):
+
+        user = factories.User()
+        datasets = [factories.Dataset() for i in range(3)]
+        for dataset in datasets:
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], user_id=user['id'], capacity='member')
+
+        page1 = helpers.call_action(
+            'dataset_collaborator_list_for_user', id=user['id'], limit='2')
+        page2 = helpers.call_action(
+            'dataset_collaborator_list_for_user', id=user['id'], limit='2',
+            cursor=page1['next_cursor'])
+
+        assert_equals(
+            [d['dataset_id'] for d in page1['results'] + page2['results']],
+            [dataset['id'] for dataset in datasets])
+        assert_equals(page2['next_cursor'], None)
+
+    def test_list_wrong_limit(self):
+
+        dataset = factories.Dataset()
+
+        for limit in (0, -1, 'xxx', 100000):
+            assert_raises(toolkit.ValidationError, helpers.call_action,
+                'dataset_collaborator_list', id=dataset['id'], limit=limit)
+
+    def test_list_wrong_cursor(self):
+
+        dataset = factories.Dataset()
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_list', id=dataset['id'], limit=10,
+            cursor='xxx')
+
+
+class TestCollaboratorsCount(FunctionalTestBase):
+
+    def test_count_dataset(self):
+
+        dataset = factories.Dataset()
+        for capacity in ('editor', 'member', 'member'):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], user_id=factories.User()['id'],
+                capacity=capacity)
+
+        result = helpers.call_action(
+            'dataset_collaborator_count', id=dataset['name'])
+
+        assert_equals(result, {
+            'count': 3, 'capacities': {'editor': 1, 'member': 2}})
+
+    def test_count_datasets(self):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset1['id'], user_id=factories.User()['id'],
+            capacity='editor')
+
+        result = helpers.call_action(
+            'dataset_collaborator_count',
+            ids=[dataset1['id'], dataset2['name']])
+
+        assert_equals(result, {
+            dataset1['id']: {
+                'count': 1, 'capacities': {'editor': 1, 'member': 0}},
+            dataset2['id']: {
+                'count': 0, 'capacities': {'editor': 0, 'member': 0}},
+        })
+
+    def test_count_user(self):
+
+        user = factories.User()
+        for capacity in ('editor', 'editor', 'member'):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=factories.Dataset()['id'], user_id=user['id'],
+                capacity=capacity)
+
+        result = helpers.call_action(
+            'dataset_collaborator_count', user_id=user['name'])
+
+        assert_equals(result, {
+            'count': 3, 'capacities': {'editor': 2, 'member': 1}})
+
+    def test_count_dataset_not_found(self):
+
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action,
+            'dataset_collaborator_count', ids=['xxx'])
+
+    def test_count_user_not_found(self):
+
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action,
+            'dataset_collaborator_count', user_id='xxx')
+
+    def test_count_wrong_params(self):
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_count')
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_count', id='xxx', user_id='yyy')
+
+    def test_count_not_authorized(self):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        user = factories.User()
+
+        context = {'user': user['name'], 'ignore_auth': False}
+        assert_raises(toolkit.NotAuthorized, helpers.call_action,
+            'dataset_collaborator_count', context=context, id=dataset['id'])
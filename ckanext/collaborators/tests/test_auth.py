@@ -1,3 +1,5 @@
+import mock
+
 from nose.tools import assert_equals, assert_raises
 
 from ckan import model
@@ -83,6 +85,27 @@ class TestCollaboratorsAuth(CollaboratorsAuthTestBase, FunctionalTestBase):
             'dataset_collaborator_create',
             context=context, id=dataset['id'])
 
+    def test_create_dataset_not_found(self):
+
+        context = self._get_context(self.org_admin)
+        assert_raises(toolkit.ObjectNotFound, helpers.call_auth,
+            'dataset_collaborator_create',
+            context=context, id='xxx')
+
+    def test_permission_is_memoized_per_request(self):
+
+        app = helpers._get_test_app()
+        with app.flask_app.test_request_context():
+            context = self._get_context(self.org_admin)
+            assert helpers.call_auth('dataset_collaborator_create',
+                context=context, id=self.dataset['id'])
+
+            with mock.patch('ckanext.collaborators.logic.auth.'
+                            'has_user_permission_for_group_or_org') as m:
+                assert helpers.call_auth('dataset_collaborator_list',
+                    context=context, id=self.dataset['name'])
+                assert_equals(m.call_count, 0)
+
     def test_delete_org_admin_is_authorized(self):
 
         context = self._get_context(self.org_admin)
@@ -383,6 +406,36 @@ class TestCollaboratorsUpdate(CollaboratorsAuthTestBase, FunctionalTestBase):
         assert helpers.call_auth('package_update',
             context=context, id=dataset['id'])
 
+    def test_dataset_update_anonymous(self):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+
+        context = self._get_context('')
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+            'package_update',
+            context=context, id=dataset['id'])
+
+    def test_dataset_update_editor_in_same_request(self):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        user = factories.User()
+
+        app = helpers._get_test_app()
+        with app.flask_app.test_request_context():
+            context = self._get_context(user)
+            assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+                'package_update',
+                context=context, id=dataset['id'])
+
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], user_id=user['id'], capacity='editor')
+
+            assert helpers.call_auth('package_update',
+                context=context, id=dataset['id'])
+
     def test_dataset_update_public_member(self):
 
         org = factories.Organization()
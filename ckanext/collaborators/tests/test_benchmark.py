@@ -0,0 +1,74 @@
+from nose.tools import assert_equals, assert_raises
+
+from ckan import model
+
+from ckanext.collaborators import benchmark
+from ckanext.collaborators.instrumentation import QueryCounter
+from ckanext.collaborators.model import DatasetMember
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class TestPercentiles(object):
+
+    def test_percentile(self):
+        values = range(1, 101)
+
+        assert_equals(benchmark.percentile(values, 50), 50)
+        assert_equals(benchmark.percentile(values, 95), 95)
+        assert_equals(benchmark.percentile(values, 99), 99)
+        assert_equals(benchmark.percentile([3], 99), 3)
+        assert_equals(benchmark.percentile([], 50), None)
+
+    def test_summarize(self):
+        summary = benchmark.summarize([0.001, 0.002, 0.003], [1, 2, 5])
+
+        assert_equals(summary['calls'], 3)
+        assert_equals(summary['latency_ms']['p50'], 2.0)
+        assert_equals(summary['queries'],
+                      {'p50': 2, 'max': 5, 'total': 8})
+
+
+class TestQueryCounter(FunctionalTestBase):
+
+    def test_count(self):
+        with QueryCounter() as counter:
+            model.Session.execute('SELECT 1')
+            model.Session.execute('SELECT 2')
+        model.Session.execute('SELECT 3')
+
+        assert_equals(counter.count, 2)
+        assert_equals(counter.statements, ['SELECT 1', 'SELECT 2'])
+
+
+class TestBenchmark(FunctionalTestBase):
+
+    def test_run(self):
+        sizes = {'orgs': 2, 'users': 5, 'datasets': 10, 'memberships': 20,
+                 'power_users': 1, 'power_user_memberships': 8,
+                 'iterations': 3}
+
+        results = benchmark.run(sizes, batch_size=4, seed=1)
+
+        assert_equals(results['sizes'], sizes)
+        assert_equals(set(results['results'].keys()), set([
+            'dataset_collaborator_create',
+            'dataset_collaborator_list',
+            'dataset_collaborator_list_for_user',
+            'dataset_collaborator_list_for_user (power user)',
+            'package_update_auth',
+            'get_user_dataset_labels',
+            'get_user_dataset_labels (power user)',
+        ]))
+        assert_equals(
+            results['results']['dataset_collaborator_list']['calls'], 3)
+        assert results['results']['dataset_collaborator_list'][
+            'queries']['max'] > 0
+
+        # The synthetic data is removed
+        assert_equals(model.Session.query(DatasetMember).count(), 0)
+        assert_equals(model.Session.query(model.Package).filter(
+            model.Package.name.like(results['prefix'] + '%')).count(), 0)
+
+    def test_wrong_sizes(self):
+        assert_raises(ValueError, benchmark.Benchmark,
+                      {'datasets': 5, 'power_user_memberships': 10})
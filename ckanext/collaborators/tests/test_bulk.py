@@ -0,0 +1,221 @@
+import io
+import json
+
+from nose.tools import assert_equals, assert_raises
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories
+
+from ckanext.collaborators import bulk, migration
+from ckanext.collaborators.model import DatasetMember
+from ckanext.collaborators.tests import (
+    FunctionalTestBase, create_collaborators)
+
+
+class TestReadCollaborators(object):
+
+    def test_read_csv(self):
+        f = io.BytesIO(b'dataset_id,user_id,capacity,other\n'
+                       b'dataset1,user1,editor,x\n'
+                       b'dataset2,user2,member,y\n')
+
+        rows = list(bulk.read_collaborators(f, 'csv'))
+
+        assert_equals(rows, [
+            (1, {'dataset_id': 'dataset1', 'user_id': 'user1',
+                 'capacity': 'editor'}),
+            (2, {'dataset_id': 'dataset2', 'user_id': 'user2',
+                 'capacity': 'member'}),
+        ])
+
+    def test_read_jsonl(self):
+        f = io.StringIO(u'{"dataset_id": "dataset1", "user_id": "user1", '
+                        u'"capacity": "editor"}\n'
+                        u'\n'
+                        u'not json\n'
+                        u'{"dataset_id": "dataset2"}\n')
+
+        rows = list(bulk.read_collaborators(f, 'jsonl'))
+
+        assert_equals(rows, [
+            (1, {'dataset_id': 'dataset1', 'user_id': 'user1',
+                 'capacity': 'editor'}),
+            (3, {}),
+            (4, {'dataset_id': 'dataset2', 'user_id': None,
+                 'capacity': None}),
+        ])
+
+    def test_unknown_format(self):
+        assert_raises(ValueError, list,
+                      bulk.read_collaborators(io.BytesIO(b''), 'xml'))
+
+    def test_guess_format(self):
+        assert_equals(bulk.guess_format('collaborators.JSONL'), 'jsonl')
+        assert_equals(bulk.guess_format('collaborators.csv'), 'csv')
+
+
+class TestImportCollaborators(FunctionalTestBase):
+
+    def _rows(self, items):
+        return [(line, dict(zip(bulk.FIELDS, item)))
+                for line, item in enumerate(items, 1)]
+
+    def _members(self):
+        return sorted((m.dataset_id, m.user_id, m.capacity)
+                      for m in model.Session.query(DatasetMember))
+
+    def test_import(self):
+        datasets = [factories.Dataset() for i in range(3)]
+        user = factories.User()
+        rows = self._rows([
+            (datasets[0]['name'], user['name'], 'editor'),
+            (datasets[1]['id'], user['id'], 'member'),
+            (datasets[2]['id'], user['id'], 'admin'),
+            ('unknown', user['id'], 'member'),
+        ])
+
+        results = list(bulk.import_collaborators(rows, batch_size=3))
+
+        assert_equals([(line, processed) for line, processed, rejected
+                       in results], [(3, 3), (4, 1)])
+        assert_equals(
+            [(line, error) for line, processed, rejected in results
+             for line, row, error in rejected],
+            [(3, 'Capacity must be one of "editor, member"'),
+             (4, 'Dataset not found')])
+        assert_equals(self._members(), sorted([
+            (datasets[0]['id'], user['id'], 'editor'),
+            (datasets[1]['id'], user['id'], 'member'),
+        ]))
+
+    def test_import_resume(self):
+        datasets = [factories.Dataset() for i in range(3)]
+        user = factories.User()
+        rows = self._rows([(dataset['id'], user['id'], 'editor')
+                           for dataset in datasets])
+
+        results = list(bulk.import_collaborators(rows, batch_size=1, skip=2))
+
+        assert_equals(results, [(3, 1, [])])
+        assert_equals(self._members(),
+                      [(datasets[2]['id'], user['id'], 'editor')])
+
+
+    def test_import_blank_lines_are_not_counted(self):
+        datasets = [factories.Dataset() for i in range(2)]
+        user = factories.User()
+        f = io.StringIO(u'\n'.join([
+            json.dumps({'dataset_id': datasets[0]['id'],
+                        'user_id': user['id'], 'capacity': 'editor'}),
+            u'',
+            u'',
+            json.dumps({'dataset_id': datasets[1]['id'],
+                        'user_id': user['id'], 'capacity': 'editor'}),
+        ]))
+
+        results = list(bulk.import_collaborators(
+            bulk.read_collaborators(f, 'jsonl')))
+
+        assert_equals(results, [(4, 2, [])])
+
+
+class TestExportCollaborators(FunctionalTestBase):
+
+    def test_export_csv(self):
+        dataset = factories.Dataset()
+        user = factories.User()
+        create_collaborators([dataset], [user])
+        f = io.BytesIO()
+
+        count = bulk.export_collaborators(f, 'csv', batch_size=1)
+
+        assert_equals(count, 1)
+        lines = f.getvalue().splitlines()
+        assert_equals(lines[0], b'dataset_id,user_id,capacity,modified')
+        assert lines[1].startswith(
+            ','.join([dataset['id'], user['id'], 'editor']).encode('utf-8'))
+
+    def test_export_jsonl_with_names(self):
+        dataset = factories.Dataset()
+        user = factories.User()
+        create_collaborators([dataset], [user])
+        f = io.StringIO()
+
+        bulk.export_collaborators(f, 'jsonl', include_names=True)
+
+        rows = [json.loads(line) for line in f.getvalue().splitlines()]
+        assert_equals(len(rows), 1)
+        assert_equals(rows[0]['dataset_name'], dataset['name'])
+        assert_equals(rows[0]['user_name'], user['name'])
+
+    def test_export_with_names_includes_orphans(self):
+        dataset = factories.Dataset()
+        user = factories.User()
+        create_collaborators([dataset], [user])
+        # Without the foreign keys, so orphans can be created
+        migration.stamp(model.meta.engine, migration.head())
+        migration.migrate(3)
+        try:
+            create_collaborators([dataset], [{'id': 'missing-user'}])
+            f = io.StringIO()
+
+            count = bulk.export_collaborators(f, 'jsonl', include_names=True)
+        finally:
+            model.Session.query(DatasetMember).filter(
+                DatasetMember.user_id == 'missing-user').delete()
+            model.Session.commit()
+            migration.migrate()
+
+        assert_equals(count, 2)
+        rows = dict((row['user_id'], row) for row in
+                    (json.loads(line) for line in f.getvalue().splitlines()))
+        assert_equals(rows['missing-user']['user_name'], None)
+        assert_equals(rows['missing-user']['dataset_name'], dataset['name'])
+
+    def test_export_filters(self):
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        other_dataset = factories.Dataset()
+        user = factories.User()
+        create_collaborators([dataset, other_dataset], [user], 'editor')
+        create_collaborators(
+            [factories.Dataset(owner_org=org['id'])], [user], 'member')
+
+        f = io.StringIO()
+        count = bulk.export_collaborators(
+            f, 'jsonl', owner_org=org['name'], capacity='editor')
+
+        assert_equals(count, 1)
+        assert_equals(json.loads(f.getvalue())['dataset_id'], dataset['id'])
+
+    def test_export_modified_since_is_inclusive(self):
+        user = factories.User()
+        create_collaborators([factories.Dataset()], [user])
+        member = model.Session.query(DatasetMember).one()
+        create_collaborators([factories.Dataset()], [user])
+
+        f = io.StringIO()
+        count = bulk.export_collaborators(
+            f, 'jsonl', modified_since=member.modified)
+
+        assert_equals(count, 2)
+
+    def test_export_organization_not_found(self):
+        assert_raises(toolkit.ObjectNotFound, bulk.export_collaborators,
+                      io.StringIO(), 'jsonl', owner_org='unknown')
+
+    def test_export_can_be_imported(self):
+        datasets = [factories.Dataset(), factories.Dataset()]
+        user = factories.User()
+        for dataset in datasets:
+            create_collaborators([dataset], [user])
+        f = io.BytesIO()
+        bulk.export_collaborators(f, 'csv', include_names=True)
+        model.Session.query(DatasetMember).delete()
+        model.Session.commit()
+
+        f.seek(0)
+        list(bulk.import_collaborators(bulk.read_collaborators(f, 'csv')))
+
+        assert_equals(model.Session.query(DatasetMember).count(), 2)
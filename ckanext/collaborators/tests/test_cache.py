@@ -0,0 +1,143 @@
+from nose.tools import assert_equals
+
+from ckan.tests import helpers, factories
+
+from ckanext.collaborators import cache
+from ckanext.collaborators.plugin import CollaboratorsPlugin
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class FakeRedis(object):
+    '''Local stand-in for a Redis client'''
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [key for key in self.data if key.startswith(pattern[:-1])]
+
+
+class TestMemoryBackend(object):
+
+    def test_get_set(self):
+        backend = cache.MemoryBackend(ttl=60, size=10)
+        backend.set('a', ['label'])
+
+        assert_equals(backend.get('a'), ['label'])
+        assert_equals(backend.get('b'), None)
+
+    def test_expires(self):
+        backend = cache.MemoryBackend(ttl=-1, size=10)
+        backend.set('a', ['label'])
+
+        assert_equals(backend.get('a'), None)
+
+    def test_least_recently_used_are_evicted(self):
+        backend = cache.MemoryBackend(ttl=60, size=2)
+        backend.set('a', ['a'])
+        backend.set('b', ['b'])
+        backend.get('a')
+        backend.set('c', ['c'])
+
+        assert_equals(backend.get('a'), ['a'])
+        assert_equals(backend.get('b'), None)
+        assert_equals(backend.get('c'), ['c'])
+
+
+class TestRedisBackend(object):
+
+    def test_get_set_delete(self):
+        backend = cache.RedisBackend(ttl=60, client=FakeRedis())
+        backend.set('a', ['label'])
+        backend.set('b', ['label'])
+
+        assert_equals(backend.get('a'), ['label'])
+
+        backend.delete(['a'])
+        assert_equals(backend.get('a'), None)
+
+        backend.clear()
+        assert_equals(backend.get('b'), None)
+
+
+class TestLabelCache(FunctionalTestBase):
+
+    def setup(self):
+        super(TestLabelCache, self).setup()
+        self._cache = cache._label_cache
+        cache._label_cache = cache.LabelCache(
+            cache.RedisBackend(ttl=60, client=FakeRedis()))
+
+    def teardown(self):
+        cache._label_cache = self._cache
+
+    def _labels(self, user):
+        from ckan import model
+        return CollaboratorsPlugin().get_user_dataset_labels(
+            model.User.get(user['id']))
+
+    def test_labels_are_cached(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='member')
+
+        labels = self._labels(user)
+        assert_equals(self._labels(user), labels)
+
+        stats = cache.get_label_cache().stats()
+        assert_equals(stats['misses'], 1)
+        assert_equals(stats['hits'], 1)
+
+    def test_create_and_delete_invalidate(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        label = 'collaborator-{}'.format(dataset['id'])
+
+        assert label not in self._labels(user)
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='member')
+        assert label in self._labels(user)
+
+        helpers.call_action(
+            'dataset_collaborator_delete',
+            id=dataset['id'], user_id=user['id'])
+        assert label not in self._labels(user)
+
+    def test_package_delete_invalidates(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        label = 'collaborator-{}'.format(dataset['id'])
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='member')
+        assert label in self._labels(user)
+
+        helpers.call_action('package_delete', id=dataset['name'])
+
+        assert label not in self._labels(user)
+
+    def test_user_delete_invalidates(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='member')
+        self._labels(user)
+
+        helpers.call_action('user_delete', id=user['name'])
+
+        assert_equals(cache.get_label_cache().backend.get(user['id']), None)
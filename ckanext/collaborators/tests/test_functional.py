@@ -66,6 +66,7 @@ class TestCollaborators(helpers.FunctionalTestBase):
 
         assert_in('Editor Collaborator', res.body)
         assert_in('<td>editor</td>', res.body)
+        assert_in('1 collaborator</h3>', res.body)
 
     def test_member_collaborators_are_shown(self):
         dataset = factories.Dataset(
@@ -0,0 +1,209 @@
+import mock
+
+from nose.tools import assert_equals, assert_in, assert_not_in, assert_raises
+
+from ckan.plugins import toolkit
+from ckan.tests import helpers, factories
+
+from ckanext.collaborators import instrumentation
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class TestSinks(object):
+
+    def _measurement(self, seconds=0.012, queries=2, rows=3, error=False):
+        m = instrumentation.Measurement('action', 'dataset_collaborator_list')
+        m.seconds = seconds
+        m.queries = queries
+        m.rows = rows
+        m.error = error
+        return m
+
+    def test_memory_sink(self):
+        sink = instrumentation.MemorySink()
+
+        sink.record(self._measurement())
+        sink.record(self._measurement(seconds=0.2, rows=None, error=True))
+
+        metric = sink.snapshot()['action.dataset_collaborator_list']
+        assert_equals(metric['calls'], 2)
+        assert_equals(metric['errors'], 1)
+        assert_equals(metric['queries'], 4)
+        assert_equals(metric['rows'], 3)
+        assert_equals(round(metric['max_ms']), 200)
+        assert_equals(metric['histogram']['le_25'], 1)
+        assert_equals(metric['histogram']['le_250'], 1)
+
+        sink.reset()
+        assert_equals(sink.snapshot(), {})
+
+    @mock.patch('ckanext.collaborators.instrumentation.socket.socket')
+    def test_statsd_sink(self, mock_socket):
+        sink = instrumentation.StatsdSink('statsd.example.com', '8125',
+                                          prefix='ckan')
+
+        sink.record(self._measurement())
+
+        packet, address = mock_socket.return_value.sendto.call_args[0]
+        assert_equals(address, ('statsd.example.com', 8125))
+        assert_equals(packet.splitlines(), [
+            b'ckan.action.dataset_collaborator_list.calls:1|c',
+            b'ckan.action.dataset_collaborator_list.latency:12.000|ms',
+            b'ckan.action.dataset_collaborator_list.queries:2|h',
+            b'ckan.action.dataset_collaborator_list.rows:3|h',
+        ])
+
+    def test_unknown_sink(self):
+        assert_raises(ValueError, instrumentation.configure_metrics,
+                      {'ckanext.collaborators.metrics.sinks': 'graphite'})
+
+
+class TestInstrumented(object):
+
+    def teardown(self):
+        instrumentation._sinks = []
+
+    def test_disabled(self):
+
+        @instrumentation.instrumented('action', 'test')
+        def func():
+            return [1, 2]
+
+        assert_equals(func(), [1, 2])
+        assert_equals(instrumentation._sinks, [])
+
+    def test_enabled(self):
+        sink = instrumentation.MemorySink()
+        instrumentation._sinks = [sink]
+
+        @instrumentation.instrumented('action', 'test')
+        def func():
+            return {'results': [1, 2], 'next_cursor': None}
+
+        @instrumentation.instrumented('auth', 'test')
+        def fails():
+            raise toolkit.NotAuthorized()
+
+        func()
+        assert_raises(toolkit.NotAuthorized, fails)
+
+        stats = sink.snapshot()
+        assert_equals(stats['action.test']['rows'], 2)
+        assert_equals(stats['auth.test']['errors'], 1)
+
+    def test_attributes_are_kept(self):
+
+        @instrumentation.instrumented('action', 'test')
+        @toolkit.chained_action
+        def func(up_func, context, data_dict):
+            pass
+
+        assert func.chained_action
+        assert_equals(func.__name__, 'func')
+
+
+class TestCollaboratorsStats(FunctionalTestBase):
+
+    def setup(self):
+        super(TestCollaboratorsStats, self).setup()
+        instrumentation.configure_metrics(
+            {'ckanext.collaborators.metrics.sinks': 'memory'})
+
+    def teardown(self):
+        instrumentation.configure_metrics({})
+
+    def test_stats(self):
+        dataset = factories.Dataset()
+        user = factories.User()
+        sysadmin = factories.Sysadmin()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='editor')
+        helpers.call_action('dataset_collaborator_list', id=dataset['id'])
+
+        stats = helpers.call_action(
+            'collaborators_stats',
+            context={'user': sysadmin['name'], 'ignore_auth': False},
+            reset=True)
+
+        metric = stats['action.dataset_collaborator_list']
+        assert_equals(metric['calls'], 1)
+        assert_equals(metric['rows'], 1)
+        assert metric['queries'] > 0
+        assert_equals(
+            stats['action.dataset_collaborator_create']['calls'], 1)
+
+        stats = helpers.call_action('collaborators_stats')
+        assert 'action.dataset_collaborator_list' not in stats
+
+    def test_stats_sysadmins_only(self):
+        user = factories.User()
+
+        assert_raises(toolkit.NotAuthorized, helpers.call_action,
+                      'collaborators_stats',
+                      context={'user': user['name'], 'ignore_auth': False})
+
+    def test_stats_not_enabled(self):
+        instrumentation.configure_metrics({})
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+                      'collaborators_stats')
+
+
+class TestSlowQueryLog(FunctionalTestBase):
+
+    def setup(self):
+        super(TestSlowQueryLog, self).setup()
+        instrumentation.configure_slow_query_log(
+            {'ckanext.collaborators.slow_queries.threshold': '0'})
+
+    def teardown(self):
+        instrumentation.configure_slow_query_log({})
+
+    def _messages(self, mock_log):
+        return [c[0][0] for c in mock_log.warning.call_args_list]
+
+    @mock.patch('ckanext.collaborators.instrumentation.log')
+    def test_slow_queries_are_logged(self, mock_log):
+        dataset = factories.Dataset()
+        helpers.call_action('dataset_collaborator_list', id=dataset['id'])
+
+        messages = [m for m in self._messages(mock_log)
+                    if 'FROM dataset_member' in m]
+        assert messages
+        assert_in('Called from: action.dataset_collaborator_list',
+                  messages[0])
+        assert_in('Location: collaborators/logic/action.py', messages[0])
+        assert_in(dataset['id'], messages[0])
+        assert_in('Plan:', messages[0])
+
+    @mock.patch('ckanext.collaborators.instrumentation.log')
+    def test_other_tables_are_ignored(self, mock_log):
+        factories.User()
+
+        assert_equals(
+            [m for m in self._messages(mock_log) if 'dataset_member' in m],
+            [])
+
+    @mock.patch('ckanext.collaborators.instrumentation.log')
+    def test_explain_can_be_disabled(self, mock_log):
+        instrumentation.configure_slow_query_log({
+            'ckanext.collaborators.slow_queries.threshold': '0',
+            'ckanext.collaborators.slow_queries.explain': 'false'})
+        dataset = factories.Dataset()
+
+        helpers.call_action('dataset_collaborator_list', id=dataset['id'])
+
+        messages = [m for m in self._messages(mock_log)
+                    if 'FROM dataset_member' in m]
+        assert messages
+        assert_not_in('Plan:', messages[0])
+
+    @mock.patch('ckanext.collaborators.instrumentation.log')
+    def test_disabled(self, mock_log):
+        instrumentation.configure_slow_query_log({})
+        dataset = factories.Dataset()
+
+        helpers.call_action('dataset_collaborator_list', id=dataset['id'])
+
+        assert_equals(self._messages(mock_log), [])
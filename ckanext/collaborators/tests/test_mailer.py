@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import socket
+import smtplib
+import datetime
+
 from nose.tools import assert_equals, assert_raises
 import mock
 from ckan.tests import helpers, factories
 from ckan import model
+from ckan.lib.mailer import MailerException
+from ckan.plugins import toolkit
 
-from ckanext.collaborators.model import DatasetMember
+from ckanext.collaborators.model import DatasetMember, MailOutbox
 from ckanext.collaborators.tests import FunctionalTestBase
 from ckanext.collaborators import mailer
 
@@ -38,3 +44,284 @@ class TestCollaboratorsMailer(FunctionalTestBase):
         dataset = factories.Dataset(title=u'réfugiés')
         subject = mailer._compose_email_subj(model.Package.get(dataset['id']))
         assert u'réfugiés' in subject
+
+    @mock.patch('ckanext.collaborators.mailer.mail_user')
+    def test_email_notifications_batch(self, mock_mail_user):
+        dataset = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+
+        mailer.mail_notifications_to_collaborators([
+            {'dataset_id': dataset['id'], 'user_id': user1['id'],
+             'capacity': 'editor'},
+            {'dataset_id': dataset['id'], 'user_id': user2['id'],
+             'capacity': 'member'},
+            {'dataset_id': 'xxx', 'user_id': user2['id'],
+             'capacity': 'member'},
+        ], 'delete')
+
+        assert_equals(mock_mail_user.call_count, 2)
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'async')
+    @mock.patch('ckanext.collaborators.mailer.toolkit.enqueue_job')
+    @mock.patch('ckanext.collaborators.mailer.mail_user')
+    def test_async_notifications_are_enqueued(self, mock_mail_user,
+                                              mock_enqueue_job):
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='editor',
+            send_mail=True)
+
+        assert_equals(mock_mail_user.call_count, 0)
+        assert_equals(mock_enqueue_job.call_count, 1)
+        args = mock_enqueue_job.call_args[0]
+        assert_equals(args[0], mailer.send_notifications_job)
+        assert_equals(args[1], [[{
+            'dataset_id': dataset['id'], 'user_id': user['id'],
+            'capacity': 'editor'}], 'create', 0])
+
+    @mock.patch('ckanext.collaborators.mailer.toolkit.enqueue_job')
+    @mock.patch('ckanext.collaborators.mailer.mail_user')
+    def test_notifications_job_retries(self, mock_mail_user,
+                                       mock_enqueue_job):
+        dataset = factories.Dataset()
+        user = factories.User()
+        mock_mail_user.side_effect = MailerException('Error')
+        notifications = [{
+            'dataset_id': dataset['id'], 'user_id': user['id'],
+            'capacity': 'editor'}]
+
+        mailer.send_notifications_job(notifications, 'create')
+
+        assert_equals(mock_mail_user.call_count, 1)
+        assert_equals(mock_enqueue_job.call_count, 1)
+        args = mock_enqueue_job.call_args[0]
+        assert_equals(args[0], mailer.send_notifications_job)
+        assert_equals(args[1], [notifications, 'create', 1])
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.retries', '2')
+    @mock.patch('ckanext.collaborators.mailer.toolkit.enqueue_job')
+    @mock.patch('ckanext.collaborators.mailer.mail_user')
+    def test_notifications_job_gives_up(self, mock_mail_user,
+                                        mock_enqueue_job):
+        dataset = factories.Dataset()
+        user = factories.User()
+        mock_mail_user.side_effect = MailerException('Error')
+
+        mailer.send_notifications_job([{
+            'dataset_id': dataset['id'], 'user_id': user['id'],
+            'capacity': 'editor'}], 'create', 2)
+
+        assert_equals(mock_mail_user.call_count, 1)
+        assert_equals(mock_enqueue_job.call_count, 0)
+
+
+class TestCollaboratorsOutbox(FunctionalTestBase):
+
+    def _create(self, **kwargs):
+        dataset = factories.Dataset()
+        user = factories.User()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='editor',
+            send_mail=True, **kwargs)
+        return dataset, user
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    @mock.patch('ckanext.collaborators.mailer.mail_user')
+    def test_notifications_are_added_to_outbox(self, mock_mail_user):
+        dataset, user = self._create()
+
+        assert_equals(mock_mail_user.call_count, 0)
+        row = model.Session.query(MailOutbox).one()
+        assert_equals(row.dataset_id, dataset['id'])
+        assert_equals(row.user_id, user['id'])
+        assert_equals(row.event, 'create')
+        assert_equals(row.sent, None)
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    def test_notifications_are_not_added_on_errors(self):
+        dataset = factories.Dataset()
+
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action,
+            'dataset_collaborator_delete',
+            id=dataset['id'], user_id=factories.User()['id'])
+
+        assert_equals(model.Session.query(MailOutbox).count(), 0)
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    @mock.patch('ckanext.collaborators.mailer.smtplib.SMTP')
+    def test_send_outbox_reuses_connection(self, mock_smtp):
+        for i in range(3):
+            self._create()
+
+        sent, failed = mailer.send_outbox(batch_size=2)
+
+        assert_equals((sent, failed), (3, 0))
+        assert_equals(mock_smtp.call_count, 1)
+        assert_equals(mock_smtp.return_value.sendmail.call_count, 3)
+        assert_equals(model.Session.query(MailOutbox).count(), 0)
+
+    @mock.patch('ckanext.collaborators.mailer.smtplib.SMTP')
+    def test_send_outbox_does_not_connect_when_empty(self, mock_smtp):
+
+        assert_equals(mailer.send_outbox(), (0, 0))
+        assert_equals(mock_smtp.call_count, 0)
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    @mock.patch('ckanext.collaborators.mailer.smtplib.SMTP')
+    def test_send_outbox_connection_errors(self, mock_smtp):
+        self._create()
+        mock_smtp.return_value.connect.side_effect = socket.error(
+            'Connection refused')
+
+        assert_raises(MailerException, mailer.send_outbox)
+
+        row = model.Session.query(MailOutbox).one()
+        assert_equals(row.attempts, 0)
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    @mock.patch('ckanext.collaborators.mailer.smtplib.SMTP')
+    def test_send_outbox_failures_are_retried(self, mock_smtp):
+        self._create()
+        mock_smtp.return_value.sendmail.side_effect = [
+            smtplib.SMTPRecipientsRefused({}), None]
+
+        assert_equals(mailer.send_outbox(), (0, 1))
+        row = model.Session.query(MailOutbox).one()
+        assert_equals(row.attempts, 1)
+        assert row.last_error
+
+        assert_equals(mailer.send_outbox(), (1, 0))
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    @mock.patch('ckanext.collaborators.mailer.smtplib.SMTP')
+    def test_send_outbox_smtp_errors_do_not_stop_the_batch(self, mock_smtp):
+        for i in range(3):
+            self._create()
+        mock_smtp.return_value.sendmail.side_effect = [
+            smtplib.SMTPDataError(554, 'Message rejected'),
+            smtplib.SMTPSenderRefused(451, 'Rate limited', 'from@example.com'),
+            None]
+
+        assert_equals(mailer.send_outbox(), (1, 2))
+        rows = model.Session.query(MailOutbox).all()
+        assert_equals(len(rows), 2)
+        assert all(row.attempts == 1 and row.last_error for row in rows)
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.retries', '0')
+    @mock.patch('ckanext.collaborators.mailer.smtplib.SMTP')
+    def test_send_outbox_prunes_given_up_notifications(self, mock_smtp):
+        self._create()
+        self._create()
+        mock_smtp.return_value.sendmail.side_effect = \
+            smtplib.SMTPRecipientsRefused({})
+
+        assert_equals(mailer.send_outbox(), (0, 2))
+        rows = model.Session.query(MailOutbox).all()
+        rows[0].last_attempt -= datetime.timedelta(days=31)
+        model.Session.commit()
+
+        assert_equals(mailer.send_outbox(), (0, 0))
+        assert_equals(model.Session.query(MailOutbox).count(), 1)
+
+    def _age_outbox(self):
+        for row in model.Session.query(MailOutbox):
+            row.created -= datetime.timedelta(hours=1)
+        model.Session.commit()
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.digest_window', '600')
+    @mock.patch('ckanext.collaborators.mailer.smtplib.SMTP')
+    def test_send_outbox_digest(self, mock_smtp):
+        user = factories.User()
+        other_user = factories.User()
+        datasets = [factories.Dataset() for i in range(3)]
+        helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': dataset['id'], 'user_id': user['id'],
+                 'capacity': 'editor'} for dataset in datasets] + [
+                {'id': datasets[0]['id'], 'user_id': other_user['id'],
+                 'capacity': 'member'}],
+            send_mail=True)
+        self._age_outbox()
+
+        assert_equals(mailer.send_outbox(), (4, 0))
+
+        sendmail = mock_smtp.return_value.sendmail
+        assert_equals(sendmail.call_count, 2)
+        recipients = [c[0][1] for c in sendmail.call_args_list]
+        assert [user['email']] in recipients
+        assert [other_user['email']] in recipients
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.digest_window', '600')
+    @mock.patch('ckanext.collaborators.mailer.smtplib.SMTP')
+    def test_send_outbox_digest_with_purged_dataset(self, mock_smtp):
+        user = factories.User()
+        datasets = [factories.Dataset() for i in range(3)]
+        helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': dataset['id'], 'user_id': user['id'],
+                 'capacity': 'editor'} for dataset in datasets],
+            send_mail=True)
+        helpers.call_action('dataset_purge', id=datasets[0]['id'])
+        self._age_outbox()
+
+        assert_equals(mailer.send_outbox(), (2, 1))
+
+        sendmail = mock_smtp.return_value.sendmail
+        assert_equals(sendmail.call_count, 1)
+        assert_equals(sendmail.call_args[0][1], [user['email']])
+        assert_equals(mailer.send_outbox(), (0, 0))
+
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.delivery', 'outbox')
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.digest_window', '600')
+    @mock.patch('ckanext.collaborators.mailer.smtplib.SMTP')
+    def test_send_outbox_digest_waits_for_window(self, mock_smtp):
+        self._create()
+
+        assert_equals(mailer.send_outbox(), (0, 0))
+        assert_equals(mock_smtp.return_value.sendmail.call_count, 0)
+
+    def test_digest_body(self):
+        user = factories.User(fullname=u'Digest User')
+        dataset1 = factories.Dataset(title=u'First dataset')
+        dataset2 = factories.Dataset(title=u'Second dataset')
+        rows = [
+            MailOutbox(user_id=user['id'], dataset_id=dataset1['id'],
+                       capacity='editor', event='create'),
+            MailOutbox(user_id=user['id'], dataset_id=dataset2['id'],
+                       capacity='member', event='delete'),
+        ]
+        datasets = dict((d['id'], model.Package.get(d['id']))
+                        for d in (dataset1, dataset2))
+
+        body = mailer._compose_digest_body(
+            model.User.get(user['id']), rows, datasets)
+
+        assert u'Digest User' in body
+        assert u'First dataset' in body
+        assert u'Second dataset' in body
@@ -0,0 +1,121 @@
+from nose.tools import assert_equals, assert_raises
+
+from ckan import model
+from ckan.tests import helpers, factories
+
+from ckanext.collaborators import migration
+from ckanext.collaborators.model import DatasetMember, foreign_keys_exist
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class TestMigrationPlan(object):
+
+    def setup(self):
+        self._migrations = migration.MIGRATIONS
+        migration.MIGRATIONS = [
+            migration.Migration(version, u'Migration {}'.format(version),
+                                None, None)
+            for version in (1, 2, 3)]
+
+    def teardown(self):
+        migration.MIGRATIONS = self._migrations
+
+    def test_upgrade_to_head(self):
+
+        steps = migration.plan(1)
+
+        assert_equals([(m.version, d) for m, d in steps],
+                      [(2, 'upgrade'), (3, 'upgrade')])
+
+    def test_upgrade_from_unversioned(self):
+
+        steps = migration.plan(0, 2)
+
+        assert_equals([(m.version, d) for m, d in steps],
+                      [(1, 'upgrade'), (2, 'upgrade')])
+
+    def test_downgrade(self):
+
+        steps = migration.plan(3, 1)
+
+        assert_equals([(m.version, d) for m, d in steps],
+                      [(3, 'downgrade'), (2, 'downgrade')])
+
+    def test_up_to_date(self):
+
+        assert_equals(migration.plan(3), [])
+
+    def test_unknown_version(self):
+
+        assert_raises(ValueError, migration.plan, 1, 7)
+
+
+class TestMigrate(FunctionalTestBase):
+
+    def setup(self):
+        super(TestMigrate, self).setup()
+        migration.stamp(model.meta.engine, migration.head())
+
+    def test_stamp(self):
+
+        assert_equals(migration.current_version(), migration.head())
+
+    def test_up_to_date(self):
+
+        assert_equals(migration.migrate(), [])
+
+    def test_dry_run_does_not_apply(self):
+
+        migration.stamp(model.meta.engine, 0)
+
+        steps = migration.migrate(dry_run=True)
+
+        assert_equals(len(steps), len(migration.MIGRATIONS))
+        assert_equals(migration.current_version(), 0)
+
+    def test_migrations_can_be_reapplied(self):
+
+        migration.stamp(model.meta.engine, 0)
+
+        migration.migrate()
+
+        assert_equals(migration.current_version(), migration.head())
+
+    def test_foreign_keys_remove_orphans(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], user_id=user['id'], capacity='editor')
+        migration.migrate(3)
+        assert not foreign_keys_exist()
+        model.Session.execute(
+            "INSERT INTO dataset_member (id, dataset_id, user_id, capacity) "
+            "VALUES ('orphan', :dataset_id, 'unknown', 'editor')",
+            {'dataset_id': dataset['id']})
+        model.Session.commit()
+
+        migration.migrate()
+
+        assert foreign_keys_exist()
+        assert_equals(
+            [m.user_id for m in model.Session.query(DatasetMember)],
+            [user['id']])
+
+    def test_lock_timeout_reset_after_failure(self):
+
+        connections = []
+
+        def upgrade(connection):
+            connections.append(connection.connection.connection)
+            raise ValueError('Step failed')
+
+        step = migration.Migration(
+            99, u'Failing migration', upgrade, None, transactional=False)
+
+        assert_raises(ValueError, migration._apply, step, u'upgrade')
+
+        cursor = connections[0].cursor()
+        cursor.execute('SHOW lock_timeout')
+        assert_equals(cursor.fetchone()[0], '0')
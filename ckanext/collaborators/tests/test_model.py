@@ -0,0 +1,103 @@
+from nose.tools import assert_equals, assert_in, assert_raises
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+
+from ckan import model
+from ckan.tests import factories
+
+from ckanext.collaborators.model import (
+    DatasetMember, foreign_keys_exist, find_orphan_members)
+from ckanext.collaborators.tests import (
+    FunctionalTestBase, create_collaborators)
+
+
+class TestDatasetMemberIndexes(FunctionalTestBase):
+
+    def test_indexes_exist(self):
+
+        indexes = [index['name'] for index in
+                   inspect(model.meta.engine).get_indexes('dataset_member')]
+
+        assert_in('idx_dataset_member_dataset_id_user_id', indexes)
+        assert_in('idx_dataset_member_user_id_capacity', indexes)
+
+    def test_dataset_user_is_unique(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        for capacity in ('editor', 'member'):
+            model.Session.add(DatasetMember(
+                dataset_id=dataset['id'], user_id=user['id'],
+                capacity=capacity))
+
+        assert_raises(IntegrityError, model.Session.commit)
+        model.Session.rollback()
+
+
+class TestDatasetMemberForeignKeys(FunctionalTestBase):
+
+    def test_foreign_keys_exist(self):
+
+        assert foreign_keys_exist()
+
+    def test_unknown_user_raises(self):
+
+        dataset = factories.Dataset()
+
+        model.Session.add(DatasetMember(
+            dataset_id=dataset['id'], user_id='unknown', capacity='editor'))
+
+        assert_raises(IntegrityError, model.Session.commit)
+        model.Session.rollback()
+
+    def test_deleting_rows_removes_collaborators(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        model.Session.add(DatasetMember(
+            dataset_id=dataset['id'], user_id=user['id'], capacity='editor'))
+        model.Session.commit()
+
+        model.Session.execute(
+            'DELETE FROM "user" WHERE id = :id', {'id': user['id']})
+        model.Session.commit()
+
+        assert_equals(model.Session.query(DatasetMember).count(), 0)
+
+
+class TestFindOrphanMembers(FunctionalTestBase):
+
+    def _find(self, **kwargs):
+        batches = list(find_orphan_members(
+            model.Session.connection(), 2, **kwargs))
+        return (sum(scanned for scanned, orphans in batches),
+                sorted(row.dataset_id for scanned, orphans in batches
+                       for row in orphans))
+
+    def test_no_orphans(self):
+
+        user = factories.User()
+        for i in range(3):
+            create_collaborators([factories.Dataset()], [user])
+
+        assert_equals(self._find(), (3, []))
+
+    def test_deleted_datasets_and_users(self):
+
+        user = factories.User()
+        deleted_user = factories.User()
+        active = factories.Dataset()
+        deleted = factories.Dataset()
+        other = factories.Dataset()
+        create_collaborators([active], [user])
+        create_collaborators([deleted], [user])
+        create_collaborators([other], [deleted_user])
+        model.Package.get(deleted['id']).state = 'deleted'
+        model.User.get(deleted_user['id']).state = 'deleted'
+        model.Session.commit()
+
+        assert_equals(self._find(), (3, []))
+        assert_equals(self._find(include_deleted=True),
+                      (3, sorted([deleted['id'], other['id']])))
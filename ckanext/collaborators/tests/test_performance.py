@@ -0,0 +1,175 @@
+'''Performance regression tests
+
+These check the number of SQL queries run by the actions, auth functions and
+pages of the extension, and that it does not grow with the number of
+collaborators (eg because of queries run once per row). Latency bounds are
+deliberately loose, they are only meant to catch gross regressions.
+'''
+import timeit
+from contextlib import contextmanager
+
+from nose.tools import assert_equals, assert_less_equal
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import helpers, factories
+
+from ckanext.collaborators.instrumentation import QueryCounter
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+# Number of collaborators each measurement is repeated with
+SIZES = (1, 10, 40)
+
+# Maximum number of queries allowed
+MAX_QUERIES = {
+    'dataset_collaborator_list': 3,
+    'dataset_collaborator_list_for_user': 3,
+    'dataset_collaborator_count': 3,
+    'package_update': 8,
+    'collaborators.read': 60,
+    'collaborators.new': 60,
+}
+
+# Maximum seconds allowed for a single call
+MAX_SECONDS = 2
+
+
+@contextmanager
+def timed(name):
+    '''Check the body of a with statement runs within MAX_SECONDS'''
+    started = timeit.default_timer()
+    yield
+    seconds = timeit.default_timer() - started
+    assert_less_equal(seconds, MAX_SECONDS,
+                      '{} took {:.2f}s'.format(name, seconds))
+
+
+def _count_queries(name, func, *args, **kwargs):
+    # Start from an empty session, as requests do
+    model.Session.remove()
+    with QueryCounter() as counter:
+        with timed(name):
+            func(*args, **kwargs)
+    return counter.count
+
+
+def _check_queries(name, counts):
+    assert_equals(len(set(counts)), 1,
+                  '{} queries grow with the number of collaborators: '
+                  '{}'.format(name, dict(zip(SIZES, counts))))
+    assert_less_equal(counts[0], MAX_QUERIES[name],
+                      '{} runs {} queries'.format(name, counts[0]))
+
+
+class TestActionQueries(FunctionalTestBase):
+
+    def _dataset_with_collaborators(self, size):
+        dataset = factories.Dataset()
+        helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[{'id': dataset['id'], 'user_id': user['id'],
+                            'capacity': 'editor'}
+                           for user in [factories.User()
+                                        for i in range(size)]])
+        return dataset
+
+    def _user_with_datasets(self, size):
+        user = factories.User()
+        helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[{'id': dataset['id'], 'user_id': user['id'],
+                            'capacity': 'editor'}
+                           for dataset in [factories.Dataset()
+                                           for i in range(size)]])
+        return user
+
+    def test_list(self):
+        counts = []
+        for size in SIZES:
+            dataset = self._dataset_with_collaborators(size)
+            counts.append(_count_queries(
+                'dataset_collaborator_list',
+                helpers.call_action, 'dataset_collaborator_list',
+                id=dataset['id'], include_user=True))
+
+        _check_queries('dataset_collaborator_list', counts)
+
+    def test_list_for_user(self):
+        counts = []
+        for size in SIZES:
+            user = self._user_with_datasets(size)
+            counts.append(_count_queries(
+                'dataset_collaborator_list_for_user',
+                helpers.call_action, 'dataset_collaborator_list_for_user',
+                id=user['id'], include_dataset=True))
+
+        _check_queries('dataset_collaborator_list_for_user', counts)
+
+    def test_count(self):
+        counts = []
+        for size in SIZES:
+            dataset = self._dataset_with_collaborators(size)
+            counts.append(_count_queries(
+                'dataset_collaborator_count',
+                helpers.call_action, 'dataset_collaborator_count',
+                id=dataset['id']))
+
+        _check_queries('dataset_collaborator_count', counts)
+
+    def test_package_update_auth(self):
+        counts = []
+        for size in SIZES:
+            user = self._user_with_datasets(size)
+            dataset_id = helpers.call_action(
+                'dataset_collaborator_list_for_user', id=user['id'])[0][
+                    'dataset_id']
+            counts.append(_count_queries(
+                'package_update', toolkit.check_access, 'package_update',
+                {'user': user['name'], 'model': model}, {'id': dataset_id}))
+
+        _check_queries('package_update', counts)
+
+
+class TestPageQueries(FunctionalTestBase):
+
+    def setup(self):
+        super(TestPageQueries, self).setup()
+        self.org_admin = factories.User()
+        self.org = factories.Organization(
+            users=[{'name': self.org_admin['name'], 'capacity': 'admin'}])
+        self.app = self._get_test_app()
+
+    def _dataset_with_collaborators(self, size):
+        dataset = factories.Dataset(private=True, owner_org=self.org['id'])
+        users = [factories.User() for i in range(size)]
+        helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[{'id': dataset['id'], 'user_id': user['id'],
+                            'capacity': 'member'} for user in users])
+        return dataset, users
+
+    def _get(self, url):
+        self.app.get(url, status=200, extra_environ={
+            'REMOTE_USER': self.org_admin['name'].encode('ascii')})
+
+    def test_read(self):
+        counts = []
+        for size in SIZES:
+            dataset, users = self._dataset_with_collaborators(size)
+            counts.append(_count_queries(
+                'collaborators.read', self._get, toolkit.url_for(
+                'collaborators.read', dataset_id=dataset['id'])))
+
+        _check_queries('collaborators.read', counts)
+
+    def test_new(self):
+        counts = []
+        for size in SIZES:
+            dataset, users = self._dataset_with_collaborators(size)
+            counts.append(_count_queries(
+                'collaborators.new', self._get, toolkit.url_for(
+                'collaborators.new', dataset_id=dataset['id'],
+                user_id=users[-1]['id'])))
+
+        _check_queries('collaborators.new', counts)
@@ -0,0 +1,97 @@
+import os
+import json
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equals, assert_in, assert_not_in
+
+from ckan.plugins import toolkit
+from ckan.tests import helpers, factories
+
+from ckanext.collaborators import profiling
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class TestPhases(object):
+
+    @mock.patch('ckanext.collaborators.profiling.timeit.default_timer')
+    def test_nested_phases_are_exclusive(self, mock_timer):
+        mock_timer.side_effect = [0, 1, 4, 6]
+        phases = profiling.Phases()
+
+        with phases.phase('render'):
+            with phases.phase('fetch'):
+                pass
+
+        assert_equals(dict(phases.seconds), {'render': 3, 'fetch': 3})
+        assert_equals(phases.as_dict(10), {
+            'render': 3000, 'fetch': 3000, 'other': 4000, 'total': 10000})
+
+    def test_phase_outside_requests(self):
+        with profiling.phase('auth'):
+            pass
+
+
+class TestProfiledViews(FunctionalTestBase):
+
+    def setup(self):
+        super(TestProfiledViews, self).setup()
+        self.sysadmin = factories.Sysadmin()
+        self.org_admin = factories.User()
+        org = factories.Organization(
+            users=[{'name': self.org_admin['name'], 'capacity': 'admin'}])
+        self.dataset = factories.Dataset(private=True, owner_org=org['id'])
+        self.app = self._get_test_app()
+        self.url = toolkit.url_for('collaborators.read',
+                                   dataset_id=self.dataset['id'])
+
+    def _get(self, user):
+        return self.app.get(self.url, extra_environ={
+            'REMOTE_USER': user['name'].encode('ascii')})
+
+    @helpers.change_config('ckanext.collaborators.profiling.enabled', 'true')
+    @helpers.change_config('ckanext.collaborators.profiling.header', 'true')
+    def test_header_for_sysadmins(self):
+        res = self._get(self.sysadmin)
+
+        header = res.headers[profiling.HEADER]
+        for name in ('auth', 'fetch', 'render', 'other', 'total'):
+            assert_in('{}='.format(name), header)
+
+        res = self._get(self.org_admin)
+        assert_not_in(profiling.HEADER, res.headers)
+
+    @helpers.change_config('ckanext.collaborators.profiling.header', 'true')
+    def test_disabled(self):
+        res = self._get(self.sysadmin)
+
+        assert_not_in(profiling.HEADER, res.headers)
+
+    @helpers.change_config('ckanext.collaborators.profiling.enabled', 'true')
+    @helpers.change_config('ckanext.collaborators.profiling.header', 'true')
+    @helpers.change_config(
+        'ckanext.collaborators.profiling.sample_rate', '0')
+    def test_sample_rate(self):
+        res = self._get(self.sysadmin)
+
+        assert_not_in(profiling.HEADER, res.headers)
+
+    @helpers.change_config('ckanext.collaborators.profiling.enabled', 'true')
+    def test_write_to_directory(self):
+        directory = tempfile.mkdtemp()
+        toolkit.config['ckanext.collaborators.profiling.directory'] = directory
+        try:
+            self._get(self.org_admin)
+
+            files = sorted(os.listdir(directory))
+            assert_equals([os.path.splitext(f)[1] for f in files],
+                          ['.json', '.prof'])
+            with open(os.path.join(directory, files[0])) as f:
+                info = json.load(f)
+            assert_equals(info['endpoint'], 'collaborators.read')
+            assert_equals(info['status'], 200)
+            assert_in('render', info['phases_ms'])
+        finally:
+            toolkit.config.pop('ckanext.collaborators.profiling.directory')
+            shutil.rmtree(directory)